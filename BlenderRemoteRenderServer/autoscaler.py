@@ -0,0 +1,49 @@
+import math
+
+# Seconds from the start of a job to its first frame: Blender startup and scene loading
+STARTUP_TIME = 60
+# A job is only worth submitting if it renders at least this many frames once started
+MIN_FRAMES_PER_JOB = 2
+# Seconds before the end of their time limit Slurm warns render jobs with SIGUSR1
+WALLTIME_WARNING = 300
+
+
+def parse_time_limit(value):
+    """
+        Seconds of a Slurm time limit, None if there is no limit
+        Accepted formats: M, M:S, H:M:S, D-H, D-H:M and D-H:M:S
+    """
+    value = str(value).strip()
+    if not value or value in ('0', 'UNLIMITED', 'INFINITE'):
+        return None
+    days = 0
+    if '-' in value:
+        days, value = value.split('-', 1)
+        fields = [int(field) for field in value.split(':')]
+        fields += [0] * (3 - len(fields))
+        hours, minutes, seconds = fields
+    else:
+        fields = [int(field) for field in value.split(':')]
+        if len(fields) == 1:
+            hours, minutes, seconds = 0, fields[0], 0
+        elif len(fields) == 2:
+            hours, minutes, seconds = 0, fields[0], fields[1]
+        else:
+            hours, minutes, seconds = fields
+    return ((int(days) * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def target_jobs(remaining, frame_time, pending_time, time_limit, ceiling):
+    """
+        Number of jobs that renders the frames left as fast as possible without idle jobs
+        A job is worth its queue wait and startup only if it still gets MIN_FRAMES_PER_JOB frames once
+        started, and there are at least enough jobs for the work left to fit in the job time limit,
+        within the ceiling set by the user
+    """
+    if remaining <= 0:
+        return 0
+    work = remaining * frame_time
+    jobs = math.floor(work / (pending_time + STARTUP_TIME + MIN_FRAMES_PER_JOB * frame_time))
+    if time_limit and time_limit - STARTUP_TIME > frame_time:
+        jobs = max(jobs, math.ceil(work / (time_limit - STARTUP_TIME)))
+    return max(1, min(jobs, remaining, ceiling))
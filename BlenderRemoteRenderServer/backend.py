@@ -1,65 +1,370 @@
 import subprocess
 import shutil
+import shlex
+import getpass
 import json
+import glob
+import threading
+import time
+from collections import deque, Counter
 from datetime import datetime
 import os.path
-from os import walk
+from output_index import OutputIndex
+from autoscaler import WALLTIME_WARNING
+from os import sched_getaffinity, sched_setaffinity, environ, getpid
+
+# Number of recent job queue waits the pending time estimate is taken from
+PENDING_SAMPLES = 20
+# Devices accepted by Blender --cycles-device
+CYCLES_DEVICES = ('CPU', 'CUDA', 'OPTIX', 'HIP', 'ONEAPI', 'METAL')
+# Job states of jobs that did not finish yet
+ACTIVE_STATES = ('PENDING', 'SUBMITTED', 'RUNNING', 'CONFIGURING', 'COMPLETING')
 
 class Backend():
-    def __init__(self):
+    def __init__(self, store=None):
         self.render_extension = 'png'
-
-    def get_blender_command(self, blend_file, export_path, render_device, frame_start, frame_end):
+        # Address of the server frame dispatcher, render jobs fall back to claiming frames on disk without it
+        self.dispatcher_address = None
+        # Directory of the server render cache, shared with the render jobs
+        self.render_cache = None
+        # Job ids of each render, indexed by export path, and last known state of each job
+        # Both are persisted in the job store and loaded back from it on restart
+        self.store = store
+        self.jobs = {}
+        self.job_states = {}
+        if store:
+            self.jobs, self.job_states = store.load_jobs()
+        # Rendered frames and previews of each render, updated from frames reported by the render jobs
+        self.outputs = OutputIndex(self.is_render_output, self.is_preview)
+        # Submission time of jobs not started yet, and recent queue waits of started jobs
+        self.submit_times = {}
+        self.pending_times = deque(maxlen=PENDING_SAMPLES)
+
+    def record_jobs(self, export_path, job_ids):
+        """ Registers new jobs of a render """
+        self.jobs.setdefault(export_path, []).extend(job_ids)
+        now = time.time()
+        for job_id in job_ids:
+            self.job_states[job_id] = 'SUBMITTED'
+            self.submit_times[job_id] = now
+        if self.store:
+            self.store.add_jobs(export_path, job_ids)
+
+    def update_job_states(self, states):
+        """ Updates last known job states, only changes are written to the job store """
+        changed = {job_id: state for job_id, state in states.items() if self.job_states.get(job_id) != state}
+        self.job_states.update(changed)
+        now = time.time()
+        for job_id, state in changed.items():
+            if state not in ('PENDING', 'SUBMITTED') and job_id in self.submit_times:
+                submitted = self.submit_times.pop(job_id)
+                if state == 'RUNNING':
+                    self.pending_times.append(now - submitted)
+        if self.store and changed:
+            self.store.set_job_states(changed)
+
+    def pending_time(self):
+        """
+            Expected queue wait of a new job: median of recent waits, or the wait of the oldest job
+            still pending if longer
+        """
+        waits = sorted(self.pending_times)
+        observed = waits[len(waits) // 2] if waits else 0
+        now = time.time()
+        current = max((now - submitted for job_id, submitted in list(self.submit_times.items())
+                       if self.job_states.get(job_id) in ('PENDING', 'SUBMITTED')), default=0)
+        return max(observed, current)
+
+    def scale_render(self, export_path, nb_jobs):
+        """ Backends without elastic jobs only change the number of jobs running at the same time """
+        return self.resize_render(export_path, nb_jobs)
+
+    def submit_jobs(self, export_path, nb_jobs):
+        """ Backends without job submission start the stopped jobs of a render again """
+        return self.requeue_render(export_path)
+
+    def forget_render(self, export_path):
+        """ Drops the jobs of a render pruned from the job store """
+        for job_id in self.jobs.pop(export_path, []):
+            self.job_states.pop(job_id, None)
+        self.outputs.forget(export_path)
+
+    def get_blender_command(self, blend_file, export_path, render_device, frame_start, frame_end, tiles=1, warm_worker=None, threads=None, render_cache=False):
         batch_render_script = os.path.join(os.path.dirname(__file__), "batch_render.py")
-        return f"blender -b {blend_file} -o //{export_path}/output_ --python {batch_render_script} -- --frames {frame_start}..{frame_end}  --cycles-device {render_device}"
+        # Output path is relative to the Blender file
+        output_dir = os.path.relpath(export_path, os.path.dirname(blend_file))
+        thread_option = f" -t {threads}" if threads else ""
+        command = f"blender -b {blend_file}{thread_option} -o //{output_dir}/output_ --python {batch_render_script} -- --frames {frame_start}..{frame_end}  --cycles-device {render_device}"
+
+        if self.dispatcher_address:
+            command += f" --dispatcher {self.dispatcher_address} --submission {export_path}"
+            if tiles > 1:
+                command += f" --tiles {tiles}"
+            if warm_worker:
+                # Job keeps running after its frames, rendering next submissions of the project
+                project, content_hash, idle_timeout = warm_worker
+                command += f" --project {project} --content-hash {content_hash} --idle-timeout {idle_timeout}"
+
+        if render_cache and self.render_cache:
+            command += f" --render-cache {self.render_cache}"
+
+        asset_manifest = self.get_asset_manifest(blend_file)
+        if os.path.isfile(asset_manifest):
+            command += f" --assets {os.path.abspath(asset_manifest)}"
+        return command
+
+    def get_warm_worker(self, render_config):
+        """ Project, content hash and idle timeout given to warm workers, None if jobs stop after their submission """
+        backend_config = render_config.get(self.name, {})
+        if not backend_config.get('warm-workers', False):
+            return None
+        return render_config['project'], render_config['content-hash'], backend_config.get('idle-timeout', 300)
+
+    def get_asset_manifest(self, blend_file):
+        """ Path of the file mapping datablocks of a project to assets on the server """
+        return blend_file + ".assets.json"
 
     def get_new_export_path(self, name):
         return "{}-{}".format(datetime.now().strftime("%Y%m%d-%H%M%S"), name.replace(" ", "_"))
 
+    def is_render_output(self, filename):
+        """ Rendered frames, frames being written have a hidden name """
+        return filename.endswith(self.render_extension) and filename.startswith('output_')
+
+    def is_preview(self, filename):
+        """ Downscaled JPEG saved by render jobs next to each frame """
+        return filename.startswith('preview_') and filename.endswith('.jpg')
+
     def get_rendered_filelist(self, export_path):
-        filenames = next(walk(export_path), (None, None, []))[2]
-        return [ os.path.join(export_path, filename) for filename in filenames 
-                if (filename.endswith(self.render_extension) and 
-                    filename.startswith('output_')) ]
+        return self.outputs.renders(export_path)
+
+    def get_preview_filelist(self, export_path):
+        return self.outputs.previews(export_path)
 
     def get_nb_rendered(self, export_path):
-        return len(self.get_rendered_filelist(export_path))
+        return self.outputs.count(export_path)
+
+    def query_job_states(self, job_ids):
+        return {}
+
+    def jobs_lost(self, export_path):
+        """ Whether the jobs of a render were lost with a previous server run and none replaced them """
+        states = [self.job_states.get(job_id, 'SUBMITTED') for job_id in self.jobs.get(export_path, [])]
+        return 'LOST' in states and not any(state in ACTIVE_STATES for state in states)
+
+    def get_status(self, export_path):
+        """ Summary of the last known state of the jobs of a render, jobs lost with a previous server run left out """
+        states = [self.job_states.get(job_id, 'SUBMITTED') for job_id in self.jobs.get(export_path, [])]
+        states = [state for state in states if state != 'LOST']
+
+        render_status = 'In progress'
+        if not states:
+            render_status = 'Unknown'
+        elif all([ a == 'COMPLETED' for a in states]):
+            render_status = 'Completed'
+        elif all([ a in ('PENDING', 'SUBMITTED') for a in states]):
+            render_status = 'Pending'
+        elif not any([ a in ('PENDING', 'SUBMITTED', 'RUNNING', 'CONFIGURING', 'COMPLETING') for a in states]):
+            render_status = 'Stopped'
+
+        return render_status
+
+
+class LocalJob():
+    """ Blender process of the local backend, started once a slot is free """
+    def __init__(self, job_id, export_path, command, log_file):
+        self.job_id = job_id
+        self.export_path = export_path
+        self.command = command
+        self.log_file = log_file
+        self.state = 'PENDING'
+        self.process = None
+        self.slot = None
 
 
 class BackendCLI(Backend):
-    def __init__(self):
+    """
+        Renders with a pool of local Blender processes, for workstations and cloud machines without scheduler.
+        Available cores are split in slots of threads_per_job cores, each process runs in its own slot,
+        pinned to its cores and given its own GPU if any, so that concurrent renders do not compete.
+        Jobs follow the Slurm job array model: a render queues nb_jobs processes, of which a limited
+        number run at the same time.
+    """
+    def __init__(self, store=None, threads_per_job=4, devices=None):
+        super().__init__(store)
         self.name = "CLI"
-        self.render_config = {}
+
+        cores = sorted(sched_getaffinity(0))
+        self.threads_per_job = max(min(threads_per_job, len(cores)), 1)
+        if devices is None:
+            devices = [device for device in environ.get('CUDA_VISIBLE_DEVICES', '').split(',') if device]
+        nb_slots = max(len(cores) // self.threads_per_job, 1)
+        self.slots = [{'cores': cores[i * self.threads_per_job:(i + 1) * self.threads_per_job],
+                       'device': devices[i % len(devices)] if devices else None} for i in range(nb_slots)]
+        self.free_slots = list(range(nb_slots))
+
+        # Jobs not finished, or whose final state was not reported yet, and the command of each render
+        self.local_jobs = {}
+        self.commands = {}
+        # Processes do not outlive the server run that started them, its unfinished jobs are lost
+        self.update_job_states({job_id: 'LOST' for job_ids in self.jobs.values() for job_id in job_ids
+                                if self.job_states.get(job_id, 'SUBMITTED') in ACTIVE_STATES})
+        # Maximum number of running processes of each render
+        self.throttles = {}
+        self.next_id = 0
+        # Processes are started and reaped from the server thread pool and from waiting threads
+        self.lock = threading.Lock()
 
         self.default_config = {}
         self.default_config['backend'] = self.name
         self.default_config['job-name'] = {'type': 'string', 'default': 'Blender_render', 'label': 'Job name'}
-        self.default_config['max-nb-jobs'] = {'type': 'int', 'default': '6', 'label': 'Simultaneous renders'}
-        self.default_config['render-backend'] = {'type': 'string', 'default': 'GPU', 'label': 'Render backend (CPU CUDA OPTIX HIP ONEAPI METAL)'}
+        self.default_config['max-nb-jobs'] = {'type': 'int', 'default': str(nb_slots), 'label': 'Simultaneous renders'}
+        self.default_config['frame-order'] = {'type': 'string', 'default': 'strided', 'label': 'Frame order (sequential strided bisection longest-first)'}
+        self.default_config['render-backend'] = {'type': 'string', 'default': 'CUDA' if devices else 'CPU', 'label': 'Render backend (CPU CUDA OPTIX HIP ONEAPI METAL)'}
+        self.default_config['warm-workers'] = {'type': 'bool', 'default': '0', 'label': 'Keep jobs running for next submissions'}
+        self.default_config['idle-timeout'] = {'type': 'int', 'default': '300', 'label': 'Warm job idle time (s)'}
+        self.default_config['render-cache'] = {'type': 'bool', 'default': '1', 'label': 'Reuse unchanged frames of previous renders'}
         return
 
     def setup_run(self):
         return
 
-    def start_render(self):
+    def start_render(self, blend_file, export_path, render_config, nb_jobs, max_running):
+        """ Queues nb_jobs Blender processes, at most max_running of them run at the same time """
+        backend_config = render_config.get(self.name, {})
+        render_device = backend_config.get('render-backend', 'CPU').strip().upper()
+        if render_device == 'GPU':
+            # Former default, kept in the settings of older clients
+            render_device = 'CUDA'
+        if render_device not in CYCLES_DEVICES:
+            return 1, "Unknown render backend {}, expected one of {}".format(render_device, " ".join(CYCLES_DEVICES))
+        command = self.get_blender_command(blend_file, export_path, render_device,
+                                           render_config['frame-start'], render_config['frame-end'],
+                                           render_config.get('tiles', 1), self.get_warm_worker(render_config),
+                                           self.threads_per_job, backend_config.get('render-cache', False))
+
+        with self.lock:
+            self.commands[export_path] = command
+            job_ids = []
+            for i in range(nb_jobs):
+                self.next_id += 1
+                job_id = "cli-{}-{}".format(getpid(), self.next_id)
+                self.local_jobs[job_id] = self.new_job(job_id, export_path)
+                job_ids.append(job_id)
+            self.record_jobs(export_path, job_ids)
+            self.throttles[export_path] = max_running
+            self.schedule()
+        return 0, ""
 
-        return
+    def new_job(self, job_id, export_path):
+        log_file = os.path.join(os.path.dirname(export_path), "{}.out".format(job_id))
+        return LocalJob(job_id, export_path, self.commands[export_path], log_file)
+
+    def schedule(self):
+        """ Starts pending processes on free slots, within the throttle of their render, lock must be held """
+        running = Counter(job.export_path for job in self.local_jobs.values() if job.state == 'RUNNING')
+        for job in self.local_jobs.values():
+            if not self.free_slots:
+                return
+            if job.state != 'PENDING':
+                continue
+            if running[job.export_path] < self.throttles.get(job.export_path, 1):
+                self.launch(job, self.free_slots.pop(0))
+                running[job.export_path] += 1
+
+    def launch(self, job, slot):
+        """ Starts the process of a job pinned to the cores of its slot """
+        cores = self.slots[slot]['cores']
+        env = dict(environ)
+        if self.slots[slot]['device'] is not None:
+            env['CUDA_VISIBLE_DEVICES'] = self.slots[slot]['device']
+
+        args = shlex.split(job.command)
+        # taskset pins the process before Blender starts its threads, which inherit the affinity
+        if shutil.which('taskset'):
+            args = ['taskset', '-c', ",".join(str(core) for core in cores)] + args
+        with open(job.log_file, 'w') as log:
+            job.process = subprocess.Popen(args, stdout=log, stderr=subprocess.STDOUT, env=env)
+        if not shutil.which('taskset'):
+            try:
+                sched_setaffinity(job.process.pid, cores)
+            except OSError:
+                pass
+
+        job.slot = slot
+        job.state = 'RUNNING'
+        threading.Thread(target=self.wait_job, args=(job,), daemon=True).start()
+
+    def wait_job(self, job):
+        """ Thread target freeing the slot of a job once its process exits """
+        return_code = job.process.wait()
+        with self.lock:
+            self.free_slots.append(job.slot)
+            if job.state == 'RUNNING':
+                job.state = 'COMPLETED' if return_code == 0 else 'FAILED'
+            self.schedule()
+
+    def cancel_render(self, export_path):
+        """ Terminates running processes of a render and drops its pending ones """
+        with self.lock:
+            for job_id in self.jobs.get(export_path, []):
+                job = self.local_jobs.get(job_id)
+                if job is None or job.state not in ('PENDING', 'RUNNING'):
+                    continue
+                if job.process and job.process.poll() is None:
+                    job.process.terminate()
+                job.state = 'CANCELLED'
+        return 0, ""
 
-    def get_status(self):
-        return
+    def resize_render(self, export_path, nb_jobs):
+        """ Changes the number of processes of a render allowed to run at the same time """
+        with self.lock:
+            self.throttles[export_path] = nb_jobs
+            self.schedule()
+        return 0, ""
 
-    def cancel_render(self):
-        return
+    def requeue_render(self, export_path):
+        """ Starts again the processes of a render that stopped """
+        with self.lock:
+            if export_path not in self.commands:
+                return 0, ""
+            requeued = {}
+            for job_id in self.jobs.get(export_path, []):
+                job = self.local_jobs.get(job_id)
+                if job is None and self.job_states.get(job_id) in ('COMPLETED', 'FAILED', 'CANCELLED'):
+                    # Dropped once its final state was reported
+                    self.local_jobs[job_id] = self.new_job(job_id, export_path)
+                    requeued[job_id] = 'PENDING'
+                elif job and job.state in ('COMPLETED', 'FAILED', 'CANCELLED'):
+                    job.state = 'PENDING'
+                    job.process = None
+                    requeued[job_id] = 'PENDING'
+            # Queried again by the status collector
+            self.update_job_states(requeued)
+            self.schedule()
+        return 0, ""
+
+    def query_job_states(self, job_ids):
+        """ Jobs are dropped once their final state is reported, they are not queried anymore """
+        with self.lock:
+            states = {job_id: self.local_jobs[job_id].state if job_id in self.local_jobs else 'LOST' for job_id in job_ids}
+            for job_id, state in states.items():
+                if state in ('COMPLETED', 'FAILED', 'CANCELLED'):
+                    del self.local_jobs[job_id]
+            return states
+
+    def forget_render(self, export_path):
+        super().forget_render(export_path)
+        self.commands.pop(export_path, None)
 
     def get_server_config(self):
         return self.default_config
 
 
 class BackendSlurm(Backend):
-    def __init__(self):
+    def __init__(self, store=None):
+        super().__init__(store)
         self.name = "Slurm"
-        self.log_filename = 'job_status_log.json'
-        self.render_config = {}
 
         self.default_config = {}
         self.default_config['backend'] = self.name
@@ -69,34 +374,76 @@ class BackendSlurm(Backend):
         self.default_config['partition'] = {'type': 'string', 'default': 'standard', 'label': 'Partition'}
         self.default_config['qos'] = {'type': 'string', 'default': 'standard', 'label': 'QOS'}
         self.default_config['max-nb-jobs'] = {'type': 'int', 'default': '4', 'label': 'Max nb Jobs'}
+        self.default_config['frame-order'] = {'type': 'string', 'default': 'strided', 'label': 'Frame order (sequential strided bisection longest-first)'}
+        self.default_config['job-array'] = {'type': 'bool', 'default': '1', 'label': 'Submit as job array'}
+        self.default_config['array-throttle'] = {'type': 'int', 'default': '0', 'label': 'Max running array tasks (0 for no limit)'}
+        self.default_config['warm-workers'] = {'type': 'bool', 'default': '0', 'label': 'Keep jobs running for next submissions'}
+        self.default_config['idle-timeout'] = {'type': 'int', 'default': '300', 'label': 'Warm job idle time (s)'}
+        self.default_config['render-cache'] = {'type': 'bool', 'default': '1', 'label': 'Reuse unchanged frames of previous renders'}
+        self.default_config['autoscale'] = {'type': 'bool', 'default': '0', 'label': 'Scale jobs to work left (Max nb Jobs as ceiling)'}
+
+        # Backend settings written to the jobfile as sbatch options
+        self.sbatch_options = ['time', 'account', 'partition', 'qos']
+        # Array task throttle last set on the jobs of each elastic render
+        self.throttles = {}
+
+        if store:
+            self.import_job_logs()
 
     def setup_run(self):
         return
 
-    def start_render(self, blend_file):
+    def start_render(self, blend_file, export_path, render_config, nb_jobs, max_running):
+        """
+            Submits nb_jobs render jobs, of which at most max_running run at the same time
+            Without job array, only max_running jobs are submitted
+        """
+        # Write slurm jobfile, in the project directory so that simultaneous submissions do not collide
+        project_dir = os.path.dirname(export_path)
+        jobfile_name = self.get_jobfile(export_path)
+
+        frame_start = render_config['frame-start']
+        frame_end = render_config['frame-end']
+        backend_config = render_config[self.name]
+        job_array = backend_config.get('job-array', False)
 
-        # Write slurm jobfile
-        jobfile_name = 'jobfile.slurm'
-        export_path = self.get_new_export_path(self.render_config['job-name'])
+        warm_worker = self.get_warm_worker(render_config)
 
-        frame_start = self.render_config['frame-start']
-        frame_end = self.render_config['frame-end']
+        throttle = backend_config.get('array-throttle', 0)
+        throttle = min(throttle, max_running) if throttle > 0 else max_running
+        if not job_array:
+            nb_jobs = throttle
 
         with open(jobfile_name, 'w') as jobfile:
             jobfile.write("#!/bin/bash\n")
 
-            for key in self.render_config[self.name]:
-                jobfile.write("#SBATCH --{}={}\n".format(key, self.render_config[self.name][key]))
+            for key in self.sbatch_options:
+                if key in backend_config:
+                    jobfile.write("#SBATCH --{}={}\n".format(key, backend_config[key]))
+
+            if job_array:
+                jobfile.write("#SBATCH --array=0-{}{}\n".format(nb_jobs - 1, "%{}".format(throttle) if throttle < nb_jobs else ""))
+                jobfile.write("#SBATCH --output={}\n".format(os.path.join(project_dir, "slurm-%A_%a.out")))
+            else:
+                jobfile.write("#SBATCH --output={}\n".format(os.path.join(project_dir, "slurm-%j.out")))
             
             jobfile.write("#SBATCH --nodes=1\n")
+            # Blender replaces the batch shell so that it gets the walltime warning itself
+            jobfile.write("#SBATCH --signal=B:USR1@{}\n".format(WALLTIME_WARNING))
             jobfile.write("module load blender\n")
-            jobfile.write("{}\n".format(super().get_blender_command(blend_file, export_path, "CPU", frame_start, frame_end)))
+            jobfile.write("exec {}\n".format(super().get_blender_command(blend_file, export_path, "CPU", frame_start, frame_end, render_config.get('tiles', 1), warm_worker, render_cache=backend_config.get('render-cache', False))))
+
+        return self.submit_jobfile(export_path, jobfile_name, nb_jobs, job_array)
 
-        # Submit jobfile
+    def get_jobfile(self, export_path):
+        return os.path.join(os.path.dirname(export_path), 'jobfile-{}.slurm'.format(os.path.basename(export_path)))
+
+    def submit_jobfile(self, export_path, jobfile_name, nb_jobs, job_array, options=()):
+        """ Submits nb_jobs jobs of a jobfile, a job array costs a single scheduler round-trip """
         job_id_list = []
-        for i in range(min(self.render_config['max-nb-jobs'], frame_end - frame_start+1)):
+        for i in range(1 if job_array else nb_jobs):
 
-            result = subprocess.run(['sbatch', jobfile_name],
+            result = subprocess.run(['sbatch', *options, jobfile_name],
                                     capture_output = True,
                                     text = True)
             if result.returncode != 0 or result.stderr or not result.stdout.startswith("Submitted batch job"):
@@ -105,58 +452,150 @@ class BackendSlurm(Backend):
             else:
                 job_id_list.append(int(result.stdout.split(" ")[-1]))
 
-        self.export_job_log(export_path, job_ids=job_id_list)
+        if job_array:
+            job_id_list = ["{}_{}".format(job_id_list[0], task) for task in range(nb_jobs)]
 
-        return 0, ""
-    
-    def export_job_log(self, export_path, job_ids):
-        filename = self.log_filename
-        if os.path.isfile(filename):
-            with open(filename, 'r') as f:
-                data = json.load(f)
-        else:
-            data = {}
-        
-        data[export_path] = {}
-        if job_ids:
-            for jobid in job_ids:
-                data[export_path][str(jobid)] = {'status': 'SUBMITTED'}
+        self.record_jobs(export_path, [str(job_id) for job_id in job_id_list])
 
-        with open(filename, 'w') as f:
-            json.dump(data, f)
+        return 0, ""
 
+    def scale_render(self, export_path, nb_jobs):
+        """
+            Submits extra jobs, or cancels pending ones, so that nb_jobs jobs of a render are queued or running
+            Running jobs are never cancelled, the dispatcher stops them once the frames left are all leased
+        """
+        # Only arrays still queued or running have a throttle to update, failing to update it does not
+        # keep jobs from being submitted or cancelled, it is tried again at the next scaling
+        throttle_error = ""
+        if self.throttles.get(export_path) != nb_jobs:
+            return_code, throttle_error = self.resize_render(export_path, nb_jobs)
+            if return_code == 0:
+                self.throttles[export_path] = nb_jobs
+
+        job_ids = self.jobs.get(export_path, [])
+        pending = [job_id for job_id in job_ids if self.job_states.get(job_id, 'SUBMITTED') in ('PENDING', 'SUBMITTED')]
+        running = [job_id for job_id in job_ids if self.job_states.get(job_id) in ('RUNNING', 'CONFIGURING')]
+        active = len(pending) + len(running)
+
+        if nb_jobs > active:
+            return_code, error = self.submit_jobs(export_path, nb_jobs - active)
+            if return_code != 0:
+                return return_code, error
+        else:
+            # Last submitted jobs are the last to start
+            surplus = pending[::-1][:active - nb_jobs]
+            if surplus:
+                return_code, error = self.run_scheduler_command(['scancel'] + surplus)
+                if return_code != 0:
+                    return return_code, error
+                self.update_job_states({job_id: 'CANCELLED' for job_id in surplus})
+        if throttle_error:
+            return 1, throttle_error
+        return 0, ""
 
-    def get_status(self, export_path):
-        filename = self.log_filename
-        if os.path.isfile(filename):
-            with open(filename, 'r') as f:
-                data = json.load(f)
-        
+    def submit_jobs(self, export_path, nb_jobs):
+        """ Submits nb_jobs more jobs of a render, they run its jobfile, the array size given on the command line wins """
+        jobfile_name = self.get_jobfile(export_path)
+        with open(jobfile_name, 'r') as jobfile:
+            job_array = "#SBATCH --array" in jobfile.read()
+        options = ['--array=0-{}'.format(nb_jobs - 1)] if job_array else []
+        return self.submit_jobfile(export_path, jobfile_name, nb_jobs, job_array, options)
+
+    def get_job_ids(self, export_path):
+        """ 
+            Returns ids of the jobs of a render 
+            Array tasks are reduced to the id of their array so that the whole array is handled in one call
+        """
+        job_ids = []
+        for job_id in self.jobs.get(export_path, []):
+            job_id = job_id.split("_")[0]
+            if job_id not in job_ids:
+                job_ids.append(job_id)
+        return job_ids
+
+    def run_scheduler_command(self, command):
+        """ Runs a Slurm command, returns its return code and error output """
+        result = subprocess.run(command,
+                                capture_output = True,
+                                text = True)
+        return result.returncode, result.stderr
+
+    def cancel_render(self, export_path):
+        """ Cancels all the jobs of a render """
+        job_ids = self.get_job_ids(export_path)
+        if not job_ids:
+            return 0, ""
+        return self.run_scheduler_command(['scancel'] + job_ids)
+
+    def resize_render(self, export_path, nb_jobs):
+        """ 
+            Changes the number of array tasks of a render allowed to run at the same time 
+            The number of tasks of an array cannot change once submitted, the throttle is changed instead
+        """
+        errors = []
+        for job_id in self.get_active_arrays(export_path):
+            return_code, error = self.run_scheduler_command(['scontrol', 'update', 'JobId={}'.format(job_id),
+                                                            'ArrayTaskThrottle={}'.format(nb_jobs)])
+            if return_code != 0:
+                # An array that finished since its state was last queried cannot be updated anymore
+                errors.append("{}: {}".format(job_id, error.strip()))
+        if errors:
+            return 1, "\n".join(errors)
+        return 0, ""
 
-        result = subprocess.run(['squeue', '-u', '$USER', '-o', '"%A %T"', '-h'],
+    def get_active_arrays(self, export_path):
+        """ Ids of the job arrays of a render with tasks still queued or running, plain jobs have no throttle """
+        array_ids = []
+        for job_id in self.jobs.get(export_path, []):
+            if "_" not in job_id:
+                continue
+            array_id = job_id.split("_")[0]
+            if array_id not in array_ids and self.job_states.get(job_id, 'SUBMITTED') in ACTIVE_STATES:
+                array_ids.append(array_id)
+        return array_ids
+
+    def requeue_render(self, export_path):
+        """ Requeues all the jobs of a render """
+        job_ids = self.get_job_ids(export_path)
+        if not job_ids:
+            return 0, ""
+        return self.run_scheduler_command(['scontrol', 'requeue', ",".join(job_ids)])
+    
+    def import_job_logs(self):
+        """ Moves jobs of the JSON job logs written by previous versions into the job store """
+        for log_file in glob.glob('job_status_log.json') + glob.glob(os.path.join('projects', '*', '*', 'job_status_log.json')):
+            with open(log_file, 'r') as f:
+                for export_path, jobs in json.load(f).items():
+                    if export_path not in self.jobs:
+                        self.record_jobs(export_path, list(jobs))
+            os.replace(log_file, log_file + ".imported")
+
+    def query_job_states(self, job_ids):
+        """ 
+            State of the given jobs, queried with a single squeue call for all the jobs of the user
+            Jobs that already left the queue are looked up with a single sacct call
+        """
+        states = {}
+        result = subprocess.run(['squeue', '-h', '-r', '-u', getpass.getuser(), '-o', '%i %T'],
                                 capture_output = True,
                                 text = True)
-        output = [ job.split(" ") for job in result.stdout.split('\n') ]
-        status_list = []
-        for job in output:
-            jobid = job[0]
-            status = job[1]
-            if jobid in data[export_path]:
-                data[export_path][jobid]['status'] = status
-                status_list.append(status)
-        
-        render_status = 'In progress'
-        if any([ a == 'PENDING' for a in status_list]):
-            render_status = 'Pending'
-        if all([ a == 'COMPLETED' for a in status_list]):
-            render_status = 'Completed'
-        
-        progress = self.get_nb_exported(export_path)
-        
-        return render_status, progress
+        for line in result.stdout.splitlines():
+            fields = line.split()
+            if len(fields) == 2:
+                states[fields[0]] = fields[1]
+
+        missing = [job_id for job_id in job_ids if job_id not in states]
+        if missing:
+            result = subprocess.run(['sacct', '-n', '-P', '-X', '-j', ",".join(missing), '-o', 'JobID,State'],
+                                    capture_output = True,
+                                    text = True)
+            for line in result.stdout.splitlines():
+                fields = line.split("|")
+                if len(fields) >= 2 and fields[1]:
+                    # States like "CANCELLED by 1234" are reduced to their first word
+                    states[fields[0]] = fields[1].split()[0]
 
-    def cancel_render(self):
-        return
+        return {job_id: states[job_id] for job_id in job_ids if job_id in states}
 
     def get_server_config(self):
         return self.default_config
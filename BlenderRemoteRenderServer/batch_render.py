@@ -1,35 +1,404 @@
 
 import bpy
 import os
+import numpy
 import sys
+import json
+import time
+import resource
+import platform
+import shutil
+import signal
 import argparse
+import threading
+import subprocess
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from messages import msg
+from file_cache import FileCache
+from render_key import frame_key
+from autoscaler import parse_time_limit, WALLTIME_WARNING
+
+# The frame dispatcher needs ZeroMQ in Blender's Python, frames are claimed on disk otherwise
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+HEARTBEAT_INTERVAL = 10
+# Time waited before asking again when all remaining frames are leased by other jobs
+WAIT_INTERVAL = 20
+DISPATCHER_TIMEOUT = 30
+# Size of the longest side of frame previews, and their JPEG quality
+PREVIEW_SIZE = 480
+PREVIEW_QUALITY = 75
+
+
+# Frames of previous submissions indexed by the digest of their render inputs, None if disabled
+render_cache = None
 
 
 def render_frame(frame):
     """
-    Render a single frame
+    Render a single frame, returns the paths of the files written and whether the frame was taken
+    from the render cache
+    The image is saved under a hidden name and renamed once written, so that the server never
+    sends a partially written frame
     """
     Scene = bpy.context.scene
+    filepath = Scene.render.frame_path(frame=frame)
+    key = frame_key(frame) if render_cache else None
+    if key and render_cache.fetch(key, filepath):
+        print("Frame {} unchanged, linked from the render cache".format(frame))
+        return [filepath] + save_preview(filepath), True
+
     Scene.frame_current = frame
     bpy.ops.render.render()
-    bpy.data.images['Render Result'].save_render(filepath=Scene.render.frame_path(frame=frame))
+    filepath_tmp = os.path.join(os.path.dirname(filepath), "." + os.path.basename(filepath))
+    bpy.data.images['Render Result'].save_render(filepath=filepath_tmp)
+    os.replace(filepath_tmp, filepath)
+    if key:
+        # The server evicts old frames, several jobs write to the cache at the same time
+        render_cache.store(filepath, key, evict=False)
+    return [filepath] + save_preview(filepath), False
+
+
+def save_preview(filepath):
+    """
+    Save a downscaled JPEG of a rendered frame, sent to the client ahead of the full resolution frame
+    output_0001.png is previewed as preview_0001.jpg, returns the preview path if it was saved
+    """
+    directory, filename = os.path.split(filepath)
+    preview_name = "preview_" + os.path.splitext(filename)[0].removeprefix("output_") + ".jpg"
+    preview_tmp = os.path.join(directory, "." + preview_name)
+
+    image = bpy.data.images.load(filepath)
+    try:
+        width, height = image.size
+        scale = PREVIEW_SIZE / max(width, height, 1)
+        if scale < 1:
+            image.scale(max(int(width * scale), 1), max(int(height * scale), 1))
+        image.file_format = 'JPEG'
+        image.save(filepath=preview_tmp, quality=PREVIEW_QUALITY)
+        os.replace(preview_tmp, os.path.join(directory, preview_name))
+        return [os.path.join(directory, preview_name)]
+    except RuntimeError as e:
+        print("Could not save preview of {}: {}".format(filepath, e))
+        return []
+    finally:
+        bpy.data.images.remove(image)
+
+
+def tile_border(tile, tiles):
+    """
+    Border of a tile of a tiles x tiles grid, as fractions of the image size
+    Tiles are numbered row by row from the bottom left corner
+    """
+    x, y = tile % tiles, tile // tiles
+    return x / tiles, (x + 1) / tiles, y / tiles, (y + 1) / tiles
+
+
+def tile_path(frame, tile):
+    """ Tiles are kept in a hidden directory of the export folder until they are stitched """
+    filepath = bpy.context.scene.render.frame_path(frame=frame)
+    directory, filename = os.path.split(filepath)
+    return os.path.join(directory, ".tiles", "tile_{}_{}".format(tile, filename))
+
+
+def render_tile(frame, tile, tiles):
+    """
+    Render a region of a frame, cropped to its border
+    """
+    Scene = bpy.context.scene
+    render = Scene.render
+    # Border settings of the scene are restored for the next renders of warm workers
+    settings = ('use_border', 'use_crop_to_border', 'border_min_x', 'border_max_x', 'border_min_y', 'border_max_y')
+    saved = {setting: getattr(render, setting) for setting in settings}
+    render.use_border = True
+    render.use_crop_to_border = True
+    render.border_min_x, render.border_max_x, render.border_min_y, render.border_max_y = tile_border(tile, tiles)
+
+    Scene.frame_current = frame
+    try:
+        bpy.ops.render.render()
+    finally:
+        for setting, value in saved.items():
+            setattr(render, setting, value)
+    filepath = tile_path(frame, tile)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    filepath_tmp = filepath + ".tmp"
+    bpy.data.images['Render Result'].save_render(filepath=filepath_tmp)
+    os.replace(filepath_tmp, filepath)
+
+
+def stitch_tiles(frame, tiles):
+    """
+    Assemble the tiles of a frame into the full image
+    Tiles are placed at their border in the pixel buffer of a new image, saved in the tile
+    colour space so that the scene view transform is not applied twice
+    """
+    Scene = bpy.context.scene
+    render = Scene.render
+    width = int(render.resolution_x * render.resolution_percentage / 100)
+    height = int(render.resolution_y * render.resolution_percentage / 100)
+    pixels = numpy.zeros((height, width, 4), dtype=numpy.float32)
+
+    is_float, colorspace = False, None
+    for tile in range(tiles * tiles):
+        image = bpy.data.images.load(tile_path(frame, tile))
+        tile_width, tile_height = image.size
+        tile_pixels = numpy.empty(tile_width * tile_height * 4, dtype=numpy.float32)
+        image.pixels.foreach_get(tile_pixels)
+        is_float, colorspace = image.is_float, image.colorspace_settings.name
+        bpy.data.images.remove(image)
+
+        min_x, _, min_y, _ = tile_border(tile, tiles)
+        x, y = int(min_x * width), int(min_y * height)
+        tile_pixels = tile_pixels.reshape(tile_height, tile_width, 4)[:height - y, :width - x]
+        pixels[y:y + tile_pixels.shape[0], x:x + tile_pixels.shape[1]] = tile_pixels
+
+    image = bpy.data.images.new("stitched", width, height, alpha=True, float_buffer=is_float)
+    if colorspace:
+        image.colorspace_settings.name = colorspace
+    image.pixels.foreach_set(pixels.ravel())
+
+    filepath = render.frame_path(frame=frame)
+    filepath_tmp = os.path.join(os.path.dirname(filepath), "." + os.path.basename(filepath))
+    image.file_format = render.image_settings.file_format
+    image.save(filepath=filepath_tmp)
+    bpy.data.images.remove(image)
+    os.replace(filepath_tmp, filepath)
+    shutil.rmtree(os.path.dirname(tile_path(frame, 0)), ignore_errors=True)
+    return [filepath] + save_preview(filepath)
+
+
+def render_stats(duration):
+    """
+    Statistics of a rendered frame, sent to the server with the frame
+    Memory is the peak resident memory of the Blender process so far, in bytes
+    """
+    Scene = bpy.context.scene
+    stats = {'duration': duration,
+             'memory': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+             'node': platform.node(),
+             'engine': Scene.render.engine}
+    if Scene.render.engine == 'CYCLES':
+        stats['device'] = Scene.cycles.device
+        stats['samples'] = Scene.cycles.samples
+        if 'cycles' in bpy.context.preferences.addons:
+            stats['compute'] = bpy.context.preferences.addons['cycles'].preferences.compute_device_type
+    elif hasattr(Scene, 'eevee'):
+        stats['samples'] = Scene.eevee.taa_render_samples
+    return stats
+
+
+def remap_assets(manifest_path):
+    """
+    Point datablocks to the assets shipped to the server
+    The manifest lists the type and name of each datablock with its path on the server
+    """
+    with open(manifest_path, 'r') as f:
+        assets = json.load(f)
+
+    for asset in assets:
+        datablock = getattr(bpy.data, asset['type']).get(asset['name'])
+        if datablock is None or datablock.library:
+            continue
+        datablock.filepath = asset['path']
+        if hasattr(datablock, 'reload'):
+            datablock.reload()
 
 
 def parse_arguments():
     """
-    Parse command line arguments meant for sequence data and overwrite some of the 
+    Parse command line arguments given after "--" and overwrite some of the scene settings
     """
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames")
+    parser.add_argument("--assets")
+    parser.add_argument("--dispatcher")
+    parser.add_argument("--submission")
+    parser.add_argument("--tiles", type=int, default=1)
+    parser.add_argument("--project")
+    parser.add_argument("--content-hash")
+    parser.add_argument("--idle-timeout", type=int, default=300)
+    parser.add_argument("--render-cache")
+    args, _ = parser.parse_known_args(argv)
+
+    if args.assets:
+        remap_assets(args.assets)
 
-    if not "--frames" in sys.argv:
+    if not args.frames:
         Scene = bpy.context.scene
-        return Scene.frame_start, Scene.frame_end
+        args.frame_start, args.frame_end = Scene.frame_start, Scene.frame_end
+    else:
+        args.frame_start = int(args.frames.split("..")[0])
+        args.frame_end = int(args.frames.split("..")[1])
+    # Tiles are rendered at the still frame
+    bpy.context.scene.frame_current = args.frame_start
+
+    return args
+
+
+class DispatcherClient():
+    """
+    Connection to the frame dispatcher of the server
+    Heartbeats keeping a lease alive are sent from a separate thread, with its own socket,
+    while the frame renders
+    """
+    def __init__(self, address, submission, project=None):
+        self.address = address
+        self.submission = submission
+        self.project = project
+        if "SLURM_ARRAY_JOB_ID" in os.environ:
+            job_id = "{}_{}".format(os.environ["SLURM_ARRAY_JOB_ID"], os.environ["SLURM_ARRAY_TASK_ID"])
+        else:
+            job_id = os.environ.get("SLURM_JOB_ID", platform.node())
+        self.worker = "{}:{}".format(job_id, os.getpid())
+        self.context = zmq.Context()
+        self.socket = self.connect()
+
+    def connect(self):
+        socket = self.context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 1000)
+        socket.connect(self.address)
+        return socket
+
+    def send_strings(self, socket, string_list):
+        socket.send_multipart([string.encode("utf-8") for string in string_list])
+
+    def request_frame(self):
+        """ Returns (lease_id, frame), or None when there is nothing left to render """
+        while True:
+            self.send_strings(self.socket, [msg.LEASE_REQUEST, self.submission, self.worker])
+            if not self.socket.poll(DISPATCHER_TIMEOUT * 1000):
+                raise TimeoutError("No answer from dispatcher {}".format(self.address))
+
+            message = self.socket.recv_multipart()
+            match message[0].decode("utf-8"):
+                case msg.LEASE:
+                    return message[1].decode("utf-8"), int(message[2])
+                case msg.LEASE_WAIT:
+                    time.sleep(WAIT_INTERVAL)
+                case _:
+                    return None
+
+    def request_work(self, idle_timeout):
+        """
+        Returns (lease_id, frame, submission, info) of any submission of the project
+        None is returned once no work was available for idle_timeout seconds
+        """
+        idle_since = time.monotonic()
+        while time.monotonic() - idle_since < idle_timeout:
+            self.send_strings(self.socket, [msg.WORK_REQUEST, self.project, self.worker])
+            if not self.socket.poll(DISPATCHER_TIMEOUT * 1000):
+                raise TimeoutError("No answer from dispatcher {}".format(self.address))
+
+            message = self.socket.recv_multipart()
+            if message[0].decode("utf-8") == msg.LEASE:
+                return message[1].decode("utf-8"), int(message[2]), message[3].decode("utf-8"), json.loads(message[4])
+            time.sleep(WAIT_INTERVAL)
+        return None
 
-    args = sys.argv[sys.argv.index("--frames") + 1:]
+    def frame_done(self, lease_id, frame, submission=None, stats=None):
+        self.send_strings(self.socket, [msg.FRAME_DONE, lease_id, submission or self.submission, str(frame), json.dumps(stats or {})])
 
-    frame_start = int(args[0].split("..")[0])
-    frame_end = int(args[0].split("..")[1])
+    def release(self, lease_id):
+        """ Gives a lease back before the job ends, called from the walltime thread with its own socket """
+        socket = self.connect()
+        self.send_strings(socket, [msg.LEASE_RELEASE, lease_id])
+        socket.close()
+
+    def send_heartbeats(self, lease_id, stop):
+        """ Thread target sending heartbeats until stop is set """
+        socket = self.connect()
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            self.send_strings(socket, [msg.LEASE_HEARTBEAT, lease_id])
+        socket.close()
+
+    def close(self):
+        self.socket.close()
+        self.context.term()
+
+
+class Walltime():
+    """
+    Time left before the scheduler ends the job, frames are only started if they can finish in time
+    The end of the job is read from squeue when it starts. Slurm also sends SIGUSR1 WALLTIME_WARNING
+    seconds before the end, it is waited for in a separate thread as the main thread only runs Python
+    signal handlers between two frames. At the warning, the frame being rendered is released if it
+    cannot finish, so that another job renders it right away.
+    """
+    def __init__(self):
+        self.deadline = None
+        job_id = os.environ.get("SLURM_JOB_ID")
+        if job_id:
+            try:
+                result = subprocess.run(['squeue', '-h', '-j', job_id, '-o', '%L'], capture_output=True, text=True)
+                left = parse_time_limit(result.stdout.strip())
+            except (OSError, ValueError):
+                left = None
+            if left:
+                self.deadline = time.monotonic() + left
+        # Render time of the frames of this job, and release function and start time of the current claim
+        self.durations = []
+        self.claim = None
+        self.warned = threading.Event()
+        self.lock = threading.Lock()
 
-    return frame_start, frame_end
+    def start(self):
+        # The Python handler catches the signal when a Blender thread gets it instead of the waiting thread
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.warn())
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGUSR1})
+        threading.Thread(target=self.wait_warning, daemon=True).start()
+
+    def wait_warning(self):
+        """ Thread target waiting for the warning signal, or for the same time before the end read from squeue """
+        if self.deadline is None:
+            signal.sigwait({signal.SIGUSR1})
+        else:
+            signal.sigtimedwait({signal.SIGUSR1}, max(self.deadline - WALLTIME_WARNING - time.monotonic(), 0))
+        self.warn()
+
+    def warn(self):
+        with self.lock:
+            if self.warned.is_set():
+                return
+            self.warned.set()
+            self.deadline = min(self.deadline or float('inf'), time.monotonic() + WALLTIME_WARNING)
+            if self.claim:
+                release, start = self.claim
+                if not self.durations or start + max(self.durations) > self.deadline:
+                    print("Job about to end, releasing the frame being rendered")
+                    try:
+                        release()
+                    except OSError as e:
+                        print("Could not release the frame: {}".format(e))
+                    self.claim = None
+
+    def fits(self):
+        """ Whether a new frame is expected to finish before the end of the job, the longest frame so far is the estimate """
+        if self.warned.is_set():
+            return False
+        if self.deadline is None or not self.durations:
+            return True
+        return time.monotonic() + max(self.durations) < self.deadline
+
+    def start_frame(self, release):
+        """ Registers the function giving back the frame about to be rendered """
+        with self.lock:
+            self.claim = (release, time.monotonic())
+
+    def end_frame(self):
+        with self.lock:
+            if self.claim:
+                self.durations.append(time.monotonic() - self.claim[1])
+            self.claim = None
+
+
+# Time left of the job, frames are started regardless without time limit
+walltime = Walltime()
 
 
 def render_frames(frame_start, frame_end):
@@ -44,6 +413,9 @@ def render_frames(frame_start, frame_end):
 
     # Render each frame
     for frame in range(frame_start, frame_end+1):
+        if not walltime.fits():
+            print("Not enough time left for another frame")
+            break
         export_path = Scene.render.frame_path(frame=frame)
         export_path_tmp = export_path + ".tmp"
 
@@ -55,13 +427,114 @@ def render_frames(frame_start, frame_end):
         with open(export_path_tmp, 'w') as fp:
             pass
 
+        # Removing the claim lets another job render the frame if this one ends first
+        walltime.start_frame(lambda path=export_path_tmp: os.remove(path))
         render_frame(frame)
+        walltime.end_frame()
         try:
             os.remove(export_path_tmp)
         except:
             pass
 
 
+def render_unit(unit, tiles):
+    """
+    Render a unit leased by the dispatcher: a frame, or for a still split in tiles x tiles regions,
+    a tile or the stitching of all the tiles once they are rendered
+    Returns the paths of the files written in the export folder and whether they came from the render cache
+    """
+    if tiles <= 1:
+        return render_frame(unit)
+    elif unit < tiles * tiles:
+        render_tile(bpy.context.scene.frame_current, unit, tiles)
+        return [], False
+    else:
+        return stitch_tiles(bpy.context.scene.frame_current, tiles), False
+
+
+def render_frames_dispatched(dispatcher, tiles=1):
+    """
+    Render frames leased by the server dispatcher until all frames are rendered
+    """
+    Scene = bpy.context.scene
+    export_folder = os.path.dirname(Scene.render.frame_path(frame=0))
+    os.makedirs(export_folder, exist_ok=True)
+
+    while walltime.fits() and (lease := dispatcher.request_frame()):
+        lease_id, frame = lease
+        render_leased(dispatcher, lease_id, frame, tiles)
+
+
+def render_leased(dispatcher, lease_id, unit, tiles, submission=None):
+    """
+    Render a leased unit, keeping its lease alive with heartbeats, and report it to the dispatcher
+    with the files written, so that the server does not have to list the export folder
+    """
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=dispatcher.send_heartbeats, args=(lease_id, stop), daemon=True)
+    heartbeat.start()
+    start = time.monotonic()
+    walltime.start_frame(lambda: dispatcher.release(lease_id))
+    try:
+        outputs, cached = render_unit(unit, tiles)
+    finally:
+        walltime.end_frame()
+        stop.set()
+        heartbeat.join()
+
+    stats = render_stats(time.monotonic() - start)
+    stats['outputs'] = [os.path.basename(path) for path in outputs]
+    stats['cached'] = cached
+    dispatcher.frame_done(lease_id, unit, submission, stats)
+
+
+def load_scene(blend_file):
+    """
+    Open the Blender file of a submission and point its datablocks to the assets on the server
+    """
+    bpy.ops.wm.open_mainfile(filepath=blend_file)
+    manifest_path = blend_file + ".assets.json"
+    if os.path.isfile(manifest_path):
+        remap_assets(manifest_path)
+
+
+def render_warm(dispatcher, idle_timeout, content_hash):
+    """
+    Keep rendering frames of the next submissions of the project until no work comes for idle_timeout seconds
+    The scene stays loaded between submissions, it is only reloaded when the Blender file or its
+    assets change
+    """
+    loaded = content_hash
+    while walltime.fits() and (work := dispatcher.request_work(idle_timeout)):
+        lease_id, unit, submission, info = work
+        if info['content_hash'] != loaded:
+            print("Loading {}".format(info['blend_file']))
+            load_scene(info['blend_file'])
+            loaded = info['content_hash']
+
+        Scene = bpy.context.scene
+        Scene.render.filepath = os.path.join(os.path.abspath(submission), "output_")
+        os.makedirs(os.path.abspath(submission), exist_ok=True)
+        if info['tiles'] > 1:
+            Scene.frame_current = info['frame']
+        render_leased(dispatcher, lease_id, unit, info['tiles'], submission)
+
+
 if __name__ == '__main__':
-    frame_start, frame_end = parse_arguments()
-    render_frames(frame_start, frame_end)
\ No newline at end of file
+    args = parse_arguments()
+    if args.render_cache:
+        render_cache = FileCache(args.render_cache, 0)
+    walltime.start()
+
+    if args.dispatcher and args.submission and zmq:
+        dispatcher = DispatcherClient(args.dispatcher, args.submission, args.project)
+        try:
+            render_frames_dispatched(dispatcher, args.tiles)
+            if args.project:
+                render_warm(dispatcher, args.idle_timeout, args.content_hash)
+        except TimeoutError as e:
+            print("{}, claiming frames on disk instead".format(e))
+            render_frames(args.frame_start, args.frame_end)
+        dispatcher.close()
+    else:
+        render_frames(args.frame_start, args.frame_end)
\ No newline at end of file
@@ -0,0 +1,232 @@
+import time
+import uuid
+from collections import deque
+
+
+class Lease():
+    """ Frame handed out to a render job, valid as long as the job sends heartbeats """
+    def __init__(self, lease_id, submission, frame, worker, slot):
+        self.lease_id = lease_id
+        self.submission = submission
+        self.frame = frame
+        self.worker = worker
+        # Queue the frame was taken from, it goes back there if the lease expires
+        self.slot = slot
+        self.start = time.monotonic()
+        self.last_heartbeat = self.start
+
+
+class Submission():
+    """
+        Frames of a render submission, split in one queue per render job.
+        A job renders the frames of its own queue first, then steals from the queue with the most
+        work left.
+        A final unit, such as stitching the tiles of a still, is only handed out once all the
+        queued units are done.
+        Jobs of an elastic submission stop when the frames left are all leased, except one kept on
+        standby for the frames of leases that expire.
+    """
+    def __init__(self, name, project, queues, costs, final_unit=None, info=None):
+        self.name = name
+        self.project = project
+        # Details sent to warm workers with each lease: Blender file, content hash, tiles
+        self.info = info or {}
+        self.queues = [deque(queue) for queue in queues]
+        self.costs = costs
+        self.final_unit = final_unit
+        self.final_leased = False
+        # Queue owned by each job
+        self.slots = {}
+        self.done = set()
+        self.total = sum(len(queue) for queue in queues) + (final_unit is not None)
+        # Render time of each unit done, for the autoscaler
+        self.durations = []
+        self.elastic = False
+        # Last request time of jobs waiting for frames
+        self.waiting = {}
+
+    def get_slot(self, worker):
+        """ Gives the first queue without owner to a new job, None if all queues are owned """
+        if worker not in self.slots:
+            owned = set(self.slots.values())
+            self.slots[worker] = next((slot for slot in range(len(self.queues)) if slot not in owned), None)
+        return self.slots[worker]
+
+    def remaining_cost(self, slot):
+        return sum(self.costs.get(frame, 0) for frame in self.queues[slot])
+
+    def next_frame(self, worker):
+        """ Returns (frame, slot) from the job own queue, or stolen from the most loaded one """
+        slot = self.get_slot(worker)
+        while slot is not None and self.queues[slot]:
+            frame = self.queues[slot].popleft()
+            if frame not in self.done:
+                return frame, slot
+
+        while True:
+            victims = [i for i in range(len(self.queues)) if self.queues[i]]
+            if not victims:
+                return self.next_final_unit()
+            victim = max(victims, key=self.remaining_cost)
+            # Steal from the tail, the frames the owner would render last
+            frame = self.queues[victim].pop()
+            if frame not in self.done:
+                return frame, victim
+
+    def next_final_unit(self):
+        if self.final_unit is None or self.final_leased or len(self.done) < self.total - 1:
+            return None, None
+        self.final_leased = True
+        # Goes back to the first queue if its lease expires
+        return self.final_unit, 0
+
+
+class FrameDispatcher():
+    """
+        Hands out frames of each render submission to render jobs.
+        Every frame is given as a lease that the job keeps alive with heartbeats, the frame goes back
+        to the queue if the lease expires, for instance when the job is killed mid-frame.
+    """
+    def __init__(self, frame_times, lease_timeout=60):
+        self.frame_times = frame_times
+        self.lease_timeout = lease_timeout
+        self.submissions = {}
+        self.leases = {}
+        # Project and last request time of warm workers
+        self.workers = {}
+
+    def add_submission(self, name, project, queues, costs, final_unit=None, info=None):
+        self.submissions[name] = Submission(name, project, queues, costs, final_unit, info)
+
+    def request_frame(self, submission, worker):
+        """
+            Returns a new lease, or None if all the frames are rendered
+            False is returned when frames remain but are all leased, the job should ask again later
+            as they go back to the queue if their lease expires
+        """
+        if submission not in self.submissions:
+            return None
+
+        sub = self.submissions[submission]
+        frame, slot = sub.next_frame(worker)
+        if frame is not None:
+            lease = Lease(uuid.uuid4().hex, submission, frame, worker, slot)
+            self.leases[lease.lease_id] = lease
+            sub.waiting.pop(worker, None)
+            return lease
+
+        if len(sub.done) < sub.total:
+            if sub.elastic and self.on_standby(sub, worker):
+                # Another job already waits, this one gives its node back
+                return None
+            return False
+        return None
+
+    def on_standby(self, sub, worker):
+        """ Returns True if a job other than worker is waiting for frames of expiring leases """
+        deadline = time.monotonic() - self.lease_timeout
+        sub.waiting = {other: last_seen for other, last_seen in sub.waiting.items() if last_seen > deadline}
+        if any(other != worker for other in sub.waiting):
+            return True
+        sub.waiting[worker] = time.monotonic()
+        return False
+
+    def request_work(self, project, worker):
+        """
+            Returns a lease on a frame of any submission of the project, oldest submissions first
+            Used by warm workers, which keep running between submissions of the same project
+        """
+        self.workers[worker] = (project, time.monotonic())
+        for submission in [sub.name for sub in self.submissions.values() if sub.project == project]:
+            lease = self.request_frame(submission, worker)
+            if lease:
+                return lease
+        return None
+
+    def live_workers(self, project, timeout):
+        """ Number of warm workers of a project that asked for work within timeout seconds """
+        deadline = time.monotonic() - timeout
+        return len([worker for worker, (worker_project, last_seen) in self.workers.items()
+                    if worker_project == project and last_seen > deadline])
+
+    def cancel(self, submission):
+        """ Drops remaining frames of a submission, render jobs asking for frames are told to stop """
+        self.submissions.pop(submission, None)
+        for lease_id in [lease_id for lease_id, lease in self.leases.items() if lease.submission == submission]:
+            del self.leases[lease_id]
+
+    def heartbeat(self, lease_id):
+        """ Keeps lease alive, returns False if it has already expired """
+        if lease_id not in self.leases:
+            return False
+        self.leases[lease_id].last_heartbeat = time.monotonic()
+        return True
+
+    def complete(self, lease_id, submission, frame, duration=None, cached=False):
+        """
+            Marks frame as rendered, even if its lease expired in the meantime
+            The render time measured by the job is used if given, rather than the lease duration
+            Frames taken from the render cache say nothing about render times
+        """
+        lease = self.leases.pop(lease_id, None)
+        if submission not in self.submissions:
+            return lease
+
+        sub = self.submissions[submission]
+        sub.done.add(frame)
+        if lease and not cached:
+            duration = duration or time.monotonic() - lease.start
+            sub.durations.append(duration)
+            if sub.final_unit is None:
+                # Render times inform the frame order of the next submissions of the project
+                self.frame_times.record(sub.project, frame, duration)
+        return lease
+
+    def frame_time(self, submission):
+        """
+            Mean render time of the units of a submission, taken from previous submissions of the
+            project until a unit is done, None if unknown
+        """
+        sub = self.submissions.get(submission)
+        if sub is None:
+            return None
+        durations = sub.durations
+        if not durations and sub.final_unit is None:
+            durations = list(self.frame_times.times.get(sub.project, {}).values())
+        return sum(durations) / len(durations) if durations else None
+
+    def expire_leases(self):
+        """ Puts frames of leases without recent heartbeat back in front of their queue """
+        deadline = time.monotonic() - self.lease_timeout
+        expired = [lease for lease in self.leases.values() if lease.last_heartbeat < deadline]
+        for lease in expired:
+            del self.leases[lease.lease_id]
+        self.requeue(expired)
+        return expired
+
+    def release(self, lease_id):
+        """
+            Puts the frame of a lease given back by a job about to end in front of its queue
+            The queue of the job can be taken by a replacement job
+        """
+        lease = self.leases.pop(lease_id, None)
+        if lease:
+            self.requeue([lease])
+            self.submissions[lease.submission].slots.pop(lease.worker, None)
+        return lease
+
+    def requeue(self, leases):
+        """ Puts frames of leases back in front of their queues, in the order they were handed out """
+        frames = {}
+        for lease in leases:
+            sub = self.submissions.get(lease.submission)
+            if sub and lease.frame not in sub.done:
+                frames.setdefault((lease.submission, lease.slot), []).append(lease.frame)
+        for (submission, slot), slot_frames in frames.items():
+            self.submissions[submission].queues[slot].extendleft(reversed(slot_frames))
+
+    def progress(self, submission):
+        """ Returns number of frames rendered and total number of frames """
+        if submission not in self.submissions:
+            return 0, 0
+        return len(self.submissions[submission].done), self.submissions[submission].total
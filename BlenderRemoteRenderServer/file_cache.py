@@ -0,0 +1,93 @@
+import os
+import shutil
+import threading
+
+# Eviction frees space down to this fraction of the maximum size, so that it does not run at every store
+EVICT_TARGET = 0.9
+
+
+class FileCache():
+    """
+        Content addressed file store.
+        Files are stored under their content digest and linked to where they are needed, the least
+        recently used files are evicted once the store grows over max_size bytes.
+        The size of the store is counted once and kept up to date as files are added, the store is
+        only walked again when it goes over max_size.
+    """
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        # Total size of the stored files, None until the store is first walked
+        self.size = None
+        # Files are stored from the server thread pool
+        self.lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def fetch(self, digest, dest):
+        """ Links cached file to dest, returns False if the digest is not in the store """
+        blob = self.blob_path(digest)
+        if not os.path.isfile(blob):
+            return False
+
+        # Access time is tracked with mtime as atime is often disabled on shared filesystems
+        os.utime(blob)
+        link_file(blob, dest)
+        return True
+
+    def store(self, path, digest, evict=True):
+        """
+            Adds file to the store and evicts old entries if needed
+            Writers other than the server leave eviction to it
+        """
+        blob = self.blob_path(digest)
+        if not os.path.isfile(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            link_file(path, blob)
+            with self.lock:
+                if self.size is not None:
+                    self.size += os.path.getsize(blob)
+        os.utime(blob)
+        if evict and (self.size is None or self.size > self.max_size):
+            self.evict()
+
+    def evict(self):
+        """ Removes least recently used files until the store fits in max_size, and counts its size again """
+        entries = []
+        total_size = 0
+        for directory in os.scandir(self.root):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+        entries.sort()
+        target = self.max_size * EVICT_TARGET if total_size > self.max_size else total_size
+        while total_size > target and entries:
+            _, size, path = entries.pop(0)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+        with self.lock:
+            self.size = total_size
+
+
+def link_file(src, dest):
+    """ Hard links src to dest, falls back to a copy across filesystems """
+    if os.path.dirname(dest):
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = dest + ".link"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
@@ -0,0 +1,104 @@
+import os
+import json
+from bisect import bisect_left
+
+
+def order_sequential(frames, costs, nb_slots):
+    """ Contiguous block of frames for each job """
+    size = -(-len(frames) // nb_slots)
+    return [frames[i * size:(i + 1) * size] for i in range(nb_slots)]
+
+
+def order_strided(frames, costs, nb_slots):
+    """ Job i renders frames i, i+n, i+2n... so heavy sequences are spread across all jobs """
+    return [frames[i::nb_slots] for i in range(nb_slots)]
+
+
+def bisection(frames):
+    """ First and last frames, then middle points of the remaining intervals, breadth first """
+    if len(frames) <= 2:
+        return list(frames)
+    order = [frames[0], frames[-1]]
+    intervals = [(0, len(frames) - 1)]
+    while intervals:
+        next_intervals = []
+        for start, end in intervals:
+            if end - start < 2:
+                continue
+            middle = (start + end) // 2
+            order.append(frames[middle])
+            next_intervals += [(start, middle), (middle, end)]
+        intervals = next_intervals
+    return order
+
+
+def order_bisection(frames, costs, nb_slots):
+    """ Frames evenly covering the whole shot are rendered first, useful for early previews """
+    return order_strided(bisection(frames), costs, nb_slots)
+
+
+def order_longest_first(frames, costs, nb_slots):
+    """ Longest processing time first, each frame goes to the job with the least work so far """
+    queues = [[] for _ in range(nb_slots)]
+    loads = [0.0] * nb_slots
+    for frame in sorted(frames, key=lambda frame: costs.get(frame, 1.0), reverse=True):
+        slot = loads.index(min(loads))
+        queues[slot].append(frame)
+        loads[slot] += costs.get(frame, 1.0)
+    return queues
+
+
+STRATEGIES = {
+    'sequential': order_sequential,
+    'strided': order_strided,
+    'bisection': order_bisection,
+    'longest-first': order_longest_first,
+}
+
+
+def order_frames(strategy, frames, costs, nb_slots):
+    """ Splits frames in one queue per render job, in the order they should be rendered """
+    nb_slots = max(min(nb_slots, len(frames)), 1)
+    return STRATEGIES.get(strategy, order_strided)(list(frames), costs, nb_slots)
+
+
+class FrameTimes():
+    """
+        Render time of each frame of previous submissions, indexed by project
+        Times are recorded in memory, the file is only written by flush
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.times = {}
+        self.dirty = False
+        if os.path.isfile(filename):
+            with open(filename, 'r') as f:
+                self.times = json.load(f)
+
+    def record(self, project, frame, duration):
+        self.times.setdefault(project, {})[str(frame)] = duration
+        self.dirty = True
+
+    def flush(self):
+        """ Writes the times recorded since the last flush, can run in another thread than record """
+        if not self.dirty:
+            return
+        self.dirty = False
+        times = {project: dict(frames) for project, frames in list(self.times.items())}
+        with open(self.filename + ".tmp", 'w') as f:
+            json.dump(times, f)
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def estimate(self, project, frames):
+        """ Estimated cost of each frame, taken from the closest frame rendered before """
+        known = {int(frame): duration for frame, duration in self.times.get(project, {}).items()}
+        if not known:
+            return {frame: 1.0 for frame in frames}
+
+        keys = sorted(known)
+        costs = {}
+        for frame in frames:
+            i = bisect_left(keys, frame)
+            neighbours = keys[max(i - 1, 0):i + 1]
+            costs[frame] = known[min(neighbours, key=lambda k: abs(k - frame))]
+        return costs
@@ -0,0 +1,153 @@
+import json
+import time
+import sqlite3
+import threading
+
+# Submission states after which a submission is not restored on restart
+FINISHED_STATES = ('DONE', 'CANCELLED', 'FAILED')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    export_path TEXT PRIMARY KEY,
+    user TEXT,
+    project TEXT,
+    blend_file TEXT,
+    config TEXT,
+    units TEXT,
+    final_unit INTEGER,
+    nb_jobs INTEGER,
+    total INTEGER,
+    state TEXT,
+    created REAL,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS submissions_state ON submissions (state, updated);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    export_path TEXT,
+    state TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_export_path ON jobs (export_path);
+CREATE TABLE IF NOT EXISTS frames (
+    export_path TEXT,
+    frame INTEGER,
+    state TEXT,
+    updated REAL,
+    PRIMARY KEY (export_path, frame)
+);
+CREATE TABLE IF NOT EXISTS transitions (
+    kind TEXT,
+    key TEXT,
+    state TEXT,
+    time REAL
+);
+CREATE INDEX IF NOT EXISTS transitions_time ON transitions (time);
+"""
+
+
+class JobStore():
+    """
+        Submissions, render jobs and rendered frames, with the history of their state changes.
+        Kept in SQLite in WAL mode: every update is an atomic transaction that survives a crash,
+        and readers never block the writer. The server keeps its working state in memory and
+        only reads the store back on restart.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        # The connection is shared by the event loop, the thread pool and the status collector
+        self.lock = threading.Lock()
+
+    def transaction(self, statements):
+        """ Runs (sql, parameters) statements in a single transaction """
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for sql, parameters in statements:
+                    self.db.execute(sql, parameters)
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def query(self, sql, parameters=()):
+        with self.lock:
+            return self.db.execute(sql, parameters).fetchall()
+
+    def add_submission(self, export_path, user, project, blend_file, config, units, final_unit, nb_jobs, total):
+        now = time.time()
+        self.transaction([
+            ("INSERT OR REPLACE INTO submissions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'QUEUED', ?, ?)",
+             (export_path, user, project, blend_file, json.dumps(config), json.dumps(units), final_unit, nb_jobs, total, now, now)),
+            ("INSERT INTO transitions VALUES ('submission', ?, 'QUEUED', ?)", (export_path, now))])
+
+    def set_submission_state(self, export_path, state):
+        now = time.time()
+        self.transaction([
+            ("UPDATE submissions SET state = ?, updated = ? WHERE export_path = ?", (state, now, export_path)),
+            ("INSERT INTO transitions VALUES ('submission', ?, ?, ?)", (export_path, state, now))])
+
+    def add_jobs(self, export_path, job_ids):
+        now = time.time()
+        statements = []
+        for job_id in job_ids:
+            statements.append(("INSERT OR REPLACE INTO jobs VALUES (?, ?, 'SUBMITTED', ?)", (job_id, export_path, now)))
+            statements.append(("INSERT INTO transitions VALUES ('job', ?, 'SUBMITTED', ?)", (job_id, now)))
+        self.transaction(statements)
+
+    def set_job_states(self, states):
+        """ Records job states, given as {job_id: state} """
+        now = time.time()
+        statements = []
+        for job_id, state in states.items():
+            statements.append(("UPDATE jobs SET state = ?, updated = ? WHERE job_id = ?", (state, now, job_id)))
+            statements.append(("INSERT INTO transitions VALUES ('job', ?, ?, ?)", (job_id, state, now)))
+        self.transaction(statements)
+
+    def frame_done(self, export_path, frame):
+        now = time.time()
+        self.transaction([("INSERT OR REPLACE INTO frames VALUES (?, ?, 'DONE', ?)", (export_path, frame, now))])
+
+    def load_jobs(self):
+        """ Returns job ids indexed by export path, and the last known state of each job """
+        jobs = {}
+        states = {}
+        for job_id, export_path, state in self.query("SELECT job_id, export_path, state FROM jobs ORDER BY rowid"):
+            jobs.setdefault(export_path, []).append(job_id)
+            states[job_id] = state
+        return jobs, states
+
+    def unfinished_submissions(self):
+        """ Submissions still queued or rendering, with the frames already done """
+        submissions = []
+        rows = self.query("SELECT export_path, user, project, blend_file, config, units, final_unit, nb_jobs, total, state "
+                          "FROM submissions WHERE state NOT IN ({})".format(",".join("?" * len(FINISHED_STATES))),
+                          FINISHED_STATES)
+        for export_path, user, project, blend_file, config, units, final_unit, nb_jobs, total, state in rows:
+            done = [frame for frame, in self.query("SELECT frame FROM frames WHERE export_path = ?", (export_path,))]
+            submissions.append({'export_path': export_path, 'user': user, 'project': project,
+                                'blend_file': blend_file, 'config': json.loads(config), 'units': json.loads(units),
+                                'final_unit': final_unit, 'nb_jobs': nb_jobs, 'total': total,
+                                'state': state, 'done': done})
+        return submissions
+
+    def prune(self, max_age):
+        """
+            Drops finished submissions, with their jobs and frames, and state changes older than max_age seconds
+            Returns the export paths of the dropped submissions
+        """
+        deadline = time.time() - max_age
+        rows = self.query("SELECT export_path FROM submissions WHERE state IN ({}) AND updated < ?".format(
+                          ",".join("?" * len(FINISHED_STATES))), FINISHED_STATES + (deadline,))
+        export_paths = [export_path for export_path, in rows]
+
+        statements = [("DELETE FROM transitions WHERE time < ?", (deadline,))]
+        for export_path in export_paths:
+            statements.append(("DELETE FROM jobs WHERE export_path = ?", (export_path,)))
+            statements.append(("DELETE FROM frames WHERE export_path = ?", (export_path,)))
+            statements.append(("DELETE FROM submissions WHERE export_path = ?", (export_path,)))
+        self.transaction(statements)
+        return export_paths
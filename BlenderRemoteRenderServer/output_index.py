@@ -0,0 +1,86 @@
+import os
+import time
+import threading
+
+# Directories reported by render jobs are still listed at this interval, for files written without a report
+RESCAN_INTERVAL = 60
+# A directory modified less than this number of seconds before it was listed is listed again,
+# files written in the same timestamp tick would not change its modification time
+MTIME_GRANULARITY = 2
+
+
+class IndexedDirectory():
+    def __init__(self):
+        self.renders = set()
+        self.previews = set()
+        self.mtime = None
+        self.scanned = 0
+        self.reported = False
+
+
+class OutputIndex():
+    """
+        Rendered frames and previews of each export directory, kept up to date incrementally.
+        Render jobs and the directory watcher report the files they see, so that queries are answered
+        from memory. Directories are listed again as a fallback, for frames rendered without
+        dispatcher or before a server restart, and skipped when their modification time did not change.
+    """
+    def __init__(self, is_render_output, is_preview):
+        self.is_render_output = is_render_output
+        self.is_preview = is_preview
+        self.directories = {}
+        # Queried from the status collector thread and the server thread pool
+        self.lock = threading.Lock()
+
+    def add(self, path):
+        """ Records a file written in an export directory """
+        export_path, filename = os.path.split(path)
+        with self.lock:
+            directory = self.directories.setdefault(export_path, IndexedDirectory())
+            if self.is_render_output(filename):
+                directory.renders.add(filename)
+            elif self.is_preview(filename):
+                directory.previews.add(filename)
+            directory.reported = True
+
+    def forget(self, export_path):
+        with self.lock:
+            self.directories.pop(export_path, None)
+
+    def scan(self, export_path):
+        """ Lists the directory again if it changed since the previous listing """
+        directory = self.directories.setdefault(export_path, IndexedDirectory())
+        now = time.time()
+        if directory.reported and now - directory.scanned < RESCAN_INTERVAL:
+            return directory
+        try:
+            mtime = os.stat(export_path).st_mtime
+        except FileNotFoundError:
+            return directory
+        directory.scanned = now
+        if mtime == directory.mtime:
+            return directory
+
+        renders, previews = set(), set()
+        with os.scandir(export_path) as entries:
+            for entry in entries:
+                if self.is_render_output(entry.name):
+                    renders.add(entry.name)
+                elif self.is_preview(entry.name):
+                    previews.add(entry.name)
+        directory.renders, directory.previews = renders, previews
+        directory.mtime = mtime if now - mtime > MTIME_GRANULARITY else None
+        directory.reported = False
+        return directory
+
+    def renders(self, export_path):
+        with self.lock:
+            return [os.path.join(export_path, filename) for filename in self.scan(export_path).renders]
+
+    def previews(self, export_path):
+        with self.lock:
+            return [os.path.join(export_path, filename) for filename in self.scan(export_path).previews]
+
+    def count(self, export_path):
+        with self.lock:
+            return len(self.scan(export_path).renders)
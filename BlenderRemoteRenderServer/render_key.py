@@ -0,0 +1,194 @@
+import bpy
+import os
+import numpy
+import hashlib
+from session import ASSETS_ROOT
+
+# Properties that change without changing the rendered image
+SKIPPED_PROPERTIES = {'rna_type', 'users', 'session_uid', 'is_evaluated', 'original', 'tag', 'is_dirty',
+                      'use_fake_user', 'use_extra_user', 'is_embedded_data', 'is_library_indirect',
+                      'is_missing', 'is_runtime_data', 'preview', 'name_full', 'select', 'hide_select'}
+# Render settings about where and how frames are written, set per submission, the image file format
+# is still hashed from the image settings as cached frames are stored in it
+OUTPUT_PROPERTIES = {'filepath', 'use_file_extension', 'use_overwrite', 'use_placeholder', 'use_render_cache',
+                     'use_lock_interface'}
+# Attribute value field and number of components of each mesh attribute type
+ATTRIBUTE_FIELDS = {'FLOAT': ('value', 1), 'INT': ('value', 1), 'BOOLEAN': ('value', 1), 'INT8': ('value', 1),
+                    'FLOAT2': ('vector', 2), 'INT32_2D': ('value', 2), 'FLOAT_VECTOR': ('vector', 3),
+                    'FLOAT_COLOR': ('color', 4), 'BYTE_COLOR': ('color', 4), 'QUATERNION': ('value', 4)}
+
+
+def hash_value(h, value):
+    """ Hashes a property value, arrays and matrices by their numbers """
+    if isinstance(value, (str, int, float, bool, set)) or value is None:
+        h.update(repr(sorted(value) if isinstance(value, set) else value).encode())
+    else:
+        h.update(numpy.asarray(value, dtype=numpy.float64).tobytes())
+
+
+def hash_rna(h, data, depth=1, skipped=SKIPPED_PROPERTIES):
+    """
+    Hashes the editable properties of an RNA struct, following pointers to other structs up to depth
+    Datablocks referenced are hashed by name, they are hashed on their own when used
+    """
+    if data is None:
+        h.update(b"None")
+        return
+    for prop in data.bl_rna.properties:
+        if prop.identifier in skipped or prop.type == 'COLLECTION':
+            continue
+        try:
+            value = getattr(data, prop.identifier)
+        except AttributeError:
+            continue
+        h.update(prop.identifier.encode())
+        if prop.type == 'POINTER':
+            if value is None or isinstance(value, bpy.types.ID):
+                h.update(repr(getattr(value, 'name', None)).encode())
+            elif depth > 0:
+                hash_rna(h, value, depth - 1)
+        elif not prop.is_readonly:
+            try:
+                hash_value(h, value)
+            except (TypeError, ValueError):
+                h.update(repr(value).encode())
+
+
+def hash_file(h, filepath):
+    """
+    Files are identified by path, size and modification time
+    Assets shipped by clients have their digest in their path, which identifies them on its own: the
+    file cache they are linked from updates their modification time each time they are used
+    """
+    path = bpy.path.abspath(filepath)
+    h.update(path.encode())
+    parts = os.path.normpath(path).split(os.sep)
+    if len(parts) > 2 and parts[-3] == ASSETS_ROOT:
+        return
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        h.update("{}:{}".format(stat.st_size, stat.st_mtime_ns).encode())
+
+
+def hash_node_tree(h, tree, seen):
+    if tree is None or tree.name_full in seen:
+        return
+    seen.add(tree.name_full)
+    for node in sorted(tree.nodes, key=lambda node: node.name):
+        h.update("{}:{}".format(node.bl_idname, node.name).encode())
+        hash_rna(h, node, 0)
+        for socket in node.inputs:
+            if hasattr(socket, 'default_value'):
+                hash_value(h, socket.default_value)
+        if getattr(node, 'node_tree', None):
+            hash_node_tree(h, node.node_tree, seen)
+        if getattr(node, 'image', None):
+            hash_id(h, node.image, seen)
+    for link in tree.links:
+        h.update("{}:{}>{}:{}:{}".format(link.from_node.name, link.from_socket.identifier,
+                                         link.to_node.name, link.to_socket.identifier, link.is_muted).encode())
+
+
+def hash_id(h, datablock, seen):
+    """ Hashes a datablock once per key: its properties, node tree and the file it is read from """
+    if datablock is None or datablock.name_full in seen:
+        return
+    seen.add(datablock.name_full)
+    hash_rna(h, datablock)
+    if getattr(datablock, 'filepath', None):
+        hash_file(h, datablock.filepath)
+    if getattr(datablock, 'node_tree', None):
+        hash_node_tree(h, datablock.node_tree, seen)
+
+
+def hash_mesh(h, mesh):
+    """ Hashes evaluated geometry: positions, topology and every attribute, such as UVs and colors """
+    for collection, field, size in ((mesh.vertices, 'co', 3), (mesh.loops, 'vertex_index', 1),
+                                    (mesh.polygons, 'loop_start', 1), (mesh.polygons, 'material_index', 1)):
+        values = numpy.empty(len(collection) * size, dtype=numpy.float64)
+        collection.foreach_get(field, values)
+        h.update(values.tobytes())
+    for attribute in sorted(mesh.attributes, key=lambda attribute: attribute.name):
+        field, size = ATTRIBUTE_FIELDS.get(attribute.data_type, (None, 0))
+        h.update("{}:{}:{}".format(attribute.name, attribute.domain, attribute.data_type).encode())
+        if field is None:
+            continue
+        values = numpy.empty(len(attribute.data) * size, dtype=numpy.float64)
+        try:
+            attribute.data.foreach_get(field, values)
+        except (TypeError, RuntimeError):
+            continue
+        h.update(values.tobytes())
+
+
+def hash_instance(instance, seen, meshes):
+    """
+    Digest of an evaluated object instance: transform, geometry, materials and object data
+    Geometry digests are kept in meshes by evaluated mesh, instances of the same mesh hash it once
+    """
+    h = hashlib.sha256()
+    obj = instance.object
+    h.update("{}:{}:{}".format(obj.name, obj.type, instance.is_instance).encode())
+    hash_value(h, instance.matrix_world)
+    if obj.type == 'MESH':
+        # Evaluated meshes keep the name of their original, their address tells them apart for this frame
+        pointer = obj.data.as_pointer()
+        if pointer not in meshes:
+            mesh_hash = hashlib.sha256()
+            hash_mesh(mesh_hash, obj.data)
+            meshes[pointer] = mesh_hash.digest()
+        h.update(meshes[pointer])
+    elif obj.type in ('CURVE', 'SURFACE', 'FONT', 'META'):
+        mesh = obj.to_mesh()
+        if mesh:
+            hash_mesh(h, mesh)
+        obj.to_mesh_clear()
+    elif obj.data is not None:
+        hash_id(h, obj.data, seen)
+    for slot in obj.material_slots:
+        hash_id(h, slot.material, seen)
+    return h.digest()
+
+
+def frame_key(frame):
+    """
+    Digest of the render inputs of a frame, frames with the same key render the same image
+    The scene is evaluated at the frame: geometry, transforms and materials of every object, camera,
+    world, compositor and render settings are hashed, with the files of referenced images and caches.
+    Returns None for frames whose inputs cannot be captured, such as sequencer edits.
+    """
+    Scene = bpy.context.scene
+    if Scene.render.use_sequencer and Scene.sequence_editor and len(Scene.sequence_editor.sequences_all):
+        return None
+    Scene.frame_set(frame)
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+
+    h = hashlib.sha256()
+    seen = set()
+    h.update("{}:{}".format(bpy.app.version_string, frame).encode())
+    hash_rna(h, Scene.render, skipped=SKIPPED_PROPERTIES | OUTPUT_PROPERTIES)
+    for settings in (Scene.render.image_settings, Scene.view_settings, Scene.display_settings,
+                     getattr(Scene, 'cycles', None), getattr(Scene, 'eevee', None), bpy.context.view_layer):
+        if settings is not None:
+            hash_rna(h, settings)
+    hash_id(h, Scene.world, seen)
+    if Scene.use_nodes:
+        hash_node_tree(h, Scene.node_tree, seen)
+    if Scene.camera:
+        h.update(Scene.camera.name.encode())
+        hash_value(h, Scene.camera.matrix_world)
+
+    # Render visibility and modifier settings of the objects, geometry is evaluated for the viewport
+    for obj in sorted(Scene.objects, key=lambda obj: obj.name):
+        hash_rna(h, obj, 0)
+        for modifier in obj.modifiers:
+            hash_rna(h, modifier)
+        for system in getattr(obj, 'particle_systems', []):
+            hash_rna(h, system.settings)
+    for cache_file in bpy.data.cache_files:
+        hash_file(h, cache_file.filepath)
+
+    meshes = {}
+    for digest in sorted(hash_instance(instance, seen, meshes) for instance in depsgraph.object_instances):
+        h.update(digest)
+    return h.hexdigest()
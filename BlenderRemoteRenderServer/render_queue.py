@@ -0,0 +1,77 @@
+
+
+def fair_share(budget, demands):
+    """
+        Max-min fair split of budget between keys wanting demands[key]
+        Every key gets the same share, what a key does not need is split between the others
+    """
+    shares = {key: 0 for key in demands}
+    remaining = {key: demand for key, demand in demands.items() if demand > 0}
+    while budget > 0 and remaining:
+        share = max(budget // len(remaining), 1)
+        for key in list(remaining):
+            given = min(share, remaining[key], budget)
+            shares[key] += given
+            remaining[key] -= given
+            budget -= given
+            if remaining[key] == 0:
+                del remaining[key]
+            if budget == 0:
+                break
+    return shares
+
+
+class QueuedRender():
+    """ Render submission waiting for, or holding, part of the server job budget """
+    def __init__(self, name, user, project, demand, start):
+        self.name = name
+        self.user = user
+        self.project = project
+        # Number of jobs wanted and number of jobs allowed to run
+        self.demand = demand
+        self.allocation = 0
+        self.started = False
+        # Coroutine function called with the allocation when the render is first given jobs
+        self.start = start
+        # Job ceiling and time limit of renders whose demand follows the work left, None otherwise
+        self.scaling = None
+
+
+class RenderQueue():
+    """
+        Shares a server wide budget of simultaneous jobs between render submissions.
+        The budget is split fairly between users, then between the projects of each user, then
+        between the submissions of each project. Submissions wait in the queue until they get jobs.
+    """
+    def __init__(self, max_jobs):
+        self.max_jobs = max_jobs
+        self.renders = {}
+
+    def add(self, render):
+        self.renders[render.name] = render
+
+    def remove(self, name):
+        self.renders.pop(name, None)
+
+    def allocate(self):
+        """ Recomputes allocations, returns renders whose allocation changed """
+        demands = {}
+        for render in self.renders.values():
+            demands.setdefault(render.user, {}).setdefault(render.project, {})[render.name] = render.demand
+
+        allocations = {}
+        user_shares = fair_share(self.max_jobs, {user: sum(sum(p.values()) for p in projects.values())
+                                                 for user, projects in demands.items()})
+        for user, projects in demands.items():
+            project_shares = fair_share(user_shares[user], {project: sum(renders.values())
+                                                            for project, renders in projects.items()})
+            for project, renders in projects.items():
+                allocations.update(fair_share(project_shares[project], renders))
+
+        changed = []
+        for name, allocation in allocations.items():
+            render = self.renders[name]
+            if render.allocation != allocation:
+                render.allocation = allocation
+                changed.append(render)
+        return changed
@@ -1,118 +1,1081 @@
+import os
 import json
+import time
+import shutil
+import hashlib
+from functools import partial
+import asyncio
 import zmq
+import zmq.asyncio
+from concurrent.futures import ThreadPoolExecutor
+from socket import getfqdn
 from messages import msg
-from backend import Backend, BackendSlurm
+from backend import Backend, BackendSlurm, BackendCLI
+from transfer import FileSender, FileReceiver, Compressor, negotiate_codec, decompress, block_size_for, file_signatures, digest_file
+from file_cache import FileCache
+from dispatcher import FrameDispatcher
+from frame_order import FrameTimes, order_frames
+from status import StatusCollector
+from session import Session, project_dir, asset_digest, ASSETS_ROOT, MAX_REPLIES
+from telemetry import Telemetry
+from autoscaler import parse_time_limit, target_jobs
+from job_store import JobStore
+from render_queue import RenderQueue, QueuedRender
+from watcher import DirectoryWatcher
+
+# Number of files sent to the client at the same time
+MAX_DOWNLOADS = 2
+# Seconds between checks for new frames in streamed export directories
+WATCH_INTERVAL = 1
+# Warm workers are counted as running if they asked for work within this number of seconds
+WARM_WORKER_TIMEOUT = 60
+# Finished submissions and state changes are kept in the job store for this number of seconds
+HISTORY_MAX_AGE = 30 * 24 * 3600
+# Seconds between two adjustments of the jobs of elastic renders
+AUTOSCALE_INTERVAL = 30
+# Seconds between two writes of the frame times recorded by the dispatcher
+FRAME_TIMES_FLUSH_INTERVAL = 60
+# Seconds between two evictions of old frames from the render cache
+RENDER_CACHE_EVICT_INTERVAL = 3600
+# Seconds between two removals of the assets evicted from the file cache, and time they stay unused before
+ASSET_PRUNE_INTERVAL = 3600
+ASSET_MAX_IDLE = 24 * 3600
+# Clients send heartbeats every few seconds, a session silent for longer is suspended until its client
+# reconnects, and dropped with its streams after SESSION_EXPIRY seconds
+SESSION_TIMEOUT = 30
+SESSION_EXPIRY = 24 * 3600
+SESSION_CHECK_INTERVAL = 10
 
 
 class Server():
     """
         Class handling the communication with the client addon. Render actions are delegated to the Backend class.
         This class only handles the communication and IO.
+        Messages are handled concurrently on an asyncio loop, disk IO and scheduler commands run in a
+        thread pool so that a slow operation never delays other messages.
+        Every client message carries a request id that is sent back with the replies to it.
+        Several clients can be connected at the same time, each one has its own session and
+        render jobs of all the sessions share a server wide budget of max_jobs jobs.
+        Submissions and frames are recorded in the job store of the backend, renders in progress
+        are restored from it when the server restarts.
     """
-    def __init__(self, listen_port, backend):
+    def __init__(self, listen_port, backend, file_cache, dispatcher_port, status_interval, max_jobs, nb_io_threads=8, render_cache=None):
         self.backend = backend
+        self.store = backend.store
         self.listen_port = listen_port
+        self.file_cache = file_cache
+        # Rendered frames indexed by the digest of their render inputs, written by the render jobs
+        self.render_cache = render_cache
+        if render_cache:
+            self.backend.render_cache = os.path.abspath(render_cache.root)
+        self.status_interval = status_interval
+        self.executor = ThreadPoolExecutor(nb_io_threads)
+
+        # Render jobs get their frames from the dispatcher
+        self.dispatcher = FrameDispatcher(FrameTimes("frame_times.json"))
+        # Frame and transfer events of each project
+        self.telemetry = Telemetry()
+        self.dispatcher_port = dispatcher_port
+        self.backend.dispatcher_address = "tcp://{}:{}".format(getfqdn(), dispatcher_port)
 
-        self.client_connected = False
+        # Client sessions indexed by socket identity, and by token for reconnecting clients
+        self.sessions = {}
+        self.tokens = {}
+        self.render_queue = RenderQueue(max_jobs)
+        # Messages about the same file are handled in order
+        self.file_locks = {}
+        # Uploads in progress indexed by server path, whichever session sends them. Assets are shared
+        # by all the users, a session opening a file already being uploaded waits for that upload
+        self.receivers = {}
+        # (session, request id, client path) of the sessions waiting for an upload, indexed by server path
+        self.upload_waiters = {}
+        # Frames claimed on disk by jobs that could not reach the dispatcher
+        self.rendered = {}
+        # Sessions receiving the frames of a render as they are written, indexed by export path
+        # For each session identity, whether full resolution frames are streamed or only previews
+        self.streams = {}
+        self.watcher = DirectoryWatcher(lambda filename: self.backend.is_render_output(filename) or self.backend.is_preview(filename))
+        # Digests of rendered frames, indexed by (path, size, mtime)
+        self.digests = {}
+        # Frames done when jobs of a render were last replaced, indexed by export path
+        self.replaced = {}
+        self.tasks = set()
 
     def log(self, text, type="status"):
         """ Prints log to terminal """
         print(text)
 
-    def send_string(self, text):
-        """ Wrapper function to send string to client """
+    async def run_blocking(self, function, *args):
+        """ Runs a blocking call in the thread pool """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def spawn(self, coroutine):
+        """ Runs coroutine concurrently, keeping a reference until it is done """
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def file_lock(self, path):
+        return self.file_locks.setdefault(path, asyncio.Lock())
+
+    async def send(self, session, header, *args, request_id=""):
+        """
+            Sends a multipart message to the client of a session, strings are utf-8 encoded
+            Messages pushed by the server have an empty request id
+        """
+        frames = [session.identity, header.encode("utf-8"), request_id.encode("utf-8")]
+        frames += [arg.encode("utf-8") if isinstance(arg, str) else arg for arg in args]
+        if request_id in session.replies:
+            session.replies[request_id].append(frames[1:])
+        await self.socket.send_multipart(frames)
 
-        self.socket.send(self.identity, zmq.SNDMORE)
-        self.socket.send_string(text)
+    async def open_file(self, session, request_id, path, size, digest, delta=False):
+        """
+            Starts or resumes a chunked upload and tells the client where to start from
+            Nothing is transferred if the content is already in the file cache.
+            In delta mode, block signatures of the previous version of the file are sent instead
+        """
+        server_path = session.server_path(path)
+        if asset_digest(server_path) not in (None, digest):
+            # Assets are shared by all users, their content has to match the digest they are named after
+            self.log("Upload of {} does not match its digest".format(server_path), type="error")
+            await self.send(session, msg.FILE_ERROR, path, "Digest mismatch", request_id=request_id)
+            return
+        if await self.run_blocking(self.file_cache.fetch, digest, server_path):
+            self.log("File {} found in cache".format(server_path))
+            await self.send(session, msg.FILE_ACK, path, request_id=request_id)
+            return
 
-    def send_backend_config(self, dict):
-        """ Sends dictionarry serialised using json """
-        self.socket.send(self.identity, zmq.SNDMORE)
-        self.socket.send_string(msg.BACKEND_CONFIG, zmq.SNDMORE)
-        self.socket.send_json(dict)
+        current = self.receivers.get(server_path)
+        if current and current.session is not session and current.digest == digest:
+            # Acknowledged when the other session is done, the .part file is not written twice
+            self.log("Upload of {} waits for the one in progress".format(server_path))
+            self.upload_waiters.setdefault(server_path, []).append((session, request_id, path))
+            return
 
-    def save_file(self, path, file):
-        """ Saves file to disk and sends acknowledgement to client """
-        with open(path, "wb") as f:
-            f.write(file)
-        self.log("File {} written".format(path))
-        self.send_string(msg.FILE_ACK)
+        receiver = await self.run_blocking(FileReceiver, server_path, size, digest)
+        receiver.session = session
+        if receiver.complete():
+            await self.finalize_file(session, request_id, path, receiver)
+            return
 
-    def send_file(self, path):
-        """ Send single file to client """
-        self.socket.send(self.identity, zmq.SNDMORE)
-        self.socket.send_string(msg.FILE, zmq.SNDMORE)
-        self.socket.send_string(path, zmq.SNDMORE)
-        with open(path, 'rb') as f:
-            self.socket.send(f.read())
-        self.log("File {} sent".format(path))
+        self.receivers[server_path] = receiver
+        if delta and not receiver.received and os.path.isfile(server_path) and os.path.getsize(server_path) > 0:
+            block_size = block_size_for(os.path.getsize(server_path))
+            signatures = await self.run_blocking(file_signatures, server_path, block_size)
+            await self.send(session, msg.FILE_SIGNATURES, path, str(block_size), signatures, request_id=request_id)
+            return
 
+        if receiver.received:
+            self.log("Resuming upload of {} at {} bytes".format(server_path, receiver.received))
+        await self.send(session, msg.FILE_RESUME, path, str(receiver.received), request_id=request_id)
 
-    def run(self):
+    async def apply_delta(self, session, request_id, path, copies):
+        """ Rebuilds the blocks of a file shared with its previous version, the rest is sent as chunks """
+        receiver = self.session_receiver(session, path)
+        if receiver is None:
+            self.log("Delta received for unknown upload {}".format(path), type="error")
+            return
+
+        await self.run_blocking(receiver.apply_delta, receiver.path, copies)
+        self.log("Delta upload of {}, {} bytes reused".format(receiver.path, receiver.received))
+        if receiver.complete():
+            del self.receivers[receiver.path]
+            await self.finalize_file(session, request_id, path, receiver)
+
+    async def save_chunk(self, session, request_id, path, offset, data, codec="none"):
+        """ Writes a file chunk at its offset and acknowledges it to the client """
+        receiver = self.session_receiver(session, path)
+        if receiver is None:
+            self.log("Chunk received for unknown upload {}".format(path), type="error")
+            return
+
+        acked = await self.run_blocking(lambda: receiver.write(offset, decompress(codec, data)))
+        await self.send(session, msg.FILE_CHUNK_ACK, path, str(acked), request_id=request_id)
+
+        if receiver.complete():
+            del self.receivers[receiver.path]
+            await self.finalize_file(session, request_id, path, receiver)
+
+    def session_receiver(self, session, path):
+        """ Upload in progress of a file by a session, None if unknown or sent by another session """
+        receiver = self.receivers.get(session.server_path(path))
+        if receiver is None or receiver.session is not session:
+            return None
+        return receiver
+
+    async def finalize_file(self, session, request_id, path, receiver):
         """
-            Run the server
+            Checks and moves a completed upload in place, then adds it to the file cache
+            Sessions waiting for the same file are acknowledged too, or the first one uploads it if it was corrupted
         """
-        self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.ROUTER)
-        self.socket.bind("tcp://*:{}".format(self.listen_port))
-        self.log("{} backend".format(self.backend.name))
-        self.log("listening to *:{}".format(self.listen_port))
+        if not await self.run_blocking(receiver.finalize):
+            self.log("File {} does not match its digest".format(receiver.path), type="error")
+            await self.send(session, msg.FILE_ERROR, path, "Digest mismatch", request_id=request_id)
+            await self.hand_over_upload(receiver.path, receiver.size, receiver.digest)
+            return
+
+        await self.run_blocking(self.file_cache.store, receiver.path, receiver.digest)
+        self.log("File {} written".format(receiver.path))
+        await self.record_transfer('upload', receiver)
+        await self.send(session, msg.FILE_ACK, path, request_id=request_id)
+        for waiter, waiter_request_id, waiter_path in self.upload_waiters.pop(receiver.path, []):
+            await self.send(waiter, msg.FILE_ACK, waiter_path, request_id=waiter_request_id)
+
+    async def hand_over_upload(self, server_path, size, digest, lock=False):
+        """
+            Upload of a file given up by its session, the first session waiting for it sends it instead
+            The file lock is taken unless the caller already holds it
+        """
+        waiters = self.upload_waiters.get(server_path)
+        if not waiters:
+            return
+        session, request_id, path = waiters.pop(0)
+        if not waiters:
+            del self.upload_waiters[server_path]
+        if lock:
+            async with self.file_lock(server_path):
+                await self.open_file(session, request_id, path, size, digest)
+        else:
+            await self.open_file(session, request_id, path, size, digest)
+
+    def link_assets(self, blend_file, assets):
+        """
+            Links assets already in the file cache in place and returns the digests of the missing ones
+            The asset manifest maps each datablock to its path on the server, it is used by the render
+            jobs to remap file paths
+        """
+        missing = []
+        manifest = []
+        for asset in assets:
+            path = os.path.abspath(os.path.join("assets", asset['digest'], asset['filename']))
+            if self.file_cache.fetch(asset['digest'], path):
+                pass
+            elif os.path.isfile(path) and digest_file(path) == asset['digest']:
+                self.file_cache.store(path, asset['digest'])
+            elif asset['digest'] not in missing:
+                missing.append(asset['digest'])
+            manifest.append({'type': asset['type'], 'name': asset['name'], 'path': path})
+
+        with open(self.backend.get_asset_manifest(blend_file), 'w') as f:
+            json.dump(manifest, f)
+        return missing
+
+    async def register_assets(self, session, request_id, blend_file, assets):
+        """ Tells the client which assets have to be uploaded """
+        missing = await self.run_blocking(self.link_assets, session.server_path(blend_file), assets)
+        self.log("{} assets, {} to upload".format(len(assets), len(missing)))
+        await self.send(session, msg.ASSET_MISSING, blend_file, json.dumps(missing), request_id=request_id)
+
+    async def start_render(self, session, request_id, blend_path):
+        """
+            Registers frames to render with the dispatcher and queues the render for jobs
+            Frames are split in one queue per job following the chosen frame order, using render
+            times of previous submissions of the project as cost estimates
+            A still can be split in a grid of tiles rendered by separate jobs, the units handed out
+            are then the tiles, followed by the stitching of the final image
+        """
+        config = dict(session.render_config)
+        blend_file = session.server_path(blend_path)
+        export_path = os.path.join(os.path.dirname(blend_file), self.backend.get_new_export_path(config['job-name']))
+
+        frames = list(range(config['frame-start'], config['frame-end'] + 1))
+        project = session.project(blend_path)
+        if len(frames) > 1:
+            config['tiles'] = 1
+
+        if config.get('tiles', 1) > 1:
+            units = list(range(config['tiles'] ** 2))
+            final_unit = len(units)
+        else:
+            units = frames
+            final_unit = None
+        nb_jobs = min(config['max-nb-jobs'], len(units))
+        config['project'] = project
+        config['content-hash'] = await self.run_blocking(self.content_hash, blend_file)
+
+        render = self.queue_submission(export_path, session.user, blend_file, config, units, final_unit, nb_jobs)
+        # Only recorded once its frames are queued, a submission that cannot be queued is not restored
+        # on restart. Jobs are allocated once it is recorded, so that its state changes are not lost
+        if self.store:
+            await self.run_blocking(self.store.add_submission, export_path, session.user, project, blend_file,
+                                    config, units, final_unit, nb_jobs, len(units) + (final_unit is not None))
+        self.render_queue.add(render)
+        await self.send(session, msg.RENDER_STARTED, session.client_path(export_path), request_id=request_id)
+        await self.allocate_jobs()
+
+    def queue_submission(self, export_path, user, blend_file, config, units, final_unit, nb_jobs, done=(), started=False):
+        """
+            Registers the units left to render with the dispatcher
+            Returns the render to add to the render queue for jobs
+        """
+        project = config['project']
+        remaining = [unit for unit in units if unit not in done]
+        if final_unit is not None:
+            # Tiles of a still take about the same time
+            costs = {unit: 1.0 for unit in remaining}
+        else:
+            costs = self.dispatcher.frame_times.estimate(project, remaining)
+        queues = order_frames(config.get('frame-order', 'strided'), remaining, costs, nb_jobs)
+        info = {'blend_file': os.path.abspath(blend_file),
+                'content_hash': config['content-hash'],
+                'tiles': config.get('tiles', 1),
+                'frame': config['frame-start']}
+        self.dispatcher.add_submission(export_path, project, queues, costs,
+                                       final_unit if final_unit not in done else None, info)
+        submission = self.dispatcher.submissions[export_path]
+        submission.done.update(done)
+        submission.total = len(units) + (final_unit is not None)
+
+        render = QueuedRender(export_path, user, project, nb_jobs, partial(self.start_jobs, blend_file, export_path, config, nb_jobs))
+        render.started = started
+        backend_config = config.get(self.backend.name, {})
+        if backend_config.get('autoscale'):
+            render.scaling = (nb_jobs, parse_time_limit(backend_config.get('time', '')))
+            submission.elastic = True
+        return render
 
+    async def start_jobs(self, blend_file, export_path, config, nb_jobs, allocation):
+        """ Submits the jobs of a render once it gets its share of the job budget """
+        # Warm workers still running for the project take frames of the new submission first
+        warm = 0
+        if config.get(self.backend.name, {}).get('warm-workers'):
+            warm = self.dispatcher.live_workers(config['project'], WARM_WORKER_TIMEOUT)
+        if warm >= allocation:
+            self.log("Render {} served by {} warm workers".format(export_path, warm))
+            return 0, ""
+        return await self.run_blocking(self.backend.start_render, blend_file, export_path, config,
+                                       max(nb_jobs - warm, 1), allocation - warm)
+
+    def restore(self):
+        """
+            Rebuilds dispatcher queues and render queue of the submissions left unfinished by a previous run
+            Running jobs reconnect to the dispatcher and get the frames that are not done yet
+        """
+        for sub in self.store.unfinished_submissions():
+            # A submission that cannot be restored is marked failed rather than stopping the server
+            # Renders whose jobs were lost with the previous run get new ones
+            started = sub['state'] == 'STARTED' and not self.backend.jobs_lost(sub['export_path'])
+            try:
+                render = self.queue_submission(sub['export_path'], sub['user'], sub['blend_file'], sub['config'], sub['units'],
+                                               sub['final_unit'], sub['nb_jobs'], set(sub['done']), started)
+            except Exception as e:
+                self.log("Could not restore render {}: {!r}".format(sub['export_path'], e), type="error")
+                self.dispatcher.cancel(sub['export_path'])
+                self.store.set_submission_state(sub['export_path'], 'FAILED')
+                continue
+            self.render_queue.add(render)
+            self.log("Restored render {} ({}/{} done)".format(sub['export_path'], len(sub['done']), sub['total']))
+
+    async def allocate_jobs(self):
+        """
+            Shares the job budget between queued renders
+            Renders getting jobs for the first time are submitted, the others are resized
+        """
+        for render in self.render_queue.allocate():
+            if not render.started:
+                if render.allocation == 0:
+                    continue
+                render.started = True
+                return_code, error = await render.start(render.allocation)
+                if return_code == 0:
+                    self.log("Render {} started with {} jobs".format(render.name, render.allocation))
+                    await self.set_submission_state(render.name, 'STARTED')
+                else:
+                    self.log("Error with starting render {}".format(render.name))
+                    self.log(error)
+                    self.dispatcher.cancel(render.name)
+                    await self.release_jobs(render.name, 'FAILED')
+                await self.send_progress(render.name)
+            else:
+                # A render keeps at least one job, the budget is exceeded until its frames are done
+                resize = self.backend.scale_render if render.scaling else self.backend.resize_render
+                await self.run_backend_command(resize, render.name, max(render.allocation, 1))
+
+    async def release_jobs(self, export_path, state='DONE'):
+        """ Gives the jobs of a finished render to the other ones """
+        if export_path in self.render_queue.renders:
+            self.render_queue.remove(export_path)
+            await self.set_submission_state(export_path, state)
+            await self.allocate_jobs()
+
+    async def set_submission_state(self, export_path, state):
+        if self.store:
+            await self.run_blocking(self.store.set_submission_state, export_path, state)
+
+    async def resize_render(self, export_path, nb_jobs):
+        """ Changes the number of jobs wanted by a render, it gets them within its share of the budget """
+        render = self.render_queue.renders.get(export_path)
+        if render is None:
+            await self.run_backend_command(self.backend.resize_render, export_path, nb_jobs)
+            return
+        render.demand = nb_jobs
+        if render.scaling:
+            # The autoscaler keeps the render within its new ceiling
+            render.scaling = (nb_jobs, render.scaling[1])
+        await self.allocate_jobs()
+
+    async def autoscale_loop(self):
+        """
+            Follows the work left of elastic renders: the jobs wanted are recomputed from measured frame times,
+            the job time limit and the queue wait of recent jobs, then jobs are submitted or cancelled to match
+            the allocation, also replacing jobs that reached their time limit
+        """
         while True:
-            identity = self.socket.recv()
+            await asyncio.sleep(AUTOSCALE_INTERVAL)
+            pending_time = self.backend.pending_time()
+            elastic = [render for render in self.render_queue.renders.values() if render.started and render.scaling]
+            for render in elastic:
+                frame_time = self.dispatcher.frame_time(render.name)
+                if frame_time is None:
+                    continue
+                ceiling, time_limit = render.scaling
+                done, total = self.dispatcher.progress(render.name)
+                demand = target_jobs(total - done, frame_time, pending_time, time_limit, ceiling)
+                if demand > 0 and demand != render.demand:
+                    self.log("Render {}: {} jobs wanted for {} frames left ({:.0f}s per frame, {:.0f}s queue wait)".format(
+                             render.name, demand, total - done, frame_time, pending_time))
+                    render.demand = demand
+
+            await self.allocate_jobs()
+            for render in elastic:
+                if render.name in self.render_queue.renders:
+                    await self.run_backend_command(self.backend.scale_render, render.name, max(render.allocation, 1))
+
+    async def cancel_render(self, export_path):
+        """ Cancels render jobs and drops frames left to render """
+        self.dispatcher.cancel(export_path)
+        await self.release_jobs(export_path, 'CANCELLED')
+        return_code, error = await self.run_blocking(self.backend.cancel_render, export_path)
+        if return_code == 0:
+            self.log("Render {} cancelled".format(export_path))
+        else:
+            self.log("Error with cancelling render {}".format(export_path))
+            self.log(error)
+
+    async def run_backend_command(self, command, *args):
+        """ Runs a backend scheduler command in the thread pool and logs errors """
+        return_code, error = await self.run_blocking(command, *args)
+        if return_code != 0:
+            self.log(error)
+
+    async def record_transfer(self, direction, transfer):
+        """ Adds a completed file transfer to the telemetry of its project """
+        directory = project_dir(transfer.path)
+        if directory is None or not transfer.transferred:
+            return
+        event = {'type': 'transfer',
+                 'direction': direction,
+                 'path': os.path.basename(transfer.path),
+                 'bytes': transfer.transferred,
+                 'duration': time.monotonic() - transfer.started}
+        await self.run_blocking(self.telemetry.record, directory, event)
+
+    async def get_stats(self, session, request_id, path):
+        """ Sends the telemetry summary of a project, or of a render if path is an export directory """
+        server_path = session.server_path(path)
+        directory = project_dir(server_path)
+        if directory is None:
+            directory, submission = server_path, None
+        else:
+            submission = server_path
+        summary = await self.run_blocking(self.telemetry.summary, directory, submission)
+        await self.send(session, msg.STATS, path, json.dumps(summary), request_id=request_id)
+
+    async def send_progress(self, export_path, jobs=None, frame=None):
+        """ Pushes render progress to the connected clients of the user owning the render """
+        sessions = [session for session in self.sessions.values()
+                    if session.connected and export_path.startswith(session.root + os.sep)]
+        if not sessions:
+            return
+
+        done, total = self.dispatcher.progress(export_path)
+        render = self.render_queue.renders.get(export_path)
+        status = 'Queued' if render and not render.started else self.backend.get_status(export_path)
+        if frame is not None:
+            # The telemetry history of the project is read from disk the first time
+            stats = await self.run_blocking(self.telemetry.summary, os.path.dirname(export_path), export_path)
+        for session in sessions:
+            progress = {'export_path': session.client_path(export_path),
+                        'status': status,
+                        'done': max(done, self.rendered.get(export_path, 0)),
+                        'total': total,
+                        'jobs': jobs or {}}
+            if frame is not None:
+                progress['frame'] = frame
+                progress['stats'] = stats
+            await self.send(session, msg.PROGRESS, json.dumps(progress))
 
-            if not self.client_connected:
-                self.identity = identity
-            elif self.identity != identity:
-                self.log("Rejecting connection from new client", type="error")
-                _ = self.socket.recv_multipart()
+    async def handle_status_changes(self, changes):
+        """ Forwards job state changes found by the status collector to the clients """
+        for export_path, change in changes.items():
+            self.rendered[export_path] = change['rendered']
+            await self.send_progress(export_path, jobs=change['jobs'])
+            # Jobs of a render can all stop before its frames are done, when failing or cancelled
+            if self.backend.get_status(export_path) in ('Completed', 'Stopped'):
+                if await self.replace_jobs(export_path):
+                    continue
+                await self.release_jobs(export_path)
+                self.watcher.unwatch(export_path)
+
+    async def replace_jobs(self, export_path):
+        """
+            Submits replacement jobs for the frames left by jobs that reached their time limit
+            Jobs are only replaced while they make progress, so that a frame longer than the time limit
+            does not resubmit jobs forever
+            Returns whether replacement jobs were submitted, the render is marked failed when their submission fails
+        """
+        render = self.render_queue.renders.get(export_path)
+        done, total = self.dispatcher.progress(export_path)
+        if render is None or done >= total or done <= self.replaced.get(export_path, -1):
+            return False
+        states = [self.backend.job_states.get(job_id) for job_id in self.backend.jobs.get(export_path, [])]
+        if not all(state in ('COMPLETED', 'TIMEOUT', 'PREEMPTED', 'LOST') for state in states):
+            return False
+
+        self.replaced[export_path] = done
+        self.log("Render {}: jobs ended with {} frames left, submitting replacements".format(export_path, total - done))
+        return_code, error = await self.run_blocking(self.backend.submit_jobs, export_path, max(render.allocation, 1))
+        if return_code != 0:
+            self.log("Error with submitting replacement jobs of render {}".format(export_path))
+            self.log(error)
+            self.dispatcher.cancel(export_path)
+            await self.release_jobs(export_path, 'FAILED')
+            return False
+        return True
+
+    async def send_worker(self, identity, string_list):
+        """ Sends a list of strings to a render job """
+        await self.dispatcher_socket.send_multipart([identity] + [string.encode("utf-8") for string in string_list])
+
+    async def handle_worker_message(self, identity, message):
+        """ Handles frame requests and reports from render jobs """
+        header = message[0].decode("utf-8")
+
+        match header:
+            case msg.LEASE_REQUEST:
+                submission = message[1].decode("utf-8")
+                worker = message[2].decode("utf-8")
+                lease = self.dispatcher.request_frame(submission, worker)
+                if lease:
+                    await self.send_worker(identity, [msg.LEASE, lease.lease_id, str(lease.frame)])
+                elif lease is False:
+                    await self.send_worker(identity, [msg.LEASE_WAIT])
+                else:
+                    await self.send_worker(identity, [msg.NO_WORK])
+
+            case msg.WORK_REQUEST:
+                project = message[1].decode("utf-8")
+                worker = message[2].decode("utf-8")
+                lease = self.dispatcher.request_work(project, worker)
+                if lease:
+                    info = self.dispatcher.submissions[lease.submission].info
+                    await self.send_worker(identity, [msg.LEASE, lease.lease_id, str(lease.frame), lease.submission, json.dumps(info)])
+                else:
+                    # Warm workers wait for new submissions until their idle timeout
+                    await self.send_worker(identity, [msg.LEASE_WAIT])
+
+            case msg.LEASE_HEARTBEAT:
+                self.dispatcher.heartbeat(message[1].decode("utf-8"))
+
+            case msg.LEASE_RELEASE:
+                lease = self.dispatcher.release(message[1].decode("utf-8"))
+                if lease:
+                    self.log("Frame {} released by {} before the end of its time limit".format(lease.frame, lease.worker))
+
+            case msg.FRAME_DONE:
+                submission = message[2].decode("utf-8")
+                frame = int(message[3])
+                # Render time, memory, node and device measured by the job, and the files it wrote
+                stats = json.loads(message[4]) if len(message) > 4 else {}
+                for filename in stats.pop('outputs', []):
+                    self.backend.outputs.add(os.path.join(submission, filename))
+                cached = stats.pop('cached', False)
+                self.dispatcher.complete(message[1].decode("utf-8"), submission, frame, stats.get('duration'), cached)
+                if self.store:
+                    await self.run_blocking(self.store.frame_done, submission, frame)
+                await self.run_blocking(self.telemetry.record, os.path.dirname(submission),
+                                        dict(stats, type='cached' if cached else 'frame', submission=submission, frame=frame))
+                done, total = self.dispatcher.progress(submission)
+                self.log("{}: frame {} rendered ({}/{})".format(submission, frame, done, total))
+                await self.send_progress(submission, frame=frame)
+                if done == total:
+                    await self.run_blocking(self.dispatcher.frame_times.flush)
+                    await self.release_jobs(submission)
+                    self.watcher.unwatch(submission)
+
+            case _:
+                self.log("Command not recognised from render job: {}".format(header))
+
+    def get_digest(self, path):
+        """ Content digest of a rendered frame, only recomputed when the file changes """
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if key not in self.digests:
+            self.digests[key] = digest_file(path)
+        return self.digests[key]
+
+    def content_hash(self, blend_file):
+        """ Digest of a Blender file and its asset manifest, warm workers reload the scene when it changes """
+        parts = [self.get_digest(blend_file)]
+        manifest = self.backend.get_asset_manifest(blend_file)
+        if os.path.isfile(manifest):
+            parts.append(self.get_digest(manifest))
+        return hashlib.sha256("".join(parts).encode("utf-8")).hexdigest()
+
+    def missing_files(self, filelist, manifest):
+        """
+            Files the client does not hold, or holds a different version of, according to its manifest
+            The manifest lists name, size and digest of the files of the export directory on the client
+        """
+        held = {entry['name']: entry for entry in manifest}
+        missing = []
+        for path in filelist:
+            entry = held.get(os.path.basename(path))
+            if entry is None or entry['size'] != os.path.getsize(path) or entry['digest'] != self.get_digest(path):
+                missing.append(path)
+        return missing
+
+    async def queue_downloads(self, session, paths):
+        """
+            Queues files to send to the client, only a few are sent at the same time
+            Previews go in their own queue, emptied first
+        """
+        sending = set(session.pending_downloads) | set(session.pending_previews) | {sender.path for sender in session.senders.values()}
+        for path in paths:
+            if path in sending:
                 continue
+            if self.backend.is_preview(os.path.basename(path)):
+                session.pending_previews.append(path)
+            else:
+                session.pending_downloads.append(path)
+        await self.start_downloads(session)
+
+    def open_sender(self, session, path):
+        return FileSender(path, session.client_path(path), self.get_digest(path))
+
+    async def start_downloads(self, session):
+        while (session.pending_previews or session.pending_downloads) and len(session.senders) < MAX_DOWNLOADS:
+            path = (session.pending_previews or session.pending_downloads).popleft()
+            sender = await self.run_blocking(self.open_sender, session, path)
+            session.senders[sender.remote_path] = sender
+            await self.send(session, msg.FILE_OPEN, sender.remote_path, str(sender.size), sender.digest)
+
+    async def send_chunks(self, session, path, offset=None, acked=None):
+        """ Sends file chunks to the client as the flow control window allows """
+        sender = session.senders.get(path)
+        if sender is None:
+            return
+        async with self.file_lock(sender.path):
+            if offset is not None:
+                sender.start(offset)
+            if acked is not None:
+                sender.ack(acked)
+                session.compressor.ack((path, acked))
+
+            # Chunks are read and compressed in the thread pool
+            chunks = await self.run_blocking(lambda: [(chunk_offset, *session.compressor.compress((path, chunk_offset + len(data)), data))
+                                                      for chunk_offset, data in sender.next_chunks()])
+            for chunk_offset, codec, payload in chunks:
+                await self.send(session, msg.FILE_CHUNK, path, str(chunk_offset), payload, codec)
+
+    async def download_done(self, session, path, error=None):
+        """ Client received a file, the next queued one is started """
+        sender = session.senders.pop(path, None)
+        if sender is None:
+            return
+        if error:
+            self.log("Client could not receive {}: {}".format(path, error), type="error")
+        else:
+            self.log("File {} sent".format(path))
+            await self.record_transfer('download', sender)
+        await self.start_downloads(session)
+
+    def cancel_downloads(self, session):
+        """ Client dropped its transfers, queued files and render output streams are not sent anymore """
+        session.pending_previews.clear()
+        session.pending_downloads.clear()
+        session.senders.clear()
+        self.close_streams(session)
+        self.log("{} cancelled its transfers".format(session.user))
+
+    async def get_render_output(self, session, export_path, manifest):
+        """ Sends rendered frames the client does not already have """
+        filelist = await self.run_blocking(self.backend.get_rendered_filelist, export_path)
+        missing = await self.run_blocking(self.missing_files, filelist, manifest)
+        self.log("Sending {} of {} files to client".format(len(missing), len(filelist)))
+        session.streamed.update(filelist)
+        await self.queue_downloads(session, missing)
+
+    async def stream_render_output(self, session, export_path, manifest, full_frames=True):
+        """
+            Sends frames of a render to the client as soon as they are written, starting with the ones already on disk
+            The preview of each frame is sent first, full resolution frames follow unless only previews are streamed
+            The export directory is only watched while the render is in progress
+        """
+        filelist = await self.run_blocking(self.backend.get_rendered_filelist, export_path)
+        filelist += await self.run_blocking(self.backend.get_preview_filelist, export_path)
+        missing = await self.run_blocking(self.missing_files, filelist, manifest)
+        if not full_frames:
+            missing = [path for path in missing if self.backend.is_preview(os.path.basename(path))]
+        # Frames already written are queued here, the watcher only reports the ones written from now on
+        session.streamed.update(filelist)
+        await self.queue_downloads(session, missing)
+        if export_path in self.render_queue.renders:
+            self.streams.setdefault(export_path, {})[session.identity] = full_frames
+            self.watcher.watch(export_path)
+
+    def resume_session(self, session, identity):
+        """ Moves a session, and the render output streams it receives, to the new socket identity of its client """
+        self.sessions.pop(session.identity, None)
+        for identities in self.streams.values():
+            if session.identity in identities:
+                identities[identity] = identities.pop(session.identity)
+        session.identity = identity
+        self.sessions[identity] = session
+        self.log("{} resumed its session".format(session.user))
+
+    async def resume_transfers(self, session):
+        """
+            Announces again the files being sent to a reconnected client, it answers with the offset it got to
+            Uploads are announced again by the client, progress of the renders of the user is sent straight away
+        """
+        for sender in list(session.senders.values()):
+            await self.send(session, msg.FILE_OPEN, sender.remote_path, str(sender.size), sender.digest)
+        await self.start_downloads(session)
+        for export_path in list(self.render_queue.renders):
+            if export_path.startswith(session.root + os.sep):
+                await self.send_progress(export_path)
+
+    def drop_session(self, session):
+        session.connected = False
+        self.close_streams(session)
+        self.sessions.pop(session.identity, None)
+        self.tokens.pop(session.token, None)
+        for server_path, waiters in list(self.upload_waiters.items()):
+            waiters[:] = [waiter for waiter in waiters if waiter[0] is not session]
+            if not waiters:
+                del self.upload_waiters[server_path]
+        # Uploads of the session are taken over by the sessions waiting for them
+        for server_path, receiver in list(self.receivers.items()):
+            if receiver.session is session:
+                del self.receivers[server_path]
+                self.spawn(self.safe_handle(self.hand_over_upload, server_path, receiver.size, receiver.digest, True))
+
+    def close_streams(self, session):
+        for export_path, identities in self.streams.items():
+            identities.pop(session.identity, None)
+            if not identities:
+                self.watcher.unwatch(export_path)
+
+    async def watch_loop(self):
+        """
+            Queues frames written in streamed export directories for download
+            Directories are watched with inotify, the poll runs in the thread pool as directories
+            are listed when they are picked up, or at every poll without inotify
+        """
+        while True:
+            await asyncio.sleep(WATCH_INTERVAL)
+            for path in sorted(await self.run_blocking(self.watcher.poll)):
+                self.backend.outputs.add(path)
+                export_path = os.path.dirname(path)
+                preview = self.backend.is_preview(os.path.basename(path))
+                for identity, full_frames in self.streams.get(export_path, {}).items():
+                    session = self.sessions.get(identity)
+                    if session and path not in session.streamed and (preview or full_frames):
+                        session.streamed.add(path)
+                        await self.queue_downloads(session, [path])
+
+            # Renders done, the last frames have been queued
+            for export_path in [e for e in self.streams if e not in self.watcher.directories]:
+                del self.streams[export_path]
+
+    async def handle_request(self, session, message):
+        """
+            Handles a client message, requests changing server state are acknowledged with REQUEST_DONE
+            A client that lost the replies with its socket sends the request again, the replies are then
+            sent again instead of handling it twice
+        """
+        header = message[0].decode("utf-8")
+        request_id = message[1].decode("utf-8")
+        if header not in msg.ACKNOWLEDGED:
+            await self.handle_message(session, message)
+            return
+
+        if request_id in session.replies:
+            for frames in list(session.replies[request_id]):
+                await self.socket.send_multipart([session.identity] + frames)
+            return
+        session.replies[request_id] = []
+        if len(session.replies) > MAX_REPLIES:
+            session.replies.popitem(last=False)
+        try:
+            await self.handle_message(session, message)
+        finally:
+            await self.send(session, msg.REQUEST_DONE, request_id=request_id)
+
+    async def handle_message(self, session, message):
+        """ Handles a single client message """
+        header = message[0].decode("utf-8")
+        request_id = message[1].decode("utf-8")
+        args = message[2:]
+
+        match header:
+            case msg.PING:
+                # Clients list the compression codecs they support after their user name
+                offered = args[1].decode("utf-8").split(",") if len(args) > 1 else []
+                codec = negotiate_codec(offered)
+                session.compressor = Compressor(codec)
+                # The session token is sent back, the client pings with it when reconnecting
+                resumed = session.greeted
+                await self.send(session, msg.PONG, codec, session.token, "resumed" if resumed else "new", request_id=request_id)
+                if resumed:
+                    await self.resume_transfers(session)
+                else:
+                    self.log("{} connected".format(session.user))
+                    session.greeted = session.connected = True
+                    # Sends default server backend configuration
+                    await self.send(session, msg.BACKEND_CONFIG, json.dumps(self.backend.get_server_config()), request_id=request_id)
+
+            case msg.HEARTBEAT:
+                await self.send(session, msg.HEARTBEAT, request_id=request_id)
+
+            case msg.CLOSE_CONNECTION:
+                self.log("{} disconnected".format(session.user))
+                self.drop_session(session)
+
+            case msg.FILE_OPEN:
+                path = args[0].decode("utf-8")
+                size = int(args[1])
+                digest = args[2].decode("utf-8")
+                delta = len(args) > 3 and args[3].decode("utf-8") == "delta"
+                async with self.file_lock(session.server_path(path)):
+                    await self.open_file(session, request_id, path, size, digest, delta)
+
+            case msg.FILE_DELTA:
+                path = args[0].decode("utf-8")
+                async with self.file_lock(session.server_path(path)):
+                    await self.apply_delta(session, request_id, path, json.loads(args[1]))
+
+            case msg.FILE_CHUNK:
+                path = args[0].decode("utf-8")
+                codec = args[3].decode("utf-8") if len(args) > 3 else "none"
+                async with self.file_lock(session.server_path(path)):
+                    await self.save_chunk(session, request_id, path, int(args[1]), args[2], codec)
+
+            case msg.FILE_RESUME:
+                await self.send_chunks(session, args[0].decode("utf-8"), offset=int(args[1]))
+
+            case msg.FILE_CHUNK_ACK:
+                await self.send_chunks(session, args[0].decode("utf-8"), acked=int(args[1]))
+
+            case msg.FILE_ACK:
+                await self.download_done(session, args[0].decode("utf-8"))
+
+            case msg.FILE_ERROR:
+                await self.download_done(session, args[0].decode("utf-8"), error=args[1].decode("utf-8"))
+
+            case msg.CANCEL_TRANSFERS:
+                self.cancel_downloads(session)
+
+            case msg.ASSET_MANIFEST:
+                blend_file = args[0].decode("utf-8")
+                await self.register_assets(session, request_id, blend_file, json.loads(args[1]))
+
+            case msg.BACKEND_CONFIG:
+                session.render_config = json.loads(args[0])
 
-            message = self.socket.recv_multipart()
+            case msg.START_RENDER:
+                await self.start_render(session, request_id, args[0].decode("utf-8"))
 
-            header = message[0].decode("utf-8")
+            case msg.CANCEL_RENDER:
+                await self.cancel_render(session.server_path(args[0].decode("utf-8")))
 
-            match header:
-                case msg.PING:
-                    self.send_string(msg.PONG)
-                    if not self.client_connected:
-                        self.log("Connected")
-                        # Sends default server backend configuration
-                        self.send_backend_config(self.backend.get_server_config())
-                        self.client_connected = True
+            case msg.RESIZE_RENDER:
+                await self.resize_render(session.server_path(args[0].decode("utf-8")), int(args[1]))
 
-                case msg.CLOSE_CONNECTION:
-                    self.log("Disconnected")
-                    self.client_connected = False
+            case msg.REQUEUE_RENDER:
+                await self.run_backend_command(self.backend.requeue_render, session.server_path(args[0].decode("utf-8")))
 
-                case msg.FILE:
-                    path = message[1].decode("utf-8")
-                    self.save_file(path, message[2])
+            case msg.GET_RENDER_OUTPUT:
+                manifest = json.loads(args[1]) if len(args) > 1 else []
+                await self.get_render_output(session, session.server_path(args[0].decode("utf-8")), manifest)
 
-                case msg.BACKEND_CONFIG:
-                    self.backend.render_config = json.loads(message[1])
+            case msg.STATS:
+                await self.get_stats(session, request_id, args[0].decode("utf-8"))
 
-                case msg.START_RENDER:
-                    return_code, error = self.backend.start_render(message[1].decode("utf-8"))
-                    if return_code == 0:
-                        self.log("Renders in progress")
-                    else:
-                        self.log("Error with starting renders")
-                        self.log(error)
+            case msg.STREAM_RENDER_OUTPUT:
+                manifest = json.loads(args[1]) if len(args) > 1 else []
+                full_frames = len(args) < 3 or args[2].decode("utf-8") == "full"
+                await self.stream_render_output(session, session.server_path(args[0].decode("utf-8")), manifest, full_frames)
 
-                case msg.GET_RENDER_OUTPUT:
-                    export_path = message[1].decode("utf-8")
-                    filelist = self.backend.get_rendered_filelist(export_path)
-                    self.log("Sending {} files to client".format(len(filelist)))
-                    for file in filelist:
-                        self.send_file(file)
+            case _:
+                self.log("Command not recognised: {}".format(header))
 
-                case _:
-                    self.log("Command not recognised: {}".format(header))
+    async def safe_handle(self, handler, *args):
+        """ Runs a message handler, errors are logged without stopping the server """
+        try:
+            await handler(*args)
+        except Exception as e:
+            self.log("Error handling message: {!r}".format(e), type="error")
+
+    async def client_loop(self):
+        """
+            Receives client messages, each one is handled in its own task
+            A session is opened by the first ping of a client, which carries its user name
+        """
+        while True:
+            identity, *message = await self.socket.recv_multipart()
+
+            session = self.sessions.get(identity)
+            if session is None:
+                if message[0].decode("utf-8") != msg.PING:
+                    self.log("Ignoring message from unknown client", type="error")
+                    continue
+                # A reconnecting client pings with the token of its session
+                token = message[4].decode("utf-8") if len(message) > 4 else ""
+                if token in self.tokens:
+                    session = self.tokens[token]
+                    self.resume_session(session, identity)
+                else:
+                    user = message[2].decode("utf-8") if len(message) > 2 else "default"
+                    session = self.sessions[identity] = Session(identity, user)
+                    self.tokens[session.token] = session
+
+            session.last_seen = time.monotonic()
+            if session.greeted and not session.connected:
+                self.log("{} reconnected".format(session.user))
+                session.connected = True
+
+            # Chunks of the same file wait on the file lock in the order they are received
+            self.spawn(self.safe_handle(self.handle_request, session, message))
+
+    async def worker_loop(self):
+        """ Receives render job messages """
+        while True:
+            identity, *message = await self.dispatcher_socket.recv_multipart()
+            self.spawn(self.safe_handle(self.handle_worker_message, identity, message))
+
+    async def lease_loop(self):
+        """ Puts frames of expired leases back in the queue """
+        while True:
+            await asyncio.sleep(1)
+            for lease in self.dispatcher.expire_leases():
+                self.log("Lease of frame {} by {} expired".format(lease.frame, lease.worker))
+
+    async def frame_times_loop(self):
+        """ Frame times are recorded in memory by the dispatcher for every frame and written here """
+        while True:
+            await asyncio.sleep(FRAME_TIMES_FLUSH_INTERVAL)
+            await self.run_blocking(self.dispatcher.frame_times.flush)
+
+    async def session_loop(self):
+        """
+            Suspends the sessions of clients that stopped sending heartbeats, such as behind a dropped ssh tunnel
+            Progress is not pushed to suspended sessions, sessions not resumed in time are dropped
+        """
+        while True:
+            await asyncio.sleep(SESSION_CHECK_INTERVAL)
+            now = time.monotonic()
+            for session in list(self.sessions.values()):
+                if now - session.last_seen > SESSION_EXPIRY:
+                    self.log("Session of {} expired".format(session.user))
+                    self.drop_session(session)
+                elif session.connected and now - session.last_seen > SESSION_TIMEOUT:
+                    self.log("{} lost connection".format(session.user))
+                    session.connected = False
+
+    async def prune_loop(self):
+        """ Drops old finished submissions from the job store, once a day """
+        while True:
+            for export_path in await self.run_blocking(self.store.prune, HISTORY_MAX_AGE):
+                self.backend.forget_render(export_path)
+            await asyncio.sleep(24 * 3600)
+
+    async def render_cache_loop(self):
+        """ Render jobs only add frames to the render cache, old ones are evicted here """
+        while True:
+            await self.run_blocking(self.render_cache.evict)
+            await asyncio.sleep(RENDER_CACHE_EVICT_INTERVAL)
+
+    def prune_assets(self):
+        """
+            Removes the assets whose file cache entry was evicted, so that the cache size bounds their disk use
+            Assets are hard links to the cache entries, linked back from the cache when submitted again
+        """
+        deadline = time.time() - ASSET_MAX_IDLE
+        if not os.path.isdir(ASSETS_ROOT):
+            return
+        for directory in os.scandir(ASSETS_ROOT):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                try:
+                    stat = entry.stat()
+                    if stat.st_nlink <= 1 and stat.st_mtime < deadline:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+            try:
+                os.rmdir(directory.path)
+            except OSError:
+                pass
+
+    async def assets_loop(self):
+        """ Assets are linked from the file cache, the ones it evicted are removed here """
+        while True:
+            await self.run_blocking(self.prune_assets)
+            await asyncio.sleep(ASSET_PRUNE_INTERVAL)
+
+    async def serve(self):
+        self.context = zmq.asyncio.Context()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.bind("tcp://*:{}".format(self.listen_port))
+        self.dispatcher_socket = self.context.socket(zmq.ROUTER)
+        self.dispatcher_socket.bind("tcp://*:{}".format(self.dispatcher_port))
+        self.log("{} backend".format(self.backend.name))
+        self.log("listening to *:{}".format(self.listen_port))
+        self.log("dispatching frames on {}".format(self.backend.dispatcher_address))
+
+        # Job states are collected in a background thread and handed back to the loop
+        loop = asyncio.get_running_loop()
+        self.status_collector = StatusCollector(
+            self.backend,
+            lambda changes: asyncio.run_coroutine_threadsafe(self.handle_status_changes(changes), loop),
+            self.status_interval)
+        self.status_collector.start()
+
+        loops = [self.client_loop(), self.worker_loop(), self.lease_loop(), self.watch_loop(), self.autoscale_loop(),
+                 self.session_loop(), self.frame_times_loop(), self.assets_loop()]
+        if self.store:
+            self.restore()
+            loops.append(self.prune_loop())
+        if self.render_cache:
+            loops.append(self.render_cache_loop())
+        await asyncio.gather(*loops)
+
+    def run(self):
+        """
+            Run the server
+        """
+        asyncio.run(self.serve())
 
 
 if __name__ == '__main__':
     port = 31416
-    backend = BackendSlurm()
-    server = Server(port, backend)
+    dispatcher_port = 31417
+    cache_size = 50 * 1024**3
+    render_cache_size = 200 * 1024**3
+    status_interval = 30
+    # Slurm is used when available, renders run as local processes otherwise
+    store = JobStore("jobs.db")
+    if shutil.which("sbatch"):
+        backend = BackendSlurm(store)
+        # Jobs running at the same time for all the users
+        max_jobs = 16
+    else:
+        backend = BackendCLI(store)
+        max_jobs = len(backend.slots)
+    server = Server(port, backend, FileCache("cache", cache_size), dispatcher_port, status_interval, max_jobs,
+                    render_cache=FileCache("render_cache", render_cache_size))
     server.run()
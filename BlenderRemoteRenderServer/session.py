@@ -0,0 +1,89 @@
+import os
+import time
+import secrets
+from collections import deque, OrderedDict
+from transfer import Compressor
+
+# Directory, relative to the server working directory, holding the files of every user
+PROJECTS_ROOT = "projects"
+# Shared by all users and projects, files in there are named after their content digest
+ASSETS_ROOT = "assets"
+# Requests of a session whose replies are kept for clients sending them again
+MAX_REPLIES = 100
+
+
+class Session():
+    """
+        State of a client connection: user, render configuration and file transfers in progress.
+        Files named by the client are relative to the user directory, each project being a sub
+        directory with its own Blender file, job log and renders.
+        A session outlives its socket: a client reconnecting with the token of its session gets it
+        back under its new socket identity, with its transfers and render output streams.
+    """
+    def __init__(self, identity, user):
+        self.identity = identity
+        self.user = safe_name(user)
+        self.root = os.path.join(PROJECTS_ROOT, self.user)
+        self.token = secrets.token_hex(16)
+        # Set when the first ping of the client is answered
+        self.greeted = False
+        # Cleared while the client is silent for longer than the session timeout
+        self.connected = False
+        self.last_seen = time.monotonic()
+        self.render_config = {}
+        # Compression of the file chunks sent to the client, with the codec negotiated at ping
+        self.compressor = Compressor()
+
+        # Chunked downloads indexed by client path, uploads are held by the server as they can be shared
+        self.senders = {}
+        self.pending_downloads = deque()
+        # Previews are sent before any full resolution frame
+        self.pending_previews = deque()
+        # Frames already queued by render output streams
+        self.streamed = set()
+        # Replies to the acknowledged requests of the client, by request id, replayed when it sends one again
+        self.replies = OrderedDict()
+
+    def server_path(self, path):
+        """ Path on the server of a file named by the client, which cannot point outside of the user directory """
+        path = os.path.normpath(path)
+        if os.path.isabs(path) or path.split(os.sep)[0] == '..':
+            raise ValueError("Invalid path {}".format(path))
+        if path.split(os.sep)[0] == ASSETS_ROOT:
+            return path
+        return os.path.join(self.root, path)
+
+    def client_path(self, path):
+        """ Path of a server file as named by the client """
+        if path.split(os.sep)[0] == ASSETS_ROOT:
+            return path
+        return os.path.relpath(path, self.root)
+
+    def project(self, path):
+        """ Project name of a file named by the client, as used to index render history """
+        return "{}/{}".format(self.user, os.path.normpath(path).split(os.sep)[0])
+
+
+def project_dir(path):
+    """ Directory of the project a server file belongs to, None for files outside of projects such as assets """
+    parts = os.path.normpath(path).split(os.sep)
+    if parts[0] != PROJECTS_ROOT or len(parts) < 4:
+        return None
+    return os.path.join(*parts[:3])
+
+
+def asset_digest(path):
+    """
+        Digest an asset path is named after, assets/<digest>/<filename>
+        None for files outside of the assets directory, an empty string for misplaced ones
+    """
+    parts = os.path.normpath(path).split(os.sep)
+    if parts[0] != ASSETS_ROOT:
+        return None
+    return parts[1] if len(parts) == 3 else ""
+
+
+def safe_name(name):
+    """ Keeps names usable as a single directory name """
+    name = "".join(c if c.isalnum() or c in "-_." else "_" for c in name).strip(".")
+    return name or "default"
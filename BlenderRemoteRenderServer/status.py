@@ -0,0 +1,57 @@
+import threading
+
+# Job states after which a job is not queried anymore
+# LOST is given by the local backend to the processes of a previous server run
+FINAL_STATES = ['COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'NODE_FAIL', 'OUT_OF_MEMORY', 'PREEMPTED', 'BOOT_FAIL', 'DEADLINE', 'LOST']
+
+
+class StatusCollector(threading.Thread):
+    """
+        Collects the state of all the tracked render jobs in the background.
+        Every interval, the jobs still running are queried from the scheduler in a single call and the
+        number of rendered frames is read from the output index. Changes are handed to the server through callback,
+        called from this thread, the scheduler is never queried on demand.
+    """
+    def __init__(self, backend, callback, interval):
+        super().__init__(daemon=True)
+        self.backend = backend
+        self.callback = callback
+        self.interval = interval
+        self.stop = threading.Event()
+
+        self.rendered = {}
+
+    def collect(self):
+        """ Returns changes since the previous collection, indexed by export path """
+        jobs = {export_path: list(job_ids) for export_path, job_ids in self.backend.jobs.items()}
+        active = [job_id for job_ids in jobs.values() for job_id in job_ids
+                  if self.backend.job_states.get(job_id, 'SUBMITTED') not in FINAL_STATES]
+        if not active:
+            return {}
+
+        states = self.backend.query_job_states(active)
+
+        changes = {}
+        for export_path, job_ids in jobs.items():
+            changed_jobs = {job_id: states[job_id] for job_id in job_ids
+                            if job_id in states and states[job_id] != self.backend.job_states.get(job_id)}
+            if not any(job_id in active for job_id in job_ids):
+                continue
+
+            rendered = self.backend.get_nb_rendered(export_path)
+            if changed_jobs or rendered != self.rendered.get(export_path):
+                changes[export_path] = {'jobs': changed_jobs, 'rendered': rendered}
+            self.rendered[export_path] = rendered
+
+        self.backend.update_job_states(states)
+        return changes
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            try:
+                changes = self.collect()
+            except Exception as e:
+                print("Error collecting render status: {}".format(e))
+                continue
+            if changes:
+                self.callback(changes)
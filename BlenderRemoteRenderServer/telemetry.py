@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import threading
+from bisect import insort
+from collections import deque, OrderedDict
+
+# Raw events appended to the history of a project before it is compacted into aggregates
+COMPACT_EVENTS = 5000
+# Submissions of a project whose statistics are kept, the oldest ones are dropped first
+MAX_SUBMISSIONS = 200
+# Frame times of a project kept for its percentiles, the most recent ones
+MAX_PROJECT_DURATIONS = 5000
+
+
+def percentile(values, fraction):
+    """ Value below which the given fraction of sorted values lie """
+    if not values:
+        return 0
+    return values[min(int(round(fraction * (len(values) - 1))), len(values) - 1)]
+
+
+class FrameStats():
+    """
+        Running statistics of the frames of a submission, or of a whole project
+        Frame times of a submission are kept sorted, only the most recent ones are kept for a project
+    """
+    def __init__(self, max_durations=None):
+        self.frames = 0
+        self.cached = 0
+        self.peak_memory = 0
+        self.first = None
+        self.last = None
+        self.max_durations = max_durations
+        self.durations = deque(maxlen=max_durations) if max_durations else []
+
+    def add(self, event):
+        if event['type'] == 'cached':
+            self.cached += 1
+            return
+        self.frames += 1
+        self.peak_memory = max(self.peak_memory, event.get('memory', 0))
+        self.first = event['time'] if self.first is None else min(self.first, event['time'])
+        self.last = event['time'] if self.last is None else max(self.last, event['time'])
+        if 'duration' in event:
+            if self.max_durations:
+                self.durations.append(event['duration'])
+            else:
+                insort(self.durations, event['duration'])
+
+    def summary(self):
+        durations = sorted(self.durations) if self.max_durations else self.durations
+        summary = {'frames': self.frames,
+                   'cached': self.cached,
+                   'frames_per_hour': 0,
+                   'p50': percentile(durations, 0.5),
+                   'p95': percentile(durations, 0.95),
+                   'peak_memory': self.peak_memory}
+        if self.frames:
+            # Time from the start of the first frame to the end of the last one
+            span = self.last - self.first + summary['p50']
+            summary['frames_per_hour'] = self.frames * 3600 / span if span > 0 else 0
+        return summary
+
+    def to_json(self):
+        return {'frames': self.frames, 'cached': self.cached, 'peak_memory': self.peak_memory,
+                'first': self.first, 'last': self.last, 'durations': list(self.durations)}
+
+    def load_json(self, state):
+        self.frames = state['frames']
+        self.cached = state['cached']
+        self.peak_memory = state['peak_memory']
+        self.first = state['first']
+        self.last = state['last']
+        self.durations.clear()
+        self.durations.extend(state['durations'] if self.max_durations else sorted(state['durations']))
+
+
+class ProjectTelemetry():
+    """ Aggregated frame and transfer statistics of a project """
+    def __init__(self):
+        self.project = FrameStats(MAX_PROJECT_DURATIONS)
+        self.submissions = OrderedDict()
+        # Bytes and seconds of the transfers in each direction
+        self.transfers = {'upload': [0, 0.0], 'download': [0, 0.0]}
+        # Raw events in the history file since it was last compacted
+        self.nb_events = 0
+
+    def add(self, event):
+        if event['type'] in ('frame', 'cached'):
+            self.project.add(event)
+            if event['submission'] not in self.submissions:
+                self.submissions[event['submission']] = FrameStats()
+                if len(self.submissions) > MAX_SUBMISSIONS:
+                    self.submissions.popitem(last=False)
+            self.submissions[event['submission']].add(event)
+        elif event['type'] == 'transfer':
+            totals = self.transfers.setdefault(event['direction'], [0, 0.0])
+            totals[0] += event['bytes']
+            totals[1] += event['duration']
+
+    def load_state(self, state):
+        """ Aggregates written when the history was compacted """
+        self.project.load_json(state['project'])
+        for submission, stats in state['submissions']:
+            self.submissions[submission] = FrameStats()
+            self.submissions[submission].load_json(stats)
+        self.transfers = state['transfers']
+
+    def state(self):
+        return {'type': 'state',
+                'project': self.project.to_json(),
+                'submissions': [[submission, stats.to_json()] for submission, stats in self.submissions.items()],
+                'transfers': self.transfers}
+
+
+class Telemetry():
+    """
+        Frame and transfer events of each project, kept as running aggregates.
+        Events are appended as JSON lines to a file in the project directory, which is compacted into a
+        single line of aggregates once it holds COMPACT_EVENTS events. Summaries are computed from the
+        aggregates, so their cost does not grow with the history of the project.
+    """
+    def __init__(self, filename="telemetry.jsonl"):
+        self.filename = filename
+        self.projects = {}
+        # Records and summaries run concurrently in the thread pool
+        self.lock = threading.Lock()
+
+    def load(self, project_dir):
+        if project_dir not in self.projects:
+            telemetry = ProjectTelemetry()
+            path = os.path.join(project_dir, self.filename)
+            if os.path.isfile(path):
+                with open(path, 'r') as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        event = json.loads(line)
+                        if event['type'] == 'state':
+                            telemetry.load_state(event)
+                        else:
+                            telemetry.add(event)
+                            telemetry.nb_events += 1
+            self.projects[project_dir] = telemetry
+        return self.projects[project_dir]
+
+    def record(self, project_dir, event):
+        """ Appends an event, a dictionary with at least a type, to the history of a project """
+        event['time'] = time.time()
+        with self.lock:
+            telemetry = self.load(project_dir)
+            telemetry.add(event)
+            telemetry.nb_events += 1
+            if telemetry.nb_events >= COMPACT_EVENTS:
+                self.compact(project_dir, telemetry)
+            else:
+                with open(os.path.join(project_dir, self.filename), 'a') as f:
+                    f.write(json.dumps(event, separators=(',', ':')) + "\n")
+
+    def compact(self, project_dir, telemetry):
+        """ Replaces the history of a project with its aggregates """
+        path = os.path.join(project_dir, self.filename)
+        with open(path + ".tmp", 'w') as f:
+            f.write(json.dumps(telemetry.state(), separators=(',', ':')) + "\n")
+        os.replace(path + ".tmp", path)
+        telemetry.nb_events = 0
+
+    def summary(self, project_dir, submission=None):
+        """
+            Frame throughput, frame time percentiles, memory and transfer rates of a project
+            Frame statistics are restricted to a submission if given
+        """
+        with self.lock:
+            telemetry = self.load(project_dir)
+            if submission is None:
+                summary = telemetry.project.summary()
+            else:
+                summary = telemetry.submissions.get(submission, FrameStats()).summary()
+            for direction, (nb_bytes, duration) in telemetry.transfers.items():
+                summary[direction + '_mbps'] = nb_bytes / duration / 1e6 if duration > 0 else 0
+        return summary
@@ -0,0 +1 @@
+../source/transfer.py
\ No newline at end of file
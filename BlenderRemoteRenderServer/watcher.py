@@ -0,0 +1,122 @@
+import os
+import struct
+import ctypes
+import ctypes.util
+
+# inotify events of files written and closed, or moved in place
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = os.O_NONBLOCK
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def inotify_init():
+    """ Returns the C library and an inotify file descriptor, None if inotify is not available """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK)
+    except (OSError, AttributeError):
+        return None, None
+    if fd < 0:
+        return None, None
+    return libc, fd
+
+
+class DirectoryWatcher():
+    """
+        Reports files finalized in watched directories, files are reported once.
+        Uses inotify when available, directories are listed at every poll otherwise.
+        A directory can be watched before it exists, it is picked up as soon as it is created.
+        Files already in a directory when it starts being watched are reported by the first poll.
+        Directories can be watched and unwatched while a poll runs in another thread.
+    """
+    def __init__(self, accept):
+        # Filter on file names, to ignore temporary files
+        self.accept = accept
+        self.libc, self.fd = inotify_init()
+        # Watched directories, with their inotify watch descriptor once they exist
+        self.directories = {}
+        self.descriptors = {}
+        self.seen = {}
+        self.closing = set()
+
+    def watch(self, directory):
+        if directory not in self.directories:
+            self.directories[directory] = None
+            self.seen[directory] = set()
+        self.closing.discard(directory)
+
+    def unwatch(self, directory):
+        """ Stops watching after the next poll, which still reports files written until now """
+        if directory in self.directories:
+            self.closing.add(directory)
+
+    def add_watch(self, directory):
+        if self.fd is None:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd >= 0:
+            self.directories[directory] = wd
+            self.descriptors[wd] = directory
+
+    def remove_watch(self, directory):
+        wd = self.directories.pop(directory)
+        self.seen.pop(directory)
+        if wd is not None:
+            self.descriptors.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """ Returns (directory, filename) of pending inotify events """
+        events = []
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+                offset += EVENT_HEADER.size
+                name = buffer[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if wd in self.descriptors and name:
+                    events.append((self.descriptors[wd], os.fsdecode(name)))
+
+    def scan(self, directory):
+        try:
+            return [(directory, filename) for filename in os.listdir(directory)]
+        except FileNotFoundError:
+            return []
+
+    def poll(self):
+        """ Returns paths of the files finalized since the previous poll """
+        candidates = []
+        for directory, wd in list(self.directories.items()):
+            if wd is None and os.path.isdir(directory):
+                self.add_watch(directory)
+                # Files written before the watch was added
+                candidates += self.scan(directory)
+            elif self.fd is None:
+                candidates += self.scan(directory)
+
+        if self.fd is not None:
+            candidates += self.read_events()
+
+        new_files = []
+        for directory, filename in candidates:
+            if directory in self.seen and filename not in self.seen[directory] and self.accept(filename):
+                self.seen[directory].add(filename)
+                new_files.append(os.path.join(directory, filename))
+
+        closing = list(self.closing)
+        self.closing.difference_update(closing)
+        for directory in closing:
+            if directory in self.directories:
+                self.remove_watch(directory)
+        return new_files
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -12,6 +12,7 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 from .panel_ui import *
 from .client_core import *
+from .messages import msg
 
 classes = [
     BackendConfig,
@@ -19,6 +20,9 @@ classes = [
     RemoteRender,
     RemoteRenderFrame,
     RemoteRenderAnim,
+    RemoteCancelRender,
+    RemoteCancelTransfers,
+    RemoteRetrieveRenders,
     RemoteClose,
     RemoteConnect
 ]
@@ -37,6 +41,14 @@ bl_info = {
 
 def register():
     bpy.types.WindowManager.zmq_context = None
+    bpy.types.WindowManager.client_io = None
+    bpy.types.WindowManager.poller = None
+    bpy.types.WindowManager.poll_interval = 0
+    bpy.types.WindowManager.pending_uploads = set()
+    bpy.types.WindowManager.pending_render = None
+    bpy.types.WindowManager.pending_assets = False
+    bpy.types.WindowManager.assets = {}
+    bpy.types.WindowManager.job_states = {}
     for cls in classes:
         bpy.utils.register_class(cls)
 
@@ -44,6 +56,13 @@ def register():
 
 
 def unregister():
+    # The connection thread and the timer handling its messages would outlive the addon
+    stop_polling()
+    client_io = bpy.types.WindowManager.client_io
+    if client_io is not None:
+        client_io.send([msg.CLOSE_CONNECTION])
+        client_io.stop()
+        bpy.types.WindowManager.client_io = None
     bpy.types.WindowManager.zmq_context = None
     for cls in classes[::-1]:
         bpy.utils.unregister_class(cls)
@@ -0,0 +1,68 @@
+import os
+import bpy
+from .transfer import digest_file
+
+# Datablock collections referencing external files
+ASSET_TYPES = ['images', 'libraries', 'movieclips', 'sounds', 'volumes', 'cache_files', 'fonts']
+
+# Digests of already hashed files, indexed by (path, size, mtime)
+digest_cache = {}
+
+
+def get_digest(path):
+    """ Content digest of a file, only recomputed when the file changes """
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key not in digest_cache:
+        digest_cache[key] = digest_file(path)
+    return digest_cache[key]
+
+
+def set_digest(path, digest):
+    """ Records the digest of a file already checked against it, such as a verified download """
+    stat = os.stat(path)
+    digest_cache[(path, stat.st_size, stat.st_mtime_ns)] = digest
+
+
+def is_shippable(datablock):
+    """ Only local datablocks pointing to a single unpacked file are shipped """
+    if datablock.library or getattr(datablock, 'packed_file', None):
+        return False
+    if getattr(datablock, 'source', 'FILE') not in ('FILE', 'MOVIE'):
+        # Image sequences and UDIM tiles span several files
+        return False
+    if getattr(datablock, 'is_sequence', False):
+        return False
+    return bool(datablock.filepath) and datablock.filepath != '<builtin>'
+
+
+def collect_assets():
+    """
+        Walks bpy.data for external files used by the project
+        Returns a list of dictionaries describing each datablock and the file it points to
+        Files are not hashed here, see digest_assets
+    """
+    assets = []
+    for asset_type in ASSET_TYPES:
+        for datablock in getattr(bpy.data, asset_type):
+            if not is_shippable(datablock):
+                continue
+
+            path = os.path.normpath(bpy.path.abspath(datablock.filepath))
+            if not os.path.isfile(path):
+                print("Asset {} not found: {}".format(datablock.name, path))
+                continue
+
+            assets.append({'type': asset_type,
+                           'name': datablock.name,
+                           'path': path,
+                           'filename': os.path.basename(path),
+                           'size': os.path.getsize(path)})
+    return assets
+
+
+def digest_assets(assets):
+    """ Adds the content digest of the files of collected assets, files are only read again when they change """
+    for asset in assets:
+        asset['digest'] = get_digest(asset['path'])
+    return assets
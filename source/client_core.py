@@ -2,8 +2,19 @@ import os
 import bpy
 import zmq
 import json
+import getpass
 from pathlib import Path
 from .messages import msg
+from .assets import collect_assets, digest_assets, get_digest
+from .client_io import ClientIO, MIN_TIMER_INTERVAL, MAX_TIMER_INTERVAL
+
+
+def redraw_panel():
+    """ Redraws properties editors showing the remote render panel """
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.type == 'PROPERTIES':
+                area.tag_redraw()
 
 
 class RemoteConnect(bpy.types.Operator):
@@ -25,14 +36,34 @@ class RemoteClose(bpy.types.Operator):
         return {"FINISHED"}
 
 class RemoteRetrieveRenders(bpy.types.Operator):
-    """Close connection to a remote render server"""
+    """Download frames rendered so far by the last render"""
     bl_idname = "remote.retrieve_renders"
     bl_label = "Get renders"
 
     def execute(self, context):
         rr = context.scene.remote_render
-        rr.send_string
-        context.scene.remote_render.get_renders()
+        rr.request_output(msg.GET_RENDER_OUTPUT)
+        rr.log("Downloading renders")
+        return {"FINISHED"}
+
+class RemoteCancelRender(bpy.types.Operator):
+    """Cancel render in progress on remote server"""
+    bl_idname = "remote.cancel_render"
+    bl_label = "Cancel render"
+
+    def execute(self, context):
+        rr = context.scene.remote_render
+        rr.send_strings([msg.CANCEL_RENDER, rr.render_export_dir])
+        rr.log("Render cancelled")
+        return {"FINISHED"}
+
+class RemoteCancelTransfers(bpy.types.Operator):
+    """Stop uploads and downloads in progress, and the render waiting for them"""
+    bl_idname = "remote.cancel_transfers"
+    bl_label = "Cancel transfers"
+
+    def execute(self, context):
+        context.scene.remote_render.cancel_transfers()
         return {"FINISHED"}
 
 class RemoteRenderAnim(bpy.types.Operator):
@@ -82,14 +113,36 @@ class RemoteRender(bpy.types.PropertyGroup):
     server_hostname: bpy.props.StringProperty(name="Hostname", default="127.0.0.1")
     server_port: bpy.props.IntProperty(name="Port", default=31415)
     server_connected: bpy.props.BoolProperty(name="Connected", default=False)
+    reconnecting: bpy.props.BoolProperty(name="Reconnecting", default=False)
+    user_name: bpy.props.StringProperty(name="User", default="",
+                                        description="Name under which projects are stored on the server, the system user name if empty")
 
     # Server settings
     backend_config: bpy.props.CollectionProperty(type=BackendConfig)
     backend_name: bpy.props.StringProperty(name="Backend name")
     render_export_dir: bpy.props.StringProperty(name="Export directory name")
 
+    # Transfer settings
+    download_dir: bpy.props.StringProperty(name="Download directory", default="//remote_renders/", subtype='DIR_PATH')
+    delta_upload: bpy.props.BoolProperty(name="Delta upload", default=False,
+                                         description="Save uncompressed and only send blocks changed since the previous upload")
+    tile_grid: bpy.props.IntProperty(name="Tile grid", default=1, min=1, max=16,
+                                     description="Split still frames in a grid of N x N regions rendered by separate jobs")
+    stream_renders: bpy.props.BoolProperty(name="Stream renders", default=True,
+                                           description="Download a preview of each frame as soon as it is rendered")
+    stream_full_frames: bpy.props.BoolProperty(name="Stream full frames", default=True,
+                                               description="Also stream full resolution frames, after the previews. Otherwise they are downloaded with Get renders")
+
     status_log: bpy.props.StringProperty(name="Status log", default="")
 
+    # Render progress pushed by the server
+    render_status: bpy.props.StringProperty(name="Render status", default="")
+    frames_done: bpy.props.IntProperty(name="Frames rendered", default=0)
+    frames_total: bpy.props.IntProperty(name="Frames to render", default=0)
+    jobs_status: bpy.props.StringProperty(name="Jobs status", default="")
+    render_stats: bpy.props.StringProperty(name="Render statistics", default="")
+    transfer_stats: bpy.props.StringProperty(name="Transfer statistics", default="")
+
 
     def log(self, comment):
         """ Add comment to the connection log """
@@ -101,12 +154,12 @@ class RemoteRender(bpy.types.PropertyGroup):
         config = {}
         # Save current project
         blender_project_filename = "remote.blend"
-        bpy.ops.wm.save_as_mainfile(filepath=blender_project_filename, compress=True, copy=True, relative_remap=True) 
-
-        # Send Blender file
-        self.send_file(blender_project_filename)
+        # Each project has its own directory on the server
+        remote_filename = "{}/{}".format(self.project_name(), blender_project_filename)
+        # Compression shuffles all blocks of the file on any change, it is disabled for delta uploads
+        bpy.ops.wm.save_as_mainfile(filepath=blender_project_filename, compress=not self.delta_upload, copy=True, relative_remap=True) 
 
-        # Send backend config
+        # Backend config
         config[self.backend_name] = {}
         for item in self.backend_config:
             match item.key:
@@ -114,6 +167,8 @@ class RemoteRender(bpy.types.PropertyGroup):
                     config['max-nb-jobs'] = item.int
                 case 'job-name':
                     config['job-name'] = item.string
+                case 'frame-order':
+                    config['frame-order'] = item.string
                 case _:
                     match item.type:
                         case 'string':
@@ -124,38 +179,120 @@ class RemoteRender(bpy.types.PropertyGroup):
                             config[self.backend_name][item.key] = item.bool
 
         config['frame-start'] = frame_start
+        config['tiles'] = self.tile_grid
         if frame_end:
             config['frame-end'] = frame_end
         else:
             config['frame-end'] = frame_start
-        
-        self.send_backend_config(config)
 
+        # Config and render start are sent once the Blender file and its assets are uploaded
+        bpy.types.WindowManager.pending_render = (config, remote_filename)
+        self.send_file(blender_project_filename, remote_filename)
+        self.send_assets(remote_filename)
+
+    def project_name(self):
+        """ Name of the current project, taken from its Blender file name """
+        return bpy.path.clean_name(bpy.path.display_name_from_filepath(bpy.data.filepath)) or "untitled"
+
+    def send_assets(self, blender_project_filename):
+        """ 
+            Sends the list of external files used by the project
+            The server answers with the digests it does not have yet, only these are uploaded
+        """
+        assets = collect_assets()
+        # Digests are filled in by the I/O worker thread before the manifest is sent
+        bpy.types.WindowManager.assets = assets
+        bpy.types.WindowManager.pending_assets = True
+
+        client_io = bpy.types.WindowManager.client_io
+        client_io.in_background(send_asset_manifest, client_io, blender_project_filename, assets)
+        self.log("Checking {} assets".format(len(assets)))
+
+    def upload_missing_assets(self, digests):
+        """ Uploads assets the server does not have in its cache """
+        bpy.types.WindowManager.pending_assets = False
+        assets = {asset['digest']: asset for asset in bpy.types.WindowManager.assets}
+        for digest in digests:
+            asset = assets[digest]
+            self.send_file(asset['path'], "assets/{}/{}".format(digest, asset['filename']), digest)
+        self.start_pending_render()
+
+    def start_pending_render(self):
+        """ Sends backend config and starts render once all uploads are done """
+        if bpy.types.WindowManager.pending_uploads or bpy.types.WindowManager.pending_assets \
+                or not bpy.types.WindowManager.pending_render:
+            return
+
+        config, blender_project_filename = bpy.types.WindowManager.pending_render
+        bpy.types.WindowManager.pending_render = None
+        self.send_backend_config(config)
         self.send_strings([msg.START_RENDER, blender_project_filename])
 
+    def update_progress(self, progress):
+        """ Updates render progress from a server progress event """
+        if progress['export_path'] != self.render_export_dir:
+            return
+
+        self.render_status = progress['status']
+        self.frames_done = progress['done']
+        self.frames_total = progress['total']
+
+        job_states = bpy.types.WindowManager.job_states
+        job_states.update(progress['jobs'])
+        counts = {}
+        for state in job_states.values():
+            counts[state] = counts.get(state, 0) + 1
+        self.jobs_status = ", ".join("{} {}".format(count, state.lower()) for state, count in sorted(counts.items()))
+
+        if 'stats' in progress:
+            self.update_stats(progress['stats'])
+        redraw_panel()
+
+    def update_stats(self, stats):
+        """ Summarises render and transfer statistics sent by the server """
+        self.render_stats = "{:.1f} frames/h, p50 {:.1f}s, p95 {:.1f}s, {:.1f} GB".format(
+            stats['frames_per_hour'], stats['p50'], stats['p95'], stats['peak_memory'] / 1e9)
+        if stats.get('cached'):
+            self.render_stats += ", {} cached".format(stats['cached'])
+        self.transfer_stats = "up {:.1f} MB/s, down {:.1f} MB/s".format(stats['upload_mbps'], stats['download_mbps'])
+
     def connect_remote(self):
         """ Connect to a remote server """
-        if not self.server_connected:
+        if bpy.types.WindowManager.client_io is None:
             if not bpy.types.WindowManager.zmq_context:
                 bpy.types.WindowManager.zmq_context = zmq.Context()
 
             self.status_log = ""
+            # Settings are reset to the defaults of the server connected to
+            self.backend_name = ""
             self.log("Connecting to {}:{} ...".format(self.server_hostname, self.server_port))
-            bpy.types.WindowManager.socket = bpy.types.WindowManager.zmq_context.socket(zmq.DEALER)
-            bpy.types.WindowManager.socket.connect("tcp://{}:{}".format(self.server_hostname, self.server_port))
-            bpy.types.WindowManager.socket.send_string(msg.PING, zmq.NOBLOCK)
-
-            # Register timer for message polling
-            if not bpy.app.timers.is_registered(self.timer_poller):
-                bpy.app.timers.register(self.timer_poller)
+            # Socket I/O and file transfers run in a background thread, the timer handles what it receives
+            # It pings the server, then keeps the connection alive and reconnects when it drops
+            client_io = ClientIO(bpy.types.WindowManager.zmq_context,
+                                 "tcp://{}:{}".format(self.server_hostname, self.server_port),
+                                 self.user_name or getpass.getuser())
+            client_io.start()
+            bpy.types.WindowManager.client_io = client_io
+            bpy.types.WindowManager.poll_interval = MIN_TIMER_INTERVAL
+            self.reconnecting = False
+
+            # Register timer for message polling, the registered function is kept to unregister it
+            poller = bpy.types.WindowManager.poller
+            if poller is None or not bpy.app.timers.is_registered(poller):
+                bpy.types.WindowManager.poller = self.timer_poller
+                bpy.app.timers.register(bpy.types.WindowManager.poller)
             
     def init_server_config(self, config):
         """ 
             Initialise backend server configuration 
             The server sends a dictionary containing user editable fields 
+            Values edited by the user are kept when it is sent again, after reconnecting with a new session
         """
         self.log("Get backend config")
 
+        edited = {}
+        if config.get('backend') == self.backend_name:
+            edited = {item.key: (item.type, item.string, item.int, item.bool) for item in self.backend_config}
         self.backend_config.clear()
 
         for key in config.keys():
@@ -167,6 +304,9 @@ class RemoteRender(bpy.types.PropertyGroup):
             self.backend_config[-1].key = key
             self.backend_config[-1].label = config[key]['label']
             self.backend_config[-1].type = config[key]['type']
+            if key in edited and edited[key][0] == config[key]['type']:
+                _, self.backend_config[-1].string, self.backend_config[-1].int, self.backend_config[-1].bool = edited[key]
+                continue
             match config[key]['type']:
                 case "string":
                     self.backend_config[-1].string = config[key]['default']
@@ -177,72 +317,222 @@ class RemoteRender(bpy.types.PropertyGroup):
 
 
     def close_remote(self):
-        """ Close remote connection """
-        if self.server_connected:
+        """ Close remote connection, also stops reconnection attempts """
+        if bpy.types.WindowManager.client_io is not None:
             self.log("Disconnecting...")
             self.server_connected = False
-            bpy.types.WindowManager.socket.send_string(msg.CLOSE_CONNECTION)
+            self.reconnecting = False
+            self.send_strings([msg.CLOSE_CONNECTION])
 
-            # Unregister message poller
-            if bpy.app.timers.is_registered(self.timer_poller):
-                bpy.app.timers.unregister(self.timer_poller)
+            stop_polling()
 
-            bpy.types.WindowManager.socket.close()
+            # Messages already queued, such as the one above, are sent before the socket is closed
+            bpy.types.WindowManager.client_io.stop()
+            bpy.types.WindowManager.client_io = None
             self.log("Disconnected")
 
     def send_strings(self, string_list):
-        """ Sends a list of strings as a multipart message """
-        for string in string_list[:-1]:
-            bpy.types.WindowManager.socket.send_string(string, zmq.SNDMORE)
-        bpy.types.WindowManager.socket.send_string(string_list[-1])
-
-    def send_file(self, path):
-        """ Send file to remote server """
-        bpy.types.WindowManager.socket.send_string(msg.FILE, zmq.SNDMORE)
-        bpy.types.WindowManager.socket.send_string(path, zmq.SNDMORE)
-        with open(path, 'rb') as f:
-            bpy.types.WindowManager.socket.send(f.read())
+        """ Queues a list of strings (or bytes) to send as a multipart message by the I/O thread """
+        bpy.types.WindowManager.client_io.send(string_list)
+
+    def send_file(self, path, remote_path=None, digest=None):
+        """
+            Start chunked upload of a file to remote server
+            The file is hashed and sent by the I/O thread, the render starts once every upload is acknowledged
+        """
+        remote_path = remote_path or path
+        mode = "delta" if self.delta_upload else "full"
+        bpy.types.WindowManager.pending_uploads.add(remote_path)
+        client_io = bpy.types.WindowManager.client_io
+        client_io.call(client_io.start_upload, path, remote_path, digest, mode)
         self.log("Sending file...")
 
+    def cancel_transfers(self):
+        """ Stops uploads and downloads in progress, a render waiting for its uploads is not started """
+        client_io = bpy.types.WindowManager.client_io
+        client_io.call(client_io.cancel_transfers)
+        bpy.types.WindowManager.pending_uploads.clear()
+        bpy.types.WindowManager.pending_assets = False
+        bpy.types.WindowManager.pending_render = None
+        self.log("Transfers cancelled")
+
+    def transfer_progress(self):
+        """ (done, total) bytes of the uploads and of the downloads in progress """
+        client_io = bpy.types.WindowManager.client_io
+        if client_io is None:
+            return (0, 0), (0, 0)
+        return client_io.progress()
+
     def send_backend_config(self, config):
         """ Helper function to send the user edited backend configuration """
-        bpy.types.WindowManager.socket.send_string(msg.BACKEND_CONFIG, zmq.SNDMORE)
-        bpy.types.WindowManager.socket.send_json(config)
- 
-    def save_file(self, path, file):
-        """ Saves file to disk """
-        path = Path(path)
-        os.mkdirs(path.parent, exist_ok=True)
-        with open(path, "wb") as f:
-            f.write(file)
+        self.send_strings([msg.BACKEND_CONFIG, json.dumps(config)])
 
-    def timer_poller(self):
-        """ Timer receiving and acting on zmq received messages """
-        try:
-            message = bpy.types.WindowManager.socket.recv_multipart(zmq.NOBLOCK)
-        except zmq.Again as e: # Error raised when no message is in the queue
-            return 0.1
+    def local_path(self, path):
+        """ Local path of a file downloaded from the server, always inside the download directory """
+        download_dir = Path(bpy.path.abspath(self.download_dir)).resolve()
+        local_path = (download_dir / path).resolve()
+        if download_dir not in local_path.parents:
+            raise ValueError("Invalid download path {}".format(path))
+        return str(local_path)
+
+    def request_output(self, header, *args):
+        """
+            Asks for the frames of the last render, with the manifest of the ones already downloaded
+            The manifest is built on the I/O worker thread, hashing large outputs would freeze the UI
+        """
+        client_io = bpy.types.WindowManager.client_io
+        client_io.in_background(send_output_request, client_io, header, self.render_export_dir,
+                                self.local_path(self.render_export_dir), list(args))
 
-        header = message[0].decode("utf-8")
+    def open_download(self, path, size, digest):
+        """ Starts or resumes download of a file sent by the server, chunks are written by the I/O thread """
+        client_io = bpy.types.WindowManager.client_io
+        client_io.call(client_io.open_download, path, self.local_path(path), size, digest)
 
+    def download_done(self, path, local_path):
+        self.log("Received {}".format(os.path.basename(path)))
+        if os.path.basename(path).startswith("preview_"):
+            self.load_preview(local_path)
+
+    def load_preview(self, path):
+        """
+            Adds a received preview to the image sequence of its render, so that the shot can be
+            scrubbed in the image editor while it renders
+        """
+        name = "{} previews".format(os.path.basename(os.path.dirname(path)))
+        image = bpy.data.images.get(name)
+        if image is None:
+            image = bpy.data.images.load(path)
+            image.name = name
+            image.source = 'SEQUENCE'
+        else:
+            # Frames added to the sequence since it was loaded are found on reload
+            image.reload()
+        redraw_panel()
+
+    def timer_poller(self):
+        """
+            Timer acting on the messages received by the I/O thread, all the pending ones are handled at each tick
+            The timer runs often while messages come in or files are transferred, and backs off when idle
+        """
+        client_io = bpy.types.WindowManager.client_io
+        if client_io is None:
+            return None
+
+        events = client_io.drain()
+        for header, args in events:
+            self.handle_message(header, args)
+
+        (uploaded, upload_size), (downloaded, download_size) = client_io.progress()
+        if upload_size or download_size:
+            # Progress bars follow the transfers
+            redraw_panel()
+        if events or upload_size or download_size:
+            bpy.types.WindowManager.poll_interval = MIN_TIMER_INTERVAL
+        else:
+            bpy.types.WindowManager.poll_interval = min(bpy.types.WindowManager.poll_interval * 2, MAX_TIMER_INTERVAL)
+        return bpy.types.WindowManager.poll_interval
+
+    def handle_message(self, header, args):
+        """ Handles a message of the server, or an event of the I/O thread """
         match header:
             case msg.PONG:
-                self.log("Connected")
+                codec = args[0].decode("utf-8") if args else "none"
+                resumed = len(args) > 2 and args[2].decode("utf-8") == "resumed"
+                if not self.reconnecting:
+                    self.log("Connected, {} compression".format(codec))
+                elif resumed:
+                    self.log("Reconnected, session resumed")
+                else:
+                    # The server lost the session, after a restart or a long disconnection, frames are streamed again
+                    self.log("Reconnected, new session")
+                    if self.render_export_dir and self.stream_renders:
+                        self.request_output(msg.STREAM_RENDER_OUTPUT, "full" if self.stream_full_frames else "previews")
+                self.reconnecting = False
                 self.server_connected = True
+            case ClientIO.DISCONNECTED:
+                self.log("Connection lost, reconnecting...")
+                self.server_connected = False
+                self.reconnecting = True
+                redraw_panel()
             case msg.FILE_ACK:
                 self.log("File sent")
+                bpy.types.WindowManager.pending_uploads.discard(args[0].decode("utf-8"))
+                self.start_pending_render()
+            case msg.FILE_OPEN:
+                # Download of a file from the server
+                self.open_download(args[0].decode("utf-8"), int(args[1]), args[2].decode("utf-8"))
+            case msg.RENDER_STARTED:
+                self.render_export_dir = args[0].decode("utf-8")
+                bpy.types.WindowManager.job_states = {}
+                self.render_status = "Submitted"
+                self.frames_done = 0
+                self.frames_total = 0
+                self.jobs_status = ""
+                self.render_stats = ""
+                self.log("Render started")
+                # Statistics of the previous renders of the project until frames of this one come in
+                self.send_strings([msg.STATS, os.path.dirname(self.render_export_dir)])
+                if self.stream_renders:
+                    self.request_output(msg.STREAM_RENDER_OUTPUT, "full" if self.stream_full_frames else "previews")
+            case msg.PROGRESS:
+                self.update_progress(json.loads(args[0]))
+            case msg.STATS:
+                self.update_stats(json.loads(args[1]))
+                redraw_panel()
+            case msg.ASSET_MISSING:
+                self.upload_missing_assets(json.loads(args[1]))
+            case msg.FILE_ERROR:
+                path = args[0].decode("utf-8")
+                self.log("Error sending {}: {}".format(path, args[1].decode("utf-8")))
+                bpy.types.WindowManager.pending_uploads.discard(path)
+                bpy.types.WindowManager.pending_render = None
             case msg.BACKEND_CONFIG:
                 # Reception of the backend configuration
-                self.init_server_config(json.loads(message[1]))
-            case msg.FILE:
-                # Getting file
-                path = message[1]
-                self.get_file(path, message[2])
-                if path.endswith('png'):
-                    bpy.ops.image.open(path)
+                self.init_server_config(json.loads(args[0]))
+            case ClientIO.LOG:
+                self.log(args[0])
+            case ClientIO.DOWNLOAD_DONE:
+                self.download_done(*args)
+            case ClientIO.DOWNLOAD_FAILED:
+                self.log("Error receiving {}".format(args[0]))
             case _:
                 self.log("Command not recognised: {}".format(header))
 
-        return 0.1
+
+def stop_polling():
+    """ Unregisters the timer handling the messages received by the I/O thread """
+    poller = bpy.types.WindowManager.poller
+    if poller is not None and bpy.app.timers.is_registered(poller):
+        bpy.app.timers.unregister(poller)
+    bpy.types.WindowManager.poller = None
+
+
+def output_manifest(directory):
+    """
+        Name, size and digest of the frames of a render already downloaded
+        The server only sends frames missing from it, or changed since. Partially downloaded
+        frames are not listed, their download resumes from the .part file
+    """
+    if not os.path.isdir(directory):
+        return []
+
+    manifest = []
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        if filename.endswith((".part", ".part.info")) or not os.path.isfile(path):
+            continue
+        manifest.append({'name': filename, 'size': os.path.getsize(path), 'digest': get_digest(path)})
+    return manifest
+
+
+def send_output_request(client_io, header, export_dir, directory, args):
+    """ Runs on the I/O worker thread: lists the frames already downloaded and sends the request """
+    client_io.send([header, export_dir, json.dumps(output_manifest(directory))] + args)
 
 
+def send_asset_manifest(client_io, blend_file, assets):
+    """ Runs on the I/O worker thread: hashes the assets of a project and sends their manifest """
+    digest_assets(assets)
+    manifest = [{key: asset[key] for key in ('type', 'name', 'filename', 'size', 'digest')} for asset in assets]
+    client_io.send([msg.ASSET_MANIFEST, blend_file, json.dumps(manifest)])
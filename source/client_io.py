@@ -0,0 +1,341 @@
+import json
+import time
+import queue
+import itertools
+import threading
+import zmq
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from .messages import msg
+from .transfer import FileSender, FileReceiver, Compressor, CODECS, decompress, compute_delta, literal_ranges
+from .assets import set_digest
+
+# Time the I/O thread waits for incoming messages before sending the queued ones, in milliseconds
+POLL_TIMEOUT = 10
+# Interval of the main thread timer, shortest while messages come in and backing off when the connection is idle
+MIN_TIMER_INTERVAL = 0.01
+MAX_TIMER_INTERVAL = 0.5
+# Time given to queued messages to be sent when closing the connection, in milliseconds
+CLOSE_LINGER = 1000
+# Heartbeats are sent every HEARTBEAT_INTERVAL seconds, the connection is lost when the server stays
+# silent for HEARTBEAT_TIMEOUT seconds
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 15
+# Seconds waited for an answer to the first reconnection attempt, doubled at each failed attempt
+RECONNECT_MIN = 2
+RECONNECT_MAX = 60
+
+
+class ClientIO(threading.Thread):
+    """
+        Background thread owning the connection to the server.
+        ØMQ sockets are not thread safe, only this thread uses the socket: messages sent by the main
+        thread are queued, received ones are handed back through a queue drained by a Blender timer.
+        File transfers are handled here from start to end, chunks are read, compressed, written and
+        acknowledged without going through the main thread, so that they never block the UI.
+        Files are hashed and deltas computed on a worker thread, so that heartbeats keep going during
+        long computations; results are handed back to this thread in order with the queued messages.
+        The connection is kept alive with heartbeats. When the server goes silent, such as behind a
+        dropped ssh tunnel or after the laptop slept, the socket is replaced with backoff until the
+        server answers: the session token is sent with the ping, the server then resumes the session
+        and transfers continue from where they were. Messages are held while disconnected, requests
+        changing server state that were sent but not acknowledged are sent again once reconnected.
+    """
+    # Events posted for the main thread, next to the messages of the server
+    LOG = "log"
+    DISCONNECTED = "disconnected"
+    DOWNLOAD_DONE = "download_done"
+    DOWNLOAD_FAILED = "download_failed"
+
+    def __init__(self, context, address, user):
+        super().__init__(name="remote-render-io", daemon=True)
+        self.context = context
+        self.address = address
+        self.user = user
+        # Session token given by the server at the first pong
+        self.token = ""
+        # Set from the pong of the server until it stays silent for too long
+        self.connected = False
+        self.backoff = RECONNECT_MIN
+        self.last_ping = self.last_received = self.last_heartbeat = time.monotonic()
+        # Messages to send, or functions to run on this thread in order with them
+        self.outgoing = queue.Queue()
+        # (header, args) of messages and events for the main thread
+        self.events = queue.Queue()
+        self.request_ids = itertools.count(1)
+        # Acknowledged requests sent but not done yet, by request id, they may be lost with the socket
+        self.unacked = {}
+        self.stopping = threading.Event()
+
+        # Only used on this thread, the main thread reads their progress
+        self.compressor = Compressor()
+        self.uploads = {}
+        self.downloads = {}
+        # Remote paths of the uploads whose file is being hashed by the worker
+        self.hashing = set()
+        self.worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="remote-render-hash")
+
+        # Messages handled on this thread, the ones returning True are also passed to the main thread
+        self.handlers = {msg.PONG: self.on_pong,
+                         msg.FILE_RESUME: self.on_file_resume,
+                         msg.FILE_SIGNATURES: self.on_file_signatures,
+                         msg.FILE_CHUNK_ACK: self.on_file_chunk_ack,
+                         msg.FILE_ACK: self.on_file_ack,
+                         msg.FILE_ERROR: self.on_file_error,
+                         msg.FILE_CHUNK: self.on_file_chunk,
+                         # Only keeps the connection alive
+                         msg.HEARTBEAT: lambda args: False}
+
+    def send(self, string_list):
+        """
+            Queues a list of strings (or bytes) to send as a multipart message, from any thread
+            A new request id is inserted after the header, the server sends it back with its replies
+        """
+        self.outgoing.put(self.encode(string_list))
+
+    def encode(self, string_list):
+        frames = [string_list[0], str(next(self.request_ids))] + string_list[1:]
+        return [frame.encode("utf-8") if isinstance(frame, str) else frame for frame in frames]
+
+    def call(self, function, *args):
+        """ Runs a function on the I/O thread, once the messages queued before are sent """
+        self.outgoing.put(partial(function, *args))
+
+    def post(self, header, *args):
+        self.events.put((header, list(args)))
+
+    def drain(self):
+        """ Returns the messages and events received since the previous call """
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def stop(self):
+        """ Closes the connection once the messages already queued are sent """
+        self.stopping.set()
+        self.join()
+
+    def run(self):
+        socket = self.open_socket()
+        while not self.stopping.is_set():
+            if self.connected:
+                self.flush(socket)
+            if socket.poll(POLL_TIMEOUT, zmq.POLLIN):
+                while True:
+                    try:
+                        message = socket.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    self.last_received = time.monotonic()
+                    self.safe_run(self.dispatch, message)
+            socket = self.keep_alive(socket)
+        if self.connected:
+            self.flush(socket)
+        socket.close()
+        self.worker.shutdown(wait=False, cancel_futures=True)
+
+    def open_socket(self):
+        """ Connects a new socket and pings the server, with the session token when reconnecting """
+        socket = self.context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, CLOSE_LINGER)
+        socket.connect(self.address)
+        # Sent before anything else, the server finds the session of the new socket from it
+        socket.send_multipart(self.encode([msg.PING, self.user, ",".join(CODECS), self.token]))
+        self.last_ping = time.monotonic()
+        return socket
+
+    def keep_alive(self, socket):
+        """ Sends heartbeats, and replaces the socket when the server does not answer, returns the socket to use """
+        now = time.monotonic()
+        if self.connected and now - self.last_received > HEARTBEAT_TIMEOUT:
+            self.connected = False
+            self.post(self.DISCONNECTED)
+        if not self.connected:
+            if now - self.last_ping > self.backoff and now - self.last_received > self.backoff:
+                # Messages still queued in the old socket are dropped, transfers are announced again on reconnection
+                socket.close(linger=0)
+                self.backoff = min(self.backoff * 2, RECONNECT_MAX)
+                return self.open_socket()
+        elif now - self.last_heartbeat > HEARTBEAT_INTERVAL:
+            self.send([msg.HEARTBEAT])
+            self.last_heartbeat = now
+        return socket
+
+    def flush(self, socket):
+        """ Sends queued messages and runs queued functions, only while connected """
+        while self.connected:
+            try:
+                item = self.outgoing.get_nowait()
+            except queue.Empty:
+                return
+            if callable(item):
+                self.safe_run(item)
+            else:
+                socket.send_multipart(item)
+                if item[0].decode("utf-8") in msg.ACKNOWLEDGED:
+                    self.unacked[item[1]] = item
+
+    def safe_run(self, function, *args):
+        """ Errors are reported to the main thread without stopping the connection """
+        try:
+            function(*args)
+        except Exception as e:
+            self.post(self.LOG, "Error: {!r}".format(e))
+
+    def in_background(self, function, *args):
+        """ Runs a long function on the worker thread, it hands its result back with call """
+        self.worker.submit(self.safe_run, function, *args)
+
+    def dispatch(self, message):
+        header = message[0].decode("utf-8")
+        if header == msg.REQUEST_DONE:
+            self.unacked.pop(message[1], None)
+            return
+        args = message[2:]
+        handler = self.handlers.get(header)
+        if handler is None or handler(args):
+            self.events.put((header, args))
+
+    def progress(self):
+        """ Bytes done and total of the uploads and of the downloads in progress """
+        uploads = list(self.uploads.values())
+        downloads = list(self.downloads.values())
+        return ((sum(sender.acked for sender in uploads), sum(sender.size for sender in uploads)),
+                (sum(receiver.received for receiver in downloads), sum(receiver.size for receiver in downloads)))
+
+    # Uploads
+
+    def start_upload(self, path, remote_path, digest, mode):
+        """
+            Start chunked upload of a file to remote server
+            The content digest is sent first, the server answers straight away if it already has the file,
+            otherwise with the offset to start from and chunks are then sent as credits come back
+        """
+        self.hashing.add(remote_path)
+        self.in_background(self.hash_upload, path, remote_path, digest, mode)
+
+    def hash_upload(self, path, remote_path, digest, mode):
+        """ Worker thread part of start_upload, hashes the file when its digest is not given """
+        sender = FileSender(path, remote_path, digest)
+        sender.mode = mode
+        self.call(self.add_upload, sender)
+
+    def add_upload(self, sender):
+        """ Announces an upload once its file is hashed, unless transfers were cancelled meanwhile """
+        if sender.remote_path not in self.hashing:
+            return
+        self.hashing.discard(sender.remote_path)
+        self.uploads[sender.remote_path] = sender
+        self.open_upload(sender)
+
+    def open_upload(self, sender):
+        """ Announces an upload to the server """
+        self.send([msg.FILE_OPEN, sender.remote_path, str(sender.size), sender.digest, sender.mode])
+
+    def send_chunks(self, sender):
+        """ Sends as many chunks as the flow control window allows """
+        for offset, data in sender.next_chunks():
+            codec, payload = self.compressor.compress((sender.remote_path, offset + len(data)), data)
+            self.send([msg.FILE_CHUNK, sender.remote_path, str(offset), payload, codec])
+
+    def on_pong(self, args):
+        codec = args[0].decode("utf-8") if args else "none"
+        self.compressor = Compressor(codec)
+        if len(args) > 1:
+            self.token = args[1].decode("utf-8")
+        self.connected = True
+        self.backoff = RECONNECT_MIN
+        # Resume uploads interrupted by a disconnection, and requests whose answer may have been lost
+        for sender in self.uploads.values():
+            self.open_upload(sender)
+        for item in list(self.unacked.values()):
+            self.outgoing.put(item)
+        return True
+
+    def on_file_resume(self, args):
+        sender = self.uploads.get(args[0].decode("utf-8"))
+        if sender:
+            sender.start(int(args[1]))
+            self.send_chunks(sender)
+
+    def on_file_signatures(self, args):
+        """ Sends blocks reused from the server copy of the file, then the remaining ranges """
+        sender = self.uploads.get(args[0].decode("utf-8"))
+        if sender is None:
+            return
+        self.in_background(self.find_delta, sender, int(args[1]), args[2])
+
+    def find_delta(self, sender, block_size, signatures):
+        """ Worker thread part of on_file_signatures """
+        copies = compute_delta(sender.path, block_size, signatures) or []
+        self.call(self.send_delta, sender, copies)
+
+    def send_delta(self, sender, copies):
+        if self.uploads.get(sender.remote_path) is not sender:
+            return
+        self.send([msg.FILE_DELTA, sender.remote_path, json.dumps(copies)])
+        sender.send_ranges(literal_ranges(sender.size, copies))
+        self.post(self.LOG, "Delta upload, {} bytes to send".format(sender.size - sender.acked))
+        self.send_chunks(sender)
+
+    def on_file_chunk_ack(self, args):
+        sender = self.uploads.get(args[0].decode("utf-8"))
+        if sender:
+            sender.ack(int(args[1]))
+            self.compressor.ack((sender.remote_path, int(args[1])))
+            self.send_chunks(sender)
+
+    def on_file_ack(self, args):
+        self.uploads.pop(args[0].decode("utf-8"), None)
+        return True
+
+    def on_file_error(self, args):
+        self.uploads.pop(args[0].decode("utf-8"), None)
+        return True
+
+    # Downloads
+
+    def open_download(self, path, local_path, size, digest):
+        """ Starts or resumes download of a file sent by the server """
+        receiver = FileReceiver(local_path, size, digest)
+        if receiver.complete():
+            self.finalize_download(path, receiver)
+            return
+        self.downloads[path] = receiver
+        self.send([msg.FILE_RESUME, path, str(receiver.received)])
+
+    def on_file_chunk(self, args):
+        """ Writes downloaded chunk to disk and acknowledges it """
+        path = args[0].decode("utf-8")
+        receiver = self.downloads.get(path)
+        if receiver is None:
+            return
+        codec = args[3].decode("utf-8") if len(args) > 3 else "none"
+        acked = receiver.write(int(args[1]), decompress(codec, args[2]))
+        self.send([msg.FILE_CHUNK_ACK, path, str(acked)])
+        if receiver.complete():
+            del self.downloads[path]
+            self.finalize_download(path, receiver)
+
+    def finalize_download(self, path, receiver):
+        if receiver.finalize():
+            # Frames are not hashed again when building the next output manifest
+            set_digest(receiver.path, receiver.digest)
+            self.send([msg.FILE_ACK, path])
+            self.post(self.DOWNLOAD_DONE, path, receiver.path)
+        else:
+            self.send([msg.FILE_ERROR, path, "Digest mismatch"])
+            self.post(self.DOWNLOAD_FAILED, path)
+
+    def cancel_transfers(self):
+        """
+            Drops uploads and downloads in progress, the server stops sending queued and streamed files
+            Partial files are kept, a later transfer of the same content resumes from them
+        """
+        self.uploads.clear()
+        self.hashing.clear()
+        self.downloads.clear()
+        self.send([msg.CANCEL_TRANSFERS])
@@ -9,10 +9,43 @@ class Messages():
         self.PING = "ping"
         self.PONG = "pong"
         self.CLOSE_CONNECTION = "close_connection"
+        self.HEARTBEAT = "heartbeat"
         self.FILE = "file"
         self.FILE_ACK = "file_ack"
+        self.FILE_OPEN = "file_open"
+        self.FILE_RESUME = "file_resume"
+        self.FILE_CHUNK = "file_chunk"
+        self.FILE_CHUNK_ACK = "file_chunk_ack"
+        self.FILE_ERROR = "file_error"
+        self.FILE_SIGNATURES = "file_signatures"
+        self.FILE_DELTA = "file_delta"
+        self.CANCEL_TRANSFERS = "cancel_transfers"
+        self.ASSET_MANIFEST = "asset_manifest"
+        self.ASSET_MISSING = "asset_missing"
         self.BACKEND_CONFIG = "backend_config"
         self.START_RENDER = "start_render"
         self.GET_RENDER_OUTPUT = "get_render_output"
+        self.STREAM_RENDER_OUTPUT = "stream_render_output"
+        self.RENDER_STARTED = "render_started"
+        self.CANCEL_RENDER = "cancel_render"
+        self.RESIZE_RENDER = "resize_render"
+        self.REQUEUE_RENDER = "requeue_render"
+        self.PROGRESS = "progress"
+        self.STATS = "stats"
+        self.REQUEST_DONE = "request_done"
+
+        # Requests changing server state, clients send them again after reconnecting until they get
+        # REQUEST_DONE, the server replays its replies to the ones it already handled
+        self.ACKNOWLEDGED = (self.ASSET_MANIFEST, self.START_RENDER, self.CANCEL_RENDER)
+
+        # Render jobs to frame dispatcher
+        self.LEASE_REQUEST = "lease_request"
+        self.LEASE = "lease"
+        self.LEASE_WAIT = "lease_wait"
+        self.LEASE_HEARTBEAT = "lease_heartbeat"
+        self.LEASE_RELEASE = "lease_release"
+        self.NO_WORK = "no_work"
+        self.FRAME_DONE = "frame_done"
+        self.WORK_REQUEST = "work_request"
 
 msg = Messages()
@@ -1,5 +1,5 @@
 import bpy
-from .client_core import RemoteRenderFrame, RemoteRenderAnim, RemoteRender, RemoteClose, RemoteConnect
+from .client_core import RemoteRenderFrame, RemoteRenderAnim, RemoteCancelRender, RemoteCancelTransfers, RemoteRetrieveRenders, RemoteRender, RemoteClose, RemoteConnect
 
 
 class RemoteRenderUI(bpy.types.Panel):
@@ -25,8 +25,9 @@ class RemoteRenderUI(bpy.types.Panel):
         if panel:
             panel.prop(rr, "server_hostname")
             panel.prop(rr, "server_port")
+            panel.prop(rr, "user_name")
             row = panel.row(align=True)
-            if rr.server_connected:
+            if rr.server_connected or rr.reconnecting:
                 row.operator("remote.close", text="Disconnect", icon='INTERNET')
                 row.enabled = True
             else:
@@ -48,6 +49,14 @@ class RemoteRenderUI(bpy.types.Panel):
             row.prop(scene, "frame_start")
             row.prop(scene, "frame_end")
 
+            panel.prop(rr, "tile_grid")
+            panel.prop(rr, "delta_upload")
+            panel.prop(rr, "download_dir")
+            panel.prop(rr, "stream_renders")
+            row = panel.row()
+            row.prop(rr, "stream_full_frames")
+            row.enabled = rr.stream_renders
+
             row = panel.row(align=True)
             row.operator("remote.render_frame", icon='RENDER_STILL')
             row.enabled = rr.server_connected
@@ -56,6 +65,14 @@ class RemoteRenderUI(bpy.types.Panel):
             row.operator("remote.render_anim", icon='RENDER_ANIMATION')
             row.enabled = rr.server_connected
 
+            row = panel.row(align=True)
+            row.operator("remote.cancel_render", icon='CANCEL')
+            row.enabled = rr.server_connected and bool(rr.render_export_dir)
+
+            row = panel.row(align=True)
+            row.operator("remote.retrieve_renders", icon='IMPORT')
+            row.enabled = rr.server_connected and bool(rr.render_export_dir)
+
         # # Status table
         # header, panel = layout.panel("Status")
         # header.label(text="Status")
@@ -67,6 +84,28 @@ class RemoteRenderUI(bpy.types.Panel):
         header, panel = layout.panel("Status")
         header.label(text="Status")
         if panel:
+            if rr.render_status:
+                panel.label(text="Render: {}".format(rr.render_status))
+            if rr.frames_total:
+                panel.progress(factor=rr.frames_done / rr.frames_total,
+                               text="{}/{} frames".format(rr.frames_done, rr.frames_total))
+            if rr.jobs_status:
+                panel.label(text="Jobs: {}".format(rr.jobs_status))
+            if rr.render_stats:
+                panel.label(text="Frames: {}".format(rr.render_stats))
+                panel.label(text="Transfers: {}".format(rr.transfer_stats))
+
+            # Transfers in progress, updated by the I/O thread
+            (uploaded, upload_size), (downloaded, download_size) = rr.transfer_progress()
+            if upload_size:
+                panel.progress(factor=uploaded / upload_size,
+                               text="Upload {:.1f}/{:.1f} MB".format(uploaded / 1e6, upload_size / 1e6))
+            if download_size:
+                panel.progress(factor=downloaded / download_size,
+                               text="Download {:.1f}/{:.1f} MB".format(downloaded / 1e6, download_size / 1e6))
+            if upload_size or download_size:
+                panel.operator("remote.cancel_transfers", icon='CANCEL')
+
             box = panel.box()
             logs = rr.status_log.split(";")[-5:]
             for line in logs:
@@ -0,0 +1,382 @@
+import os
+import mmap
+import math
+import time
+import zlib
+import struct
+import hashlib
+from collections import deque
+
+# zstd and lz4 are used for transfers when available, zlib otherwise
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+    zstd = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Size of a single file chunk sent over the socket
+CHUNK_SIZE = 1024 * 1024
+# Maximum number of chunks sent but not yet acknowledged by the receiver
+WINDOW = 8
+# Modulo of the adler32 weak checksum used for delta transfers
+ADLER_MOD = 65521
+# Packed signature of a block: weak checksum and strong checksum
+SIGNATURE = struct.Struct("<I16s")
+# Above this many unmatched bytes a delta is given up for a full transfer, rolling the checksum is slow in Python
+MAX_DELTA_LITERAL = 16 * 1024 * 1024
+# Chunks are sent as they are when a sample of their start does not shrink below this ratio, like PNG or JPEG data
+INCOMPRESSIBLE_RATIO = 0.95
+COMPRESSION_SAMPLE = 64 * 1024
+# The compression level goes up when sending a chunk takes this many times longer than compressing it
+LEVEL_UP_MARGIN = 2
+# Link throughput is measured on the chunks acknowledged over the last seconds
+RATE_WINDOW = 5
+
+
+def available_codecs():
+    """
+        Compression codecs available on this side, by order of preference
+        Each codec is (compress(data, level), decompress(data), levels from fastest to smallest output)
+    """
+    available = {}
+    if zstd:
+        available['zstd'] = (lambda data, level: zstd.compress(data, level), zstd.decompress, (1, 3, 6, 9, 15, 19))
+    elif zstandard:
+        available['zstd'] = (lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+                             lambda data: zstandard.ZstdDecompressor().decompress(data), (1, 3, 6, 9, 15, 19))
+    if lz4:
+        available['lz4'] = (lambda data, level: lz4.frame.compress(data, compression_level=level), lz4.frame.decompress, (0, 3, 9, 12))
+    available['zlib'] = (zlib.compress, zlib.decompress, (1, 3, 6, 9))
+    return available
+
+
+CODECS = available_codecs()
+
+
+def negotiate_codec(offered):
+    """ First codec of this side also offered by the other one, "none" if there is no common codec """
+    return next((codec for codec in CODECS if codec in offered), "none")
+
+
+def decompress(codec, data):
+    if codec == "none":
+        return data
+    return CODECS[codec][1](data)
+
+
+class Compressor():
+    """
+        Compresses file chunks sent over a connection with the codec negotiated when connecting.
+        The level follows the link: it goes up while sending a chunk takes much longer than compressing
+        it, and down when compression becomes the bottleneck. Chunks that do not compress, such as
+        PNG frames or compressed Blender files, are sent as they are.
+    """
+    def __init__(self, codec="none"):
+        self.codec = codec
+        self.compress_data, _, self.levels = CODECS.get(codec, (None, None, ()))
+        # Starts with a fast level until the link throughput is known
+        self.level = min(1, len(self.levels) - 1)
+        # Compressed size of chunks not yet acknowledged, and (time, size) of acknowledged ones
+        self.in_flight = {}
+        self.acked = deque()
+
+    def compress(self, key, data):
+        """ Returns the codec used for the chunk, "none" if sent as is, and the data to send """
+        payload, codec = data, "none"
+        if self.compress_data and self.compressible(data):
+            start = time.perf_counter()
+            compressed = self.compress_data(data, self.levels[self.level])
+            if len(compressed) < len(data):
+                payload, codec = compressed, self.codec
+                self.adapt(time.perf_counter() - start, len(compressed))
+        self.in_flight[key] = len(payload)
+        return codec, payload
+
+    def compressible(self, data):
+        sample = data[:COMPRESSION_SAMPLE]
+        return len(zlib.compress(sample, 1)) < len(sample) * INCOMPRESSIBLE_RATIO
+
+    def adapt(self, compress_time, size):
+        rate = self.link_rate()
+        if rate is None:
+            return
+        send_time = size / rate
+        if compress_time > send_time and self.level > 0:
+            self.level -= 1
+        elif compress_time * LEVEL_UP_MARGIN < send_time and self.level < len(self.levels) - 1:
+            self.level += 1
+
+    def ack(self, key):
+        """ Records the acknowledgement of a chunk, for link throughput measurement """
+        size = self.in_flight.pop(key, None)
+        if size is not None:
+            self.acked.append((time.monotonic(), size))
+
+    def link_rate(self):
+        """ Bytes per second acknowledged over the last RATE_WINDOW seconds, None until measured """
+        now = time.monotonic()
+        while self.acked and self.acked[0][0] < now - RATE_WINDOW:
+            self.acked.popleft()
+        if len(self.acked) < 2 or self.acked[-1][0] == self.acked[0][0]:
+            return None
+        return sum(size for _, size in list(self.acked)[1:]) / (self.acked[-1][0] - self.acked[0][0])
+
+
+def digest_file(path, chunk_size=CHUNK_SIZE):
+    """ Content hash of a file, read chunk by chunk """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while data := f.read(chunk_size):
+            h.update(data)
+    return h.hexdigest()
+
+
+class FileSender():
+    """
+        Reads a file chunk by chunk with credit based flow control.
+        A chunk is only read from disk when a credit is available, credits are given back
+        when the receiver acknowledges a chunk, so memory usage does not depend on file size.
+    """
+    def __init__(self, path, remote_path, digest=None, chunk_size=CHUNK_SIZE, window=WINDOW):
+        self.path = path
+        self.remote_path = remote_path
+        self.size = os.path.getsize(path)
+        self.digest = digest or digest_file(path)
+        self.chunk_size = chunk_size
+        self.window = window
+
+        self.ranges = []
+        self.acked = 0
+        # Length of chunks not yet acknowledged, indexed by their end offset
+        self.in_flight = {}
+        # Bytes actually sent, for transfer rate statistics
+        self.started = time.monotonic()
+        self.transferred = 0
+
+    def start(self, offset):
+        """ (Re)starts the transfer from the offset acknowledged by the receiver """
+        self.send_ranges([(offset, self.size - offset)])
+
+    def send_ranges(self, ranges):
+        """ Restricts the transfer to (offset, length) ranges, the rest of the file is already on the other side """
+        self.ranges = [[offset, length] for offset, length in ranges if length > 0]
+        self.acked = self.size - sum(length for _, length in self.ranges)
+        self.in_flight = {}
+
+    def next_chunks(self):
+        """ Yields (offset, data) for as many chunks as the credits allow """
+        if len(self.in_flight) >= self.window or not self.ranges:
+            return
+        with open(self.path, 'rb') as f:
+            while len(self.in_flight) < self.window and self.ranges:
+                offset, length = self.ranges[0]
+                f.seek(offset)
+                data = f.read(min(self.chunk_size, length))
+                if not data:
+                    break
+                if len(data) < length:
+                    self.ranges[0] = [offset + len(data), length - len(data)]
+                else:
+                    self.ranges.pop(0)
+                self.in_flight[offset + len(data)] = len(data)
+                yield offset, data
+
+    def ack(self, offset):
+        """ Gives back a credit for the chunk ending at offset """
+        length = self.in_flight.pop(offset, 0)
+        self.acked += length
+        self.transferred += length
+
+    def done(self):
+        return self.acked >= self.size
+
+    def progress(self):
+        return self.acked / self.size if self.size else 1.0
+
+
+class FileReceiver():
+    """
+        Writes incoming chunks directly to disk at their offset.
+        Data is written to a .part file that is renamed once complete, an interrupted transfer of
+        the same content resumes from the last acknowledged offset.
+        In delta mode the .part file is first filled with blocks of the previous version and
+        only the remaining ranges are received.
+    """
+    def __init__(self, path, size, digest):
+        self.path = path
+        self.part_path = path + ".part"
+        self.info_path = path + ".part.info"
+        self.size = size
+        self.digest = digest
+        # Bytes actually received, for transfer rate statistics
+        self.started = time.monotonic()
+        self.transferred = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.received = 0
+        if os.path.isfile(self.part_path) and self.read_digest() == digest:
+            self.received = min(os.path.getsize(self.part_path), size)
+        else:
+            with open(self.part_path, 'wb'):
+                pass
+            with open(self.info_path, 'w') as f:
+                f.write(digest)
+
+    def read_digest(self):
+        try:
+            with open(self.info_path, 'r') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def apply_delta(self, basis, copies):
+        """ Fills .part file with blocks copied from the previous version of the file """
+        apply_copies(basis, self.part_path, self.size, copies)
+        self.received = sum(length for _, length, _ in copies)
+        # A partially received delta cannot be resumed from the .part file size
+        with open(self.info_path, 'w'):
+            pass
+
+    def write(self, offset, data):
+        """ Writes chunk to disk, returns the end offset used to acknowledge it """
+        with open(self.part_path, 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+        self.received += len(data)
+        self.transferred += len(data)
+        return offset + len(data)
+
+    def complete(self):
+        return self.received >= self.size
+
+    def finalize(self):
+        """ 
+            Moves completed file to its final location 
+            Returns False if the received content does not match the announced digest
+        """
+        valid = digest_file(self.part_path) == self.digest
+        if valid:
+            os.replace(self.part_path, self.path)
+        else:
+            os.remove(self.part_path)
+        try:
+            os.remove(self.info_path)
+        except OSError:
+            pass
+        return valid
+
+
+def block_size_for(size):
+    """ Block size used for signatures, grows with the square root of the file size like rsync """
+    return min(max(int(math.sqrt(size)) // 1024 * 1024, 4096), 1024 * 1024)
+
+
+def strong_checksum(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def file_signatures(path, block_size):
+    """ Weak and strong checksums of every block of a file, packed in a single bytes object """
+    signatures = bytearray()
+    with open(path, 'rb') as f:
+        while data := f.read(block_size):
+            signatures += SIGNATURE.pack(zlib.adler32(data), strong_checksum(data))
+    return bytes(signatures)
+
+
+def parse_signatures(signatures):
+    """ Indexes packed signatures by weak checksum """
+    table = {}
+    for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(signatures)):
+        table.setdefault(weak, []).append((index, strong))
+    return table
+
+
+def compute_delta(path, block_size, signatures, max_literal=None):
+    """
+        Finds blocks of the file that already exist in the previous version on the other side.
+        The adler32 checksum is rolled byte by byte through unmatched regions so that shifted
+        blocks are still found. Returns a list of [offset, length, basis_offset] copies, or
+        None if more than max_literal bytes would have to be sent.
+    """
+    table = parse_signatures(signatures)
+    size = os.path.getsize(path)
+    if max_literal is None:
+        max_literal = min(size // 2, MAX_DELTA_LITERAL)
+    if not table or size < block_size:
+        return None if size > max_literal else []
+
+    copies = []
+    literal = 0
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        pos = 0
+        weak = None
+        while pos + block_size <= size:
+            if weak is None:
+                weak = zlib.adler32(data[pos:pos + block_size])
+                a, b = weak & 0xffff, weak >> 16
+
+            match = None
+            if weak in table:
+                strong = strong_checksum(data[pos:pos + block_size])
+                match = next((index for index, s in table[weak] if s == strong), None)
+
+            if match is not None:
+                basis_offset = match * block_size
+                if copies and copies[-1][0] + copies[-1][1] == pos \
+                        and copies[-1][2] + copies[-1][1] == basis_offset:
+                    copies[-1][1] += block_size
+                else:
+                    copies.append([pos, block_size, basis_offset])
+                pos += block_size
+                weak = None
+                continue
+
+            # Roll checksum one byte forward
+            literal += 1
+            if literal > max_literal:
+                return None
+            if pos + block_size == size:
+                break
+            out_byte, in_byte = data[pos], data[pos + block_size]
+            a = (a - out_byte + in_byte) % ADLER_MOD
+            b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+            weak = (b << 16) | a
+            pos += 1
+
+    return copies
+
+
+def literal_ranges(size, copies):
+    """ Ranges of the file not covered by copies, these have to be sent """
+    ranges = []
+    offset = 0
+    for copy_offset, length, _ in sorted(copies):
+        if copy_offset > offset:
+            ranges.append((offset, copy_offset - offset))
+        offset = copy_offset + length
+    if offset < size:
+        ranges.append((offset, size - offset))
+    return ranges
+
+
+def apply_copies(basis, path, size, copies, chunk_size=CHUNK_SIZE):
+    """ Creates file of the given size filled with blocks copied from the previous version """
+    with open(basis, 'rb') as src, open(path, 'wb') as dest:
+        dest.truncate(size)
+        for offset, length, basis_offset in copies:
+            src.seek(basis_offset)
+            dest.seek(offset)
+            while length > 0:
+                data = src.read(min(chunk_size, length))
+                dest.write(data)
+                length -= len(data)
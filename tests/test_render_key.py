@@ -0,0 +1,46 @@
+import os
+import sys
+import hashlib
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "BlenderRemoteRenderServer"))
+
+# Render keys are computed in Blender, the server needs ZeroMQ
+pytest.importorskip("bpy")
+pytest.importorskip("zmq")
+
+from file_cache import FileCache
+from render_key import hash_file
+from server import Server
+
+
+def asset_key(path):
+    h = hashlib.sha256()
+    hash_file(h, path)
+    return h.hexdigest()
+
+
+def test_asset_key_survives_submissions(tmp_path, monkeypatch):
+    """ A scene submitted twice with the same assets gets the same keys, so its frames hit the render cache """
+    monkeypatch.chdir(tmp_path)
+    data = b"texture" * 1000
+    digest = hashlib.sha256(data).hexdigest()
+    assets = [{'type': 'IMAGE', 'name': 'texture', 'filename': 'texture.png', 'digest': digest}]
+    server = SimpleNamespace(file_cache=FileCache(str(tmp_path / "cache"), 1 << 30),
+                             backend=SimpleNamespace(get_asset_manifest=lambda blend_file: blend_file + ".assets.json"))
+
+    # First submission uploads the missing asset
+    assert Server.link_assets(server, str(tmp_path / "scene.blend"), assets) == [digest]
+    path = os.path.abspath(os.path.join("assets", digest, "texture.png"))
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+    server.file_cache.store(path, digest)
+    first_key = asset_key(path)
+
+    # Second submission links it from the file cache, which updates its modification time
+    os.utime(path, ns=(0, 0))
+    assert Server.link_assets(server, str(tmp_path / "scene.blend"), assets) == []
+    assert asset_key(path) == first_key